@@ -1,31 +1,321 @@
 
 """
 This file contains key classes to enable AutoPlay of the game (2048).
-- AutoPlayer, MoveTree
+- AutoPlayer, MoveTree, Expectimax
 
 The functionality of each can be configured through parameters passed into AutoPlayer
 
-This file requires supporting functions from either AutoPlayUtilsCy or AutoPlayUtilsPy
-AutoPlayUtilsCy is recommended for much faster processing.
+This file requires supporting functions from one of the AutoPlayUtils backends:
+AutoPlayUtilsCy (Cython), AutoPlayUtilsNb (Numba) or AutoPlayUtilsPy (pure Python).
+Each AutoPlayer picks one (see get_backend()).  Cy and Nb are much faster than Py.
 """
 
+import os
+import multiprocessing
+from importlib import import_module
 from math import floor
-from numpy import zeros, random, single, int64
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+from numpy import (zeros, random, sort, concatenate, unique,
+                   single, float64, int8, int32, int64, uint64)
 # from pprint import pp
 # import cProfile
 
-import AutoPlayUtilsPy
-import AutoPlayUtilsCy
+import BitBoard
+import HeuristicTables
+import NTuple
+import SearchCache
 
 SIZE = int(4)
 
-# !!! Important configuration flag. Determines if UtilsPy or UtilsCy is used,
-# with a huge impact on execution speed.
-USE_CYTHON = True
+# AutoPlayUtils backends: name --> module.  In order of preference (fastest first) for "auto"
+BACKENDS = {"cy": "AutoPlayUtilsCy", "nb": "AutoPlayUtilsNb", "py": "AutoPlayUtilsPy"}
+
+# Functions every AutoPlayUtils module must have (see Backend)
+BACKEND_FUNCS = ("move_tiles_into", "add_random_tile_into", "check_game_over", "pack_tiles",
+                 "move_boards_all", "calc_metrics_boards", "calc_metric_bitboard",
+                 "calc_metrics0", "calc_metrics1", "calc_metrics2", "calc_metrics3", "calc_metrics4",
+                 "lut_metric_bitboard", "lut_metrics_boards", "merge_top_metrics")
+
+# Environment variable naming the backend of AutoPlayers created with backend=None
+BACKEND_ENV = "AUTOPLAY_BACKEND"
+
+# Number of random floats generated at a time by each AutoPlayer (see RandStream)
+RAND_CHUNK = 2**16
+
+# Recommended AutoPlayer depth_bands: (max empty tiles, depth).  Fewer empty tiles --> deeper
+DEPTH_BANDS = ((2, 6), (5, 5), (9, 4), (16, 3))
+
+# Boards with at least this many distinct tile values are searched 1 level deeper (if depth_bands)
+DISTINCT_TILES_DANGER = 9
+
+# Probabilities of the value of each new random tile
+TILE_PROBS = ((1, 0.9), (2, 0.1))     # (BitBoard exponent, probability) for 2 and 4
 
 # ------------------------------
 
 
+def calc_metric(tiles, ap):
+    """
+    Compute the "quality" metric of a board with the calc_metricX() function
+    selected by ap.calc_option, from ap.backend (see Backend.metric_func())
+
+    :param tiles: NumPy 2D-array of game board
+    :param ap: AutoPlayer object
+    :return: metric (int or float)
+    """
+
+    return ap.metric_func(tiles)
+
+
+def cached_metric(tiles, ap):
+    """
+    Same as calc_metric(), but first checks ap.trans_table and ap.eval_cache (if any) for
+    the board, and saves newly calculated metrics there.
+    """
+
+    trans_table = ap.trans_table
+    eval_cache = ap.eval_cache
+    if trans_table is None and eval_cache is None:
+        return calc_metric(tiles, ap)
+
+    board = ap.backend.pack_tiles(tiles)
+
+    if trans_table is not None:
+        metric = trans_table.lookup(board, 0, exact=True)
+        if metric is not None:
+            return metric
+
+    metric = None if (eval_cache is None) else eval_cache.lookup(board, ap.eval_params)
+    if metric is None:
+        metric = calc_metric(tiles, ap)
+        if eval_cache is not None:
+            eval_cache.store(board, ap.eval_params, metric)
+
+    if trans_table is not None:
+        trans_table.store(board, 0, metric)
+
+    return metric
+
+
+def cached_metrics(boards, ap):
+    """
+    Metrics of many boards, computed all at once by ap.backend (without the GIL, if compiled).
+    If ap.eval_cache is set, only the distinct boards not found there are computed.
+
+    :param boards: NumPy uint64 1D-array of packed boards
+    :param ap: AutoPlayer object
+    :return: NumPy float64 1D-array
+    """
+
+    eval_cache = ap.eval_cache
+    if eval_cache is None:
+        return ap.boards_metric_func(boards)
+
+    unique_boards, inverse = unique(boards, return_inverse=True)
+    metrics, found = eval_cache.lookup_boards(unique_boards, ap.eval_params)
+
+    missing = ~found
+    if missing.any():
+        metrics[missing] = ap.boards_metric_func(unique_boards[missing])
+        eval_cache.store_boards(unique_boards[missing], ap.eval_params, metrics[missing])
+
+    return metrics[inverse]
+
+# ------------------------------
+
+
+class Backend:
+    """
+    Dispatch table of one AutoPlayUtils module.  All backends have the same function surface,
+    so AutoPlay looks each function up once here, instead of choosing a module at every call.
+    Get Backends with get_backend(), which creates one per module and process.
+
+    ----- Attributes -----
+    - name : str. key of BACKENDS ("cy", "nb" or "py")
+    - utils : the AutoPlayUtils module
+    - move_tiles_into, add_random_tile_into, check_game_over, pack_tiles, move_boards_all,
+      calc_metrics_boards, calc_metric_bitboard, calc_metrics4, lut_metric_bitboard,
+      lut_metrics_boards, merge_top_metrics : functions of utils
+
+    ----- Methods -----
+    The metric functions of calc_option 4 need lut (see HeuristicTables.build_lut()),
+    and of calc_option 5 need network (NTuple.NTupleNetwork, the same for every backend)
+    - metric_func(calc_option, mult_base, lut=None, network=None) : function(tiles) --> metric
+    - board_metric_func(calc_option, mult_base, lut=None, network=None) : function(board) --> metric
+    - boards_metric_func(calc_option, mult_base, lut=None, network=None, num_threads=1)
+        : function(boards) --> metrics, on num_threads threads (Cy and Nb)
+    """
+
+    def __init__(self, name, utils):
+
+        # An old build of AutoPlayUtilsCy imports fine, but lacks newer functions
+        missing = [func for func in BACKEND_FUNCS if not hasattr(utils, func)]
+        if missing:
+            raise ImportError(f"{utils.__name__} is out of date (missing {', '.join(missing)}). "
+                              f"Rebuild it with: python setup.py build_ext --inplace")
+
+        self.name = name
+        self.utils = utils
+
+        self.move_tiles_into = utils.move_tiles_into
+        self.add_random_tile_into = utils.add_random_tile_into
+        self.check_game_over = utils.check_game_over
+        self.pack_tiles = utils.pack_tiles
+        self.move_boards_all = utils.move_boards_all
+        self.calc_metrics_boards = utils.calc_metrics_boards
+        self.calc_metric_bitboard = utils.calc_metric_bitboard
+        self.calc_metrics4 = utils.calc_metrics4
+        self.lut_metric_bitboard = utils.lut_metric_bitboard
+        self.lut_metrics_boards = utils.lut_metrics_boards
+        self.merge_top_metrics = utils.merge_top_metrics
+
+        # Indexed by calc_option
+        self.calc_metrics = (utils.calc_metrics0, utils.calc_metrics1,
+                             utils.calc_metrics2, utils.calc_metrics3)
+
+    def __repr__(self):
+        return f"Backend({self.name!r}, {self.utils.__name__})"
+
+    def metric_func(self, calc_option, mult_base, lut=None, network=None):
+        """:return: function(tiles) --> metric of a NumPy 2D-array of tiles, for calc_option.
+                    Unknown calc_option --> metric is always 0"""
+
+        if calc_option == 0:
+            return self.calc_metrics[0]
+
+        if calc_option in (1, 2, 3):
+            calc_metrics = self.calc_metrics[calc_option]
+            return lambda tiles: calc_metrics(tiles, mult_base)
+
+        if calc_option == 4:
+            calc_metrics4 = self.calc_metrics4
+            return lambda tiles: calc_metrics4(tiles, lut)
+
+        if calc_option == 5:
+            pack_tiles = self.pack_tiles
+            return lambda tiles: network.metric(pack_tiles(tiles))
+
+        return lambda tiles: 0
+
+    def board_metric_func(self, calc_option, mult_base, lut=None, network=None):
+        """:return: function(board) --> metric of a packed BitBoard, for calc_option"""
+
+        if calc_option == 4:
+            lut_metric_bitboard = self.lut_metric_bitboard
+            return lambda board: lut_metric_bitboard(board, lut)
+
+        if calc_option == 5:
+            return network.metric
+
+        calc_metric_bitboard = self.calc_metric_bitboard
+        return lambda board: calc_metric_bitboard(board, calc_option, mult_base)
+
+    def boards_metric_func(self, calc_option, mult_base, lut=None, network=None, num_threads=1):
+        """:return: function(boards) --> NumPy float64 1D-array of the metrics of a NumPy uint64
+                    1D-array of packed BitBoards, for calc_option.  (num_threads: 0 --> one per CPU)"""
+
+        if calc_option == 4:
+            lut_metrics_boards = self.lut_metrics_boards
+            return lambda boards: lut_metrics_boards(boards, lut, num_threads)
+
+        if calc_option == 5:
+            return network.metrics
+
+        calc_metrics_boards = self.calc_metrics_boards
+        return lambda boards: calc_metrics_boards(boards, calc_option, mult_base, num_threads)
+
+
+_backends = {}
+
+
+def get_backend(name=None):
+    """
+    Load (once per process) and return the Backend of an AutoPlayUtils module.
+
+    :param name: str. "cy", "nb", "py" or "auto".  "auto" --> the first of BACKENDS that
+                 can be imported on this host, and has all of BACKEND_FUNCS.  None --> environment variable AUTOPLAY_BACKEND,
+                 or "auto" if it isn't set
+    :return: Backend
+    """
+
+    if name is None:
+        name = os.environ.get(BACKEND_ENV) or "auto"
+
+    backend = _backends.get(name)
+    if backend is not None:
+        return backend
+
+    if name == "auto":
+        for candidate in BACKENDS:
+            try:
+                backend = get_backend(candidate)
+                break
+            except ImportError:
+                continue
+    elif name in BACKENDS:
+        backend = Backend(name, import_module(BACKENDS[name]))
+    else:
+        raise ValueError(f"Unknown backend '{name}'. Must be one of {', '.join(BACKENDS)} or 'auto'.")
+
+    _backends[name] = backend
+    return backend
+
+# ------------------------------
+
+
+class RandStream:
+    """
+    Stream of random floats [0.0, 1.0), generated chunk_size at a time from a NumPy Generator.
+
+    Memory use is fixed (one chunk of float32) no matter how long the game or deep the search.
+    For a given Generator seed, and the same sequence of take() calls, the numbers are identical.
+
+    ----- Methods -----
+    - take(num)
+        Returns a NumPy float32 1D-array view of the next num unused random numbers.
+        Refills the buffer first, if fewer than num are left.
+        The view is only valid until the next take().
+    """
+
+    def __init__(self, rand, chunk_size=RAND_CHUNK):
+        """
+        :param rand: NumPy random Generator
+        :param chunk_size: int. number of random floats generated at a time
+        """
+
+        self.rand = rand
+        self.chunk_size = chunk_size
+        self.rands = self.rand.random(chunk_size, dtype=single)
+        self.rand_idx = 0
+        self.num_used = 0
+
+    def take(self, num):
+
+        self.num_used += num
+
+        # Rarely, a request (e.g. a huge MoveTree level) is larger than a whole chunk
+        if num > self.chunk_size:
+            return self.rand.random(num, dtype=single)
+
+        # Keep the unused numbers, and fill the rest of the buffer with new ones
+        if self.rand_idx + num > self.chunk_size:
+            remaining = self.chunk_size - self.rand_idx
+            self.rands[:remaining] = self.rands[self.rand_idx:]
+            self.rands[remaining:] = self.rand.random(self.chunk_size - remaining, dtype=single)
+            self.rand_idx = 0
+
+        rands = self.rands[self.rand_idx:self.rand_idx + num]
+        self.rand_idx += num
+
+        return rands
+
+
+class SearchTimeout(Exception):
+    """Raised inside a search when AutoPlayer.deadline has passed"""
+    pass
+
+
 class AutoPlayer:
     """
     Each instance enables autoplay of the GameMgr "game" passed into constructor.
@@ -37,58 +327,184 @@ class AutoPlayer:
         Determines best move with get_move() and takes it, changing game state.
     """
 
-    def __init__(self, game, tree_depth=6, topx_perc=0.05, calc_option=3, rand=None, mult_base=1.5):
+    def __init__(self, game, tree_depth=6, topx_perc=0.05, calc_option=3, rand=None, mult_base=1.5,
+                 search_mode="tree", prob_cutoff=0.0001, trans_table_bits=None, time_budget=None,
+                 rand_chunk=RAND_CHUNK, num_workers=0, split_depth=1, reuse_tree=False,
+                 depth_bands=None, max_nodes=None, backend=None, eval_cache=None,
+                 lut_weights=None, ntuple_file=None, num_threads=1):
         """
         :param game: GameMgr.Game instance holding current game state
 
         Parameters configuring how the AutoPlayer plays the game
 
         :param tree_depth: the level of depth of the 4-ary tree MoveTree
+                           (search_mode "expectimax": number of moves searched, 2-4 recommended)
         :param topx_perc: float 0.01-0.05. Controls % of forward move scores being "averaged"
-        :param calc_option: int 0-4. Decides which overall strategy is used.
+        :param calc_option: int 0-5. Decides which overall strategy is used.
+                            4 --> lookup table heuristic (see HeuristicTables)
+                            5 --> learned n-tuple network (see NTuple), from ntuple_file
         :param rand: Numpy random Generator. Default None --> new Generator created
         :param mult_base: float 1.0-5.0. Parameter of calc_metricX() functions
-
-        NOTE:   If Cython is used, then Autoplay MUST contain random numbers.
-                MUCH faster to generate all random numbers upfront w/NumPy vs. on the fly
-                self.rand_idx must be incremented each time one is used.
-
-                If Cython is NOT used, (speed not critical) then rands not needed
-                Rands can be generated on-the-fly by GameMgr.Game.rand
+        :param search_mode: str. "tree" --> MoveTree with one sampled random tile per move
+                                 "expectimax" --> Expectimax with every possible random tile
+        :param prob_cutoff: float. "expectimax" only. Random tile branches less likely than this
+                                   are not searched deeper, only evaluated.
+        :param trans_table_bits: int. Size of transposition table of board metrics (2**bits entries)
+                                      kept across moves.  0 --> no transposition table
+                                      None --> 16 for "expectimax", 0 for "tree".  (MoveTree
+                                      samples its random tiles, so boards rarely repeat)
+        :param time_budget: float. seconds per move.  If given, get_move() searches depth 1, 2, ...
+                            up to tree_depth until the time is used up, and returns the best move
+                            of the deepest completed search.  None --> always search tree_depth
+        :param rand_chunk: int. number of random floats generated at a time by self.rands
+        :param num_workers: int. If > 0, the subtrees below the first move(s) are searched in
+                            parallel by a persistent pool of num_workers processes.
+                            Results are deterministic for a given rand seed, but not the same
+                            as with num_workers=0.
+        :param split_depth: int >= 1. "tree" only. Level of MoveTree split between worker tasks.
+                            1 --> up to 4 tasks, 2 --> up to 16 tasks, ...
+                            ("expectimax" always splits after the first move --> up to 4 tasks)
+        :param reuse_tree: bool. "tree" only (and num_workers=0).  If the new game state is in the
+                           last MoveTree (the move taken, AND the random tile that was added),
+                           that subtree is kept, and only the missing levels are built.
+                           Faster, but the kept levels' random tiles were drawn for the last
+                           move, so games differ from reuse_tree=False for the same rand seed.
+        :param depth_bands: tuple of (max_empty, depth) pairs, by increasing max_empty.
+                            Search depth of each move is the depth of the first band with
+                            max_empty >= the number of empty tiles, +1 for boards with
+                            DISTINCT_TILES_DANGER or more distinct tiles.  Never > tree_depth.
+                            None --> always tree_depth.  (See DEPTH_BANDS)
+        :param max_nodes: int. Hard limit of nodes per search.  "tree": levels are only added
+                          while even a full next level fits.  "expectimax": boards are only
+                          evaluated, not searched deeper, once max_nodes boards were evaluated.
+                          None --> no limit
+        :param backend: str. AutoPlayUtils module used: "cy", "nb", "py" or "auto" (fastest
+                        available).  None --> environment variable AUTOPLAY_BACKEND, else "auto".
+                        (See get_backend())
+        :param eval_cache: SearchCache.EvalCache.  Cache of board metrics, checked before
+                           each metric is calculated.  May be shared by many AutoPlayers
+                           (and games).  None --> no cache
+        :param lut_weights: dict. calc_option 4 only.  Weight of each component of the lookup
+                            table heuristic, by name (see HeuristicTables.LUT_WEIGHTS).
+                            Missing names keep their default weight.  The tables are rebuilt
+                            for each AutoPlayer, so weights can be tuned without recompiling.
+        :param ntuple_file: str. calc_option 5 only.  Weight file of an NTuple.NTupleNetwork,
+                            trained with Training.train_ntuple().  Memory-mapped read-only,
+                            so AutoPlayers (and worker processes) share one copy.
+        :param num_threads: int. Threads of the batch functions of the backend (Cy and Nb only),
+                            used by MoveTree levels.  0 --> one per CPU.  Keep 1 with num_workers,
+                            or with many AutoPlayers in parallel processes: N processes of
+                            N threads oversubscribe the CPUs.  (Worker processes always use 1)
+
+        NOTE:   Autoplay MUST contain random numbers, for MoveTree and Cython add_random_tile()
+                MUCH faster to generate random numbers in chunks w/NumPy vs. one at a time.
+                self.rands is a RandStream: a fixed size buffer, refilled from self.rand.
         """
         # GameMgr.Game object stores current game state: tiles, score, etc
         self.game = game
 
         self.tree_depth = tree_depth
         self.tree_size = 0
+        self.move_tree = None
+        self.reuse_tree = reuse_tree
+
+        # Depth of the current / last completed search. Equals tree_depth, unless time_budget or
+        # depth_bands are used
+        self.time_budget = time_budget
+        self.search_depth = tree_depth
+        self.depth_bands = depth_bands
+        self.max_nodes = max_nodes
+        self.deadline = None
         self.topx_perc = topx_perc
         self.calc_option = calc_option
         self.mult_base = mult_base
 
-        if USE_CYTHON:
-
-            # Enable optional passing of fixed seed NumPy number Generator for testing
-            if rand is None:
-                self.rand = random.default_rng()
-            else:
-                self.rand = rand
+        # Lookup tables of calc_option 4, built from the weights
+        self.lut_weights = dict(HeuristicTables.LUT_WEIGHTS, **(lut_weights or {}))
+        if calc_option == 4:
+            self.lut = HeuristicTables.build_lut(self.lut_weights, mult_base)
+        else:
+            self.lut = None
+
+        # N-tuple network of calc_option 5, memory-mapped from its weight file
+        self.ntuple_file = ntuple_file
+        if calc_option == 5:
+            if ntuple_file is None:
+                raise ValueError("calc_option 5 needs an ntuple_file of network weights.")
+            self.network = NTuple.NTupleNetwork.load(ntuple_file)
+        else:
+            self.network = None
+
+        # Functions of the backend are looked up once, here
+        self.backend = get_backend(backend)
+        self.metric_func = self.backend.metric_func(calc_option, mult_base, self.lut, self.network)
+        self.board_metric_func = self.backend.board_metric_func(calc_option, mult_base,
+                                                                self.lut, self.network)
+        self.num_threads = num_threads
+        self.boards_metric_func = self.backend.boards_metric_func(calc_option, mult_base,
+                                                                  self.lut, self.network,
+                                                                  num_threads)
+
+        # Metrics only depend on the board and these, so eval_cache is keyed on them
+        self.eval_params = (calc_option, mult_base)
+        if calc_option == 4:
+            self.eval_params += (tuple(sorted(self.lut_weights.items())),)
+        if calc_option == 5:
+            self.eval_params += (os.path.abspath(ntuple_file),)
+        self.eval_cache = eval_cache
+
+        if search_mode not in ("tree", "expectimax"):
+            raise ValueError(f"Unknown search_mode '{search_mode}'. Must be 'tree' or 'expectimax'.")
+        self.search_mode = search_mode
+        self.prob_cutoff = prob_cutoff
+
+        # Transposition table persists across get_move() calls.
+        if trans_table_bits is None:
+            trans_table_bits = 16 if (search_mode == "expectimax") else 0
+
+        self.trans_table_bits = trans_table_bits
+        if trans_table_bits:
+            self.trans_table = SearchCache.TranspositionTable(trans_table_bits)
+        else:
+            self.trans_table = None
 
-            # Calculate how many random numbers are needed based on move tree size
-            rand_nums = int(sum([4**i for i in range(tree_depth+1)])*2*4000)
-            self.rands = self.rand.random(rand_nums, dtype=single)
-            self.rand_idx = int(0)
+        self.num_workers = num_workers
+        self.split_depth = split_depth
 
+        # Enable optional passing of fixed seed NumPy number Generator for testing
+        if rand is None:
+            self.rand = random.default_rng()
         else:
-            self.rand = None
+            self.rand = rand
+
+        self.rands = RandStream(self.rand, rand_chunk)
+
+    def worker_params(self):
+        """:return: tuple of the strategy parameters, to configure AutoPlayers in worker processes"""
+
+        return (self.calc_option, self.mult_base, self.topx_perc, self.search_mode,
+                self.prob_cutoff, self.trans_table_bits, self.rands.chunk_size, self.backend.name,
+                tuple(sorted(self.lut_weights.items())), self.ntuple_file)
+
+    def time_left(self):
+        """:return: seconds until self.deadline, or None if no deadline"""
+
+        return None if (self.deadline is None) else self.deadline - perf_counter()
 
     def __repr__(self):
 
         out = list()
         out.append("-"*30 + "\n")
-        out.append(f"AutoPlay - Tree Depth: {self.tree_depth} | " +
+        out.append(f"AutoPlay - Tree Depth: {self.tree_depth} | Last Depth: {self.search_depth} | " +
                    f"TopX: {self.topx_perc}%, {floor(self.tree_size*self.topx_perc)} | " +
                    f"Calc Opt: {self.calc_option} | Mult Base: {self.mult_base} | " +
-                   f"Rands Length: {self.rands.size} | rand_idx: {self.rand_idx}\n")
+                   f"Backend: {self.backend.name}, {self.num_threads or 'all'} threads | " +
+                   f"Rand Chunk: {self.rands.chunk_size} | Rands Used: {self.rands.num_used} | " +
+                   f"Tree Reuses: {self.move_tree.num_reroots if self.move_tree else 0}\n")
+        if self.trans_table is not None:
+            out.append(repr(self.trans_table))
+        if self.eval_cache is not None:
+            out.append(repr(self.eval_cache))
         out.append(repr(self.game))
 
         return "".join(out)
@@ -102,11 +518,111 @@ class AutoPlayer:
 
         Used by auto_move() and ui.autoplay_move()
 
+        If time_budget is set, searches are "iteratively deepened" until time runs out.
+
         :return: int 0-3. ((0: Up, 1: Right, 2: Down, 3: Left)
         """
 
-        self.tree_size = 0
-        move_tree = MoveTree(None, self.game.tiles, self.game.score, self)
+        if self.trans_table is not None:
+            self.trans_table.new_search()
+
+        max_depth = self.choose_depth()
+        if self.time_budget is None:
+            return self.search_move(max_depth)
+
+        # --- Iterative Deepening
+        start_time = perf_counter()
+        deadline = start_time + self.time_budget
+
+        # Depth 1 always completes, so there is always a move
+        best_move = self.search_move(1)
+        last_time = perf_counter() - start_time
+
+        for depth in range(2, max_depth + 1):
+
+            # Each level costs up to ~4x the previous. Don't start a search that can't finish
+            now = perf_counter()
+            if now + last_time * 4 > deadline:
+                break
+
+            self.deadline = deadline
+            try:
+                move = self.search_move(depth)
+            except SearchTimeout:
+                break
+            finally:
+                self.deadline = None
+
+            best_move = move
+            last_time = perf_counter() - now
+
+        return best_move
+
+    def choose_depth(self):
+        """
+        Depth to search the current game state to, from depth_bands.
+        Boards with few empty tiles, or many distinct tiles (few merges), are in more danger.
+
+        :return: int 1 - tree_depth
+        """
+
+        if self.depth_bands is None:
+            return self.tree_depth
+
+        board = self.game.get_bitboard()
+        num_empty = BitBoard.count_empty(board)
+
+        depth = self.depth_bands[-1][1]
+        for max_empty, band_depth in self.depth_bands:
+            if num_empty <= max_empty:
+                depth = band_depth
+                break
+
+        if BitBoard.count_distinct(board) >= DISTINCT_TILES_DANGER:
+            depth += 1
+
+        return max(1, min(depth, self.tree_depth))
+
+    def search_move(self, depth):
+        """
+        Search to depth with the configured search_mode and return the best move.
+        Raises SearchTimeout if self.deadline passes during the search.
+
+        :param depth: int >= 1.
+        :return: int 0-3. ((0: Up, 1: Right, 2: Down, 3: Left)
+        """
+
+        if self.search_mode == "expectimax":
+            best_move = self.get_move_expectimax(depth)
+        else:
+            best_move = self.get_move_tree(depth)
+
+        self.search_depth = depth
+        return best_move
+
+    def get_move_tree(self, depth):
+        """
+        Determine and return the "best" next game move direction with MoveTree search.
+        Called by search_move() if search_mode is "tree"
+
+        :param depth: int >= 1. depth of MoveTree
+        :return: int 0-3. ((0: Up, 1: Right, 2: Down, 3: Left)
+        """
+
+        # Tree arrays are allocated once, and reused by every move
+        if self.move_tree is None or self.move_tree.max_depth < depth:
+            self.move_tree = MoveTree(depth)
+
+        move_tree = self.move_tree
+        if self.num_workers:
+            self.tree_size = self.build_tree_parallel(move_tree, depth)
+        else:
+            # Keep the part of the last tree below the current game state, if it's there
+            if self.reuse_tree and move_tree.reroot(self.game.get_bitboard(), self.game.score):
+                move_tree.extend(self, depth)
+            else:
+                move_tree.build(self.game.tiles, self.game.score, self, depth)
+            self.tree_size = move_tree.num_nodes(depth) - 1
 
         # # DEBUG
         # print_tree_bfs(move_tree)
@@ -118,45 +634,140 @@ class AutoPlayer:
         for move_dir in range(SIZE):
 
             # If this was an invalid move (no node exists), metric is -2
-            if move_tree.next[move_dir] is None:
+            node = move_tree.child(0, move_dir)
+            if node is None:
                 move_metrics.append(-2.0)
                 continue
 
             # If this move would displace a max from a corner, metric is -1
-            if move_tree.metric > 0 and move_tree.next[move_dir].metric == 0:
+            if move_tree.metric[0] > 0 and move_tree.metric[node] == 0:
                 move_metrics.append(-1.0)
                 continue
 
             # Experiments indicate top ~?% averaged yields best results
             topx_num = max(1, floor(self.tree_size*self.topx_perc))
-            max_metrics = zeros(topx_num, dtype=int64)
-            max_metrics[-1] = move_tree.next[move_dir].metric
-            max_metrics = AutoPlayUtilsPy.node_tree_max_DFS(move_tree.next[move_dir], max_metrics)
+            max_metrics = sort(move_tree.top_metrics[move_dir])[-topx_num:]
             move_metrics.append(max_metrics.sum() / float(topx_num))
 
         # # DEBUG
         # print(f"move_metrics: Up: {move_metrics[0]}, Right: {move_metrics[1]}, " +
         #       f"Down: {move_metrics[2]}, Left: {move_metrics[3]}")
 
-        # Important...multiple metrics can be the same
+        # Important...multiple metrics can be the same.  Ties go to the first (lowest) direction
         max_met = max(move_metrics)
-        maxs = [(i, move_metrics[i]) for i in range(4) if move_metrics[i] == max_met]
+        best_move = move_metrics.index(max_met)
+
+        # # DEBUG
+        # if move_metrics.count(max_met) > 1 and max_met > 0:
+        #     print(f"MORE THAN ONE BEST MOVE: move_metrics = {move_metrics}")
+
+        return best_move
+
+    def build_tree_parallel(self, move_tree, depth):
+        """
+        Build move_tree to split_depth here, then search the subtree below each node of that
+        last level ("frontier") in the worker pool.  Worker results are merged into
+        move_tree.top_metrics, so get_move_tree() can use it as if the whole tree was built.
+
+        :return: int. number of nodes in the whole tree (excluding node 0)
+        """
+
+        split_depth = min(self.split_depth, depth)
+        topx_max = max(1, floor(sum([4**i for i in range(1, depth + 1)]) * self.topx_perc))
+        move_tree.build(self.game.tiles, self.game.score, self, split_depth, topx_max)
+        tree_size = move_tree.size - 1
+
+        # No frontier if tree is already deep enough, or moves ran out before split_depth
+        if split_depth == depth or len(move_tree.level_start) - 2 < split_depth:
+            return tree_size
+
+        lo, hi = move_tree.level_start[-2], move_tree.level_start[-1]
 
-        # If only one max, or no good move, pick it/one.
-        if len(maxs) == 1 or max_met <= 0:
-            best_move = move_metrics.index(max_met)
+        # Each task gets its own seed, so results don't depend on which worker runs it
+        seeds = self.rand.integers(0, 2**63, size=hi - lo)
 
-        # If there is more than one equally good move
+        pool = get_worker_pool(self.num_workers)
+        params = self.worker_params()
+        futures = [pool.submit(search_subtree, params, int(move_tree.board[node]),
+                               int(move_tree.score[node]), depth - split_depth, topx_max,
+                               int(seeds[node - lo]), self.time_left())
+                   for node in range(lo, hi)]
+
+        try:
+            for node, future in zip(range(lo, hi), futures):
+                subtree_size, top_metrics = future.result()
+                tree_size += subtree_size
+
+                branch = move_tree.branch[node]
+                move_tree.top_metrics[branch] = self.backend.merge_top_metrics(
+                    move_tree.top_metrics[branch], top_metrics, topx_max)
+        finally:
+            for future in futures:
+                future.cancel()
+
+        return tree_size
+
+    def get_move_expectimax(self, depth):
+        """
+        Determine and return the "best" next game move direction with Expectimax search.
+        Called by search_move() if search_mode is "expectimax"
+
+        :param depth: int >= 1. number of moves searched
+        :return: int 0-3. ((0: Up, 1: Right, 2: Down, 3: Left)
+        """
+
+        if self.num_workers and depth > 1:
+            move_metrics = self.search_expectimax_parallel(depth)
         else:
-            print(f"MORE THAN ONE BEST MOVE: move_metrics = {move_metrics}")
-            best_move = move_metrics.index(max_met)
+            search = Expectimax(self)
+            move_metrics = search.search(self.game.get_bitboard(), depth)
+            self.tree_size = search.num_evals
 
-        return best_move
+        return move_metrics.index(max(move_metrics))
+
+    def search_expectimax_parallel(self, depth):
+        """
+        Same as Expectimax.search(), but the chance node after each valid first move is
+        searched as a separate task in the worker pool.
+
+        :return: list of 4 floats. expected metric of each move. -2.0 if move is invalid
+        """
+
+        board = self.game.get_bitboard()
+        pool = get_worker_pool(self.num_workers)
+        params = self.worker_params()
+
+        futures = []
+        valid_mask, boards2, _ = BitBoard.move_all(board)
+        for direction in range(4):
+            if (valid_mask >> direction) & 1:
+                futures.append(pool.submit(search_expectimax, params, boards2[direction],
+                                           depth - 1, self.time_left()))
+            else:
+                futures.append(None)
+
+        move_metrics = []
+        self.tree_size = 0
+        try:
+            for future in futures:
+                if future is None:
+                    move_metrics.append(-2.0)
+                    continue
+
+                value, num_evals = future.result()
+                move_metrics.append(value)
+                self.tree_size += num_evals
+        finally:
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+
+        return move_metrics
 
     def auto_move(self):
         """
         Determines best move with get_move() and takes it, changing game state.
-        Uses faster Cython Utils, if possible.
+        The move and the random tile are made in place by the backend, no new arrays.
 
         :return: bool. True if move was valid, otherwise false."""
 
@@ -164,122 +775,543 @@ class AutoPlayer:
             return
 
         best_move = self.get_move()
+        backend = self.backend
 
-        if USE_CYTHON:
-            valid_move, tiles2, self.game.score = \
-                AutoPlayUtilsCy.move_tiles(best_move, self.game.tiles, self.game.score)
-        else:
-            valid_move, _, _, _ = self.game.move_tiles(best_move, True)
+        valid_move, delta = backend.move_tiles_into(best_move, self.game.tiles, self.game.tiles)
+        self.game.score += delta
 
         if valid_move:
-            if USE_CYTHON:
-                self.game.tiles, self.game.num_empty, self.rand_idx = \
-                    AutoPlayUtilsCy.add_random_tile(tiles2, self.rands, self.rand_idx)
-                self.game.num_moves += 1
+            rand_pos, rand_val = self.rands.take(2)
+            self.game.num_empty = max(0, backend.add_random_tile_into(self.game.tiles,
+                                                                      rand_pos, rand_val))
+            self.game.num_moves += 1
 
-                if self.game.num_empty == 0:
-                    self.game.game_over = self.game.check_game_over(self.game.tiles)
-            else:
-                self.game.add_random_tile(commit=True)
+            if self.game.num_empty == 0:
+                self.game.game_over = backend.check_game_over(self.game.tiles)
 
         return valid_move
 
 # ------------------------------
+# Process-parallel search (AutoPlayer num_workers > 0)
+# Worker processes keep one AutoPlayer per parameter set, and reuse it for every task.
+
+_worker_pools = {}
+_worker_players = {}
+
+
+def get_worker_pool(num_workers):
+    """:return: persistent ProcessPoolExecutor of num_workers processes, shared by all AutoPlayers"""
+
+    pool = _worker_pools.get(num_workers)
+    if pool is None:
+        # "spawn": forked workers would inherit the OpenMP runtime of this process, and hang in
+        # their first prange if this process already ran one.  Workers build their own
+        # AutoPlayers anyway (see _worker_player())
+        pool = ProcessPoolExecutor(max_workers=num_workers,
+                                   mp_context=multiprocessing.get_context("spawn"))
+        _worker_pools[num_workers] = pool
+
+    return pool
+
+
+def shutdown_worker_pools():
+    """Stop all worker processes.  A new pool is started if needed again."""
+
+    for pool in _worker_pools.values():
+        pool.shutdown(cancel_futures=True)
+    _worker_pools.clear()
+
+
+def _worker_player(params):
+
+    ap = _worker_players.get(params)
+    if ap is None:
+        (calc_option, mult_base, topx_perc, search_mode,
+         prob_cutoff, trans_table_bits, rand_chunk, backend, lut_weights, ntuple_file) = params
+        ap = AutoPlayer(None, 1, topx_perc, calc_option, random.default_rng(0), mult_base,
+                        search_mode, prob_cutoff, trans_table_bits, rand_chunk=rand_chunk,
+                        backend=backend, lut_weights=dict(lut_weights), ntuple_file=ntuple_file,
+                        num_threads=1)
+        _worker_players[params] = ap
+
+    return ap
+
+
+def search_subtree(params, board, score, depth, topx_max, seed, time_left):
+    """
+    Worker task.  Build a MoveTree below one node (board), to depth.
+
+    :return: (int, NumPy float64 1D-array). number of nodes below board, and their
+             topx_max largest metrics.
+    """
+
+    ap = _worker_player(params)
+    ap.rands = RandStream(random.default_rng(seed), ap.rands.chunk_size)
+    if ap.move_tree is None or ap.move_tree.max_depth < depth:
+        ap.move_tree = MoveTree(depth)
+
+    ap.deadline = None if (time_left is None) else perf_counter() + time_left
+    try:
+        ap.move_tree.build(BitBoard.to_tiles(board), score, ap, depth, topx_max)
+    finally:
+        ap.deadline = None
+
+    top_metrics = ap.backend.merge_top_metrics(zeros(0, dtype=float64),
+                                               concatenate(ap.move_tree.top_metrics), topx_max)
+
+    return ap.move_tree.size - 1, top_metrics
+
+
+def search_expectimax(params, board, depth, time_left):
+    """
+    Worker task.  Expectimax chance_node() value of board (after a first move).
+    The transposition table is cleared for each task, so the result never depends on
+    which tasks the worker ran before.
+
+    :return: (float, int). value, and number of boards evaluated
+    """
+
+    ap = _worker_player(params)
+    if ap.trans_table is not None:
+        ap.trans_table.clear()
+
+    search = Expectimax(ap)
+    ap.deadline = None if (time_left is None) else perf_counter() + time_left
+    try:
+        value = search.chance_node(board, depth, 1.0)
+    finally:
+        ap.deadline = None
+
+    return value, search.num_evals
+
+# ------------------------------
 
 
 class MoveTree:
     """
-    Nodes of individual game state linked to form 4-ary Tree Structure.
+    Tree of future game states, stored "flat" in preallocated NumPy arrays.
+
+    Node 0 (level 0) is the current actual game state.
+    Level 1 of tree contains up to 4 game states after the 4 possible moves
+    Level 2 of tree contains up to 16 game states, and so on
+
+    Each move is followed by one random tile, drawn from ap.rands.
+
+    Nodes are stored level by level.  Only valid moves create nodes, and the children of a
+    node are contiguous, in direction order.  So the nodes below any range of nodes on one
+    level are also a range on the next level (see subtree_ranges()).
 
-    Top of tree is the current actual game state.
-    Level 1 of tree contains 4 game states after the 4 possible moves
-    Level 2 of tree contains 16 game states, and so on
+    The tree is built one level at a time with BitBoard vector operations, and the arrays
+    are reused by each build(), so no memory is allocated per node.
 
-    Tree is created recursively in __init__ function to Level (tree_depth)
+    After a move, reroot() keeps the subtree below the new game state (if the tree holds it)
+    and extend() only builds the missing levels.  The tree may then hold more levels than
+    a search needs.  Searches only use levels up to their depth (see extend(), num_nodes()).
 
     For each Node, a metric of the "quality" of the board is computed and saved.
 
+    ----- Attributes (NumPy 1D-arrays indexed by node) -----
+    - board : uint64 packed BitBoard
+    - score : int64 game score
+    - metric : float64 board "quality" metric (see calc_metric)
+    - parent : int32 index of parent node (-1 for node 0)
+    - first_child : int32 index where the node's children start (even if it has none)
+    - num_children : int8 number of children (valid moves)
+    - move : int8 direction (0-3) of move from parent to node
+    - branch : int8 direction (0-3) of the first move, from node 0 towards node
+
+    - top_metrics : list of 4 NumPy float64 1D-arrays.  The largest metrics found below
+                    each first move (branch), up to topx_max of them, kept while building.
+
+    - level_start : list of int. Level L is nodes [level_start[L], level_start[L+1])
+    - size : int. number of nodes in current tree
+    - num_reroots : int. number of times a subtree was kept by reroot()
     """
 
-    def __init__(self, prev, tiles, score, ap):
+    def __init__(self, depth):
+        """
+        :param depth: int. maximum depth of trees built.  Allocates space for a full 4-ary tree.
+        """
+
+        self.max_depth = depth
+        capacity = sum([4**i for i in range(depth + 1)])
+
+        self.board = zeros(capacity, dtype=uint64)
+        self.score = zeros(capacity, dtype=int64)
+        self.metric = zeros(capacity, dtype=float64)
+        self.parent = zeros(capacity, dtype=int32)
+        self.first_child = zeros(capacity, dtype=int32)
+        self.num_children = zeros(capacity, dtype=int8)
+        self.move = zeros(capacity, dtype=int8)
+        self.branch = zeros(capacity, dtype=int8)
+
+        self.level_start = [0, 0]
+        self.size = 0
+        self.num_reroots = 0
+        self.topx_max = 1
+        self.top_metrics = [zeros(0, dtype=float64) for _ in range(4)]
+
+    def __repr__(self):
+
+        out = list()
+        out.append("-"*20 + "\n")
+        out.append(f"MoveTree - Nodes: {self.size} | Levels: {len(self.level_start) - 1}")
+        out.append(f"  |  Root Score: {self.score[0]}  |  Root Metric: {self.metric[0]}\n")
+
+        return "".join(out)
+
+    def build(self, tiles, score, ap, depth, topx_max=None):
         """
-        :param prev: MoveTree node. link to previous node in tree
-        :param tiles: NumPy 2D-array of game board of current node
-        :param score: int. score of current board
+        Build the tree of all moves from tiles, to depth.
+
+        :param tiles: NumPy 2D-array of game board of current game state
+        :param score: int. score of current game state
         :param ap: AutoPlayer object
+        :param depth: int. depth of the tree. Must be <= max_depth
+        :param topx_max: int. number of top metrics kept per branch.
+                         Default None --> enough for any tree of this depth
         """
 
-        # self.tiles = tiles.copy()
-        self.prev = prev
-        self.score = score
-        self.level = 0 if (prev is None) else (prev.level + 1)
-        self.metric = 0
-
-        if USE_CYTHON:  # Use fast Cython functions
-            if ap.calc_option == 0:
-                self.metric = AutoPlayUtilsCy.calc_metrics0(tiles)
-            elif ap.calc_option == 1:
-                self.metric = AutoPlayUtilsCy.calc_metrics1(tiles, ap.mult_base)
-            elif ap.calc_option == 2:
-                self.metric = AutoPlayUtilsCy.calc_metrics2(tiles, ap.mult_base)
-            elif ap.calc_option == 3:
-                self.metric = AutoPlayUtilsCy.calc_metrics3(tiles, ap.mult_base)
-
-        else:   # Use slower Python functions
-            if ap.calc_option == 0:
-                self.metric = AutoPlayUtilsPy.calc_metrics0(tiles)
-            elif ap.calc_option == 1:
-                self.metric = AutoPlayUtilsPy.calc_metrics1(tiles, ap.mult_base)
-            elif ap.calc_option == 2:
-                self.metric = AutoPlayUtilsPy.calc_metrics2(tiles, ap.mult_base)
-            elif ap.calc_option == 3:
-                self.metric = AutoPlayUtilsPy.calc_metrics3(tiles, ap.mult_base)
-
-        # Base Case: If already traversed to proper tree depth, stop
-        if self.level > ap.tree_depth - 1:
-            self.next = None
-            return
+        self.board[0] = BitBoard.from_tiles(tiles)
+        self.score[0] = score
+        self.metric[0] = cached_metric(tiles, ap)
+        self.parent[0] = -1
+        self.move[0] = -1
+        self.level_start = [0, 1]
+        self.size = 1
+
+        self.extend(ap, depth, topx_max)
+
+    def extend(self, ap, depth, topx_max=None):
+        """
+        Build the tree down to depth, from the levels already in the tree.
+        Recomputes top_metrics from the existing levels (up to depth) first.
+
+        :param ap: AutoPlayer object
+        :param depth: int. depth of the tree. Must be <= max_depth
+        :param topx_max: int. number of top metrics kept per branch. Default None, as build()
+        """
+
+        # Enough top metrics are kept for the largest possible tree, since size isn't known yet
+        if topx_max is None:
+            topx_max = max(1, floor(sum([4**i for i in range(1, depth + 1)]) * ap.topx_perc))
+        self.topx_max = topx_max
+        self.top_metrics = [zeros(0, dtype=float64) for _ in range(4)]
+
+        num_levels = min(depth, len(self.level_start) - 2)
+        for level in range(1, num_levels + 1):
+            self.merge_level(ap, self.level_start[level], self.level_start[level + 1])
+
+        for _ in range(num_levels, depth):
+
+            # Only add a level if even a full one stays within max_nodes
+            last_level = self.level_start[-1] - self.level_start[-2]
+            if ap.max_nodes is not None and self.size + 4 * last_level > ap.max_nodes:
+                break
+
+            if not self.build_level(ap):
+                break
+
+    def num_nodes(self, depth):
+        """:return: int. number of nodes in levels 0 - depth (including node 0)"""
+
+        return self.level_start[min(depth + 1, len(self.level_start) - 1)]
+
+    def build_level(self, ap):
+        """
+        Add the next level of the tree: every valid move of every node on the last level,
+        each followed by a random tile.
+
+        :param ap: AutoPlayer object
+        :return: bool. False if no valid moves were left (no level was added)
+        """
+
+        lo = self.level_start[-2]
+        hi = self.level_start[-1]
+
+        # All 4 moves of every node on the last level [lo, hi), in one call
+        valid, boards2, gained = ap.backend.move_boards_all(self.board[lo:hi], ap.num_threads)
+        scores2 = self.score[lo:hi, None] + gained
 
-        # Recursively build next level of tree
+        counts = valid.sum(axis=1)
+        self.num_children[lo:hi] = counts
+        self.first_child[lo:hi] = hi + counts.cumsum() - counts
+
+        num_new = int(counts.sum())
+        if num_new == 0:
+            return False
+
+        # New nodes, in parent order then direction order
+        new = slice(hi, hi + num_new)
+        parents, directions = valid.nonzero()
+        self.parent[new] = parents + lo
+        self.move[new] = directions
+        self.score[new] = scores2[valid]
+
+        rands = ap.rands.take(2 * num_new)
+        self.board[new], _ = BitBoard.add_random_tiles(boards2[valid], rands[0::2], rands[1::2])
+
+        if ap.deadline is not None and perf_counter() > ap.deadline:
+            raise SearchTimeout()
+
+        # Whole level at once (without the GIL, if compiled), unless metrics are looked up
+        # in trans_table.  Boards found in ap.eval_cache are not computed again
+        if ap.trans_table is None:
+            self.metric[new] = cached_metrics(self.board[new], ap)
         else:
-            self.next = []
+            tiles = BitBoard.boards_to_tiles(self.board[new])
+            metric = self.metric
+            for i in range(num_new):
 
-            # Children Moves: 0 - Up, 1 - Right, 2 - Down, 3 - Left
-            for direction in range(4):
+                if ap.deadline is not None and perf_counter() > ap.deadline:
+                    raise SearchTimeout()
 
-                # Move Tiles
-                if USE_CYTHON:
-                    valid_move, new_tiles, new_score = \
-                        AutoPlayUtilsCy.move_tiles(direction, tiles, score)
-                else:
-                    valid_move, _, new_tiles, new_score = \
-                        ap.game.move_tiles(direction, False, tiles, score)
+                metric[hi + i] = cached_metric(tiles[i], ap)
 
-                # If valid move, add random tile
-                if valid_move:
+        self.merge_level(ap, hi, hi + num_new)
 
-                    if USE_CYTHON:
-                        new_tiles, _, ap.rand_idx = \
-                            AutoPlayUtilsCy.add_random_tile(new_tiles, ap.rands, ap.rand_idx)
-                    else:
-                        new_tiles, _, _, ap.rand_idx = \
-                            ap.game.add_random_tile(commit=False, tiles=new_tiles)
+        self.level_start.append(hi + num_new)
+        self.size = hi + num_new
 
-                    ap.tree_size += 1
+        return True
 
-                    self.next.append(MoveTree(self, new_tiles, new_score, ap))
+    def merge_level(self, ap, lo, hi):
+        """
+        Set the branch of the nodes [lo, hi) of one level, and merge their metrics into
+        top_metrics.  Tracks the largest metrics below each first move while building,
+        so no separate traversal is needed.
+        """
 
-                else:
-                    self.next.append(None)
+        new = slice(lo, hi)
 
-    def __repr__(self):
+        # Level 1 always starts at node 1
+        if lo == 1:
+            self.branch[new] = self.move[new]
+        else:
+            self.branch[new] = self.branch[self.parent[new]]
 
-        out = list()
-        out.append("-"*20 + "\n")
-        out.append(f"Tree Level: {self.level}  |  Score: {self.score}")
-        out.append(f"  |  Metric: {self.metric}\n")
+        level_metric = self.metric[new]
+        level_branch = self.branch[new]
+        for direction in range(4):
 
-        return "".join(out)
+            new_metrics = level_metric[level_branch == direction]
+
+            # First move node's own metric is counted twice, as it always has been
+            if lo == 1:
+                new_metrics = concatenate((new_metrics, new_metrics))
+
+            if new_metrics.size:
+                self.top_metrics[direction] = ap.backend.merge_top_metrics(
+                    self.top_metrics[direction], new_metrics, self.topx_max)
+
+    def child(self, node, direction):
+        """:return: index of the child of node after move direction, or None if move invalid"""
+
+        for idx in range(self.first_child[node], self.first_child[node] + self.num_children[node]):
+            if self.move[idx] == direction:
+                return idx
+
+        return None
+
+    def reroot(self, board, score):
+        """
+        Make the node holding the game state (board, score) the new node 0, keeping its
+        subtree and dropping the rest of the tree.  The node is looked for at node 0
+        (same game state searched again) and on level 1 (after one move and random tile).
+
+        :param board: int. packed BitBoard of current game state
+        :param score: int. score of current game state
+        :return: bool. True if the state was found. False --> tree unchanged, call build()
+        """
+
+        if self.size == 0:
+            return False
+
+        if self.board[0] == board and self.score[0] == score:
+            return True
+
+        if len(self.level_start) < 3:
+            return False
+
+        lo, hi = self.level_start[1], self.level_start[2]
+        matches = ((self.board[lo:hi] == uint64(board)) & (self.score[lo:hi] == score)).nonzero()[0]
+        if matches.size == 0:
+            return False
+
+        # Copy each level of the subtree to the front of its new level.
+        # A level's new position is always before (or at) the old one, and after all
+        # earlier levels' old positions, so no level is overwritten before it's copied.
+        ranges = list(self.subtree_ranges(lo + int(matches[0])))
+        arrays = (self.board, self.score, self.metric, self.parent,
+                  self.first_child, self.num_children, self.move)
+
+        level_start = [0]
+        for level, (old_lo, old_hi) in enumerate(ranges):
+
+            new_lo = level_start[-1]
+            new_hi = new_lo + old_hi - old_lo
+            for arr in arrays:
+                arr[new_lo:new_hi] = arr[old_lo:old_hi]
+
+            # Indices of parents and children move with their levels
+            if level > 0:
+                self.parent[new_lo:new_hi] -= ranges[level - 1][0] - level_start[-2]
+            if level + 1 < len(ranges):
+                self.first_child[new_lo:new_hi] -= ranges[level + 1][0] - new_hi
+
+            level_start.append(new_hi)
+
+        self.parent[0] = -1
+        self.move[0] = -1
+        self.level_start = level_start
+        self.size = level_start[-1]
+        self.num_reroots += 1
+
+        return True
+
+    def subtree_ranges(self, node):
+        """
+        Generator of the (start, stop) index range of node and its descendants on each level.
+        """
+
+        lo, hi = node, node + 1
+        while lo < hi:
+
+            yield lo, hi
+
+            # Nodes on the last level have no children
+            if lo >= self.level_start[-2]:
+                return
+
+            # Children of nodes [lo, hi) are contiguous on the next level
+            lo, hi = self.first_child[lo], self.first_child[hi - 1] + self.num_children[hi - 1]
+
+# ------------------------------
+
+
+class Expectimax:
+    """
+    Expectimax search of future moves, working on packed BitBoards.
+
+    Unlike MoveTree, which samples one random tile per move, every possible random tile is
+    searched: each empty tile with a 2 (p=0.9) and a 4 (p=0.1).  "Chance" nodes (after a move)
+    take the probability-weighted average of their children, and "max" nodes (after a random
+    tile) take the best of their 4 moves.
+
+    A random tile branch whose cumulative probability falls below ap.prob_cutoff is not
+    searched deeper, and is only evaluated, which keeps the cost bounded.
+
+    Chance node values are saved in ap.trans_table (if any) with the depth searched,
+    so boards reached by different move orders, or again on the next move, are searched once.
+    Only exact values are saved: not if any branch below was cut by prob_cutoff or max_nodes,
+    since another search (other cutoff, other path probability) may cut differently.
+
+    Boards are evaluated (calc_metric) after a move, before its random tile is added.
+    Evaluations are saved in ap.trans_table at depth 0, and only an exact depth 0 entry is used
+    as an evaluation (never a chance node value of the same board).
+    """
+
+    def __init__(self, ap):
+        """
+        :param ap: AutoPlayer object. Supplies calc_option, mult_base and prob_cutoff
+        """
+
+        self.ap = ap
+        self.num_evals = 0
+
+        # True if a branch below the current chance node was cut (value is approximate)
+        self.pruned = False
+
+    def search(self, board, depth):
+        """
+        :param board: int. packed BitBoard of current game state
+        :param depth: int >= 1. number of moves to search
+        :return: list of 4 floats. expected metric of each move. -2.0 if move is invalid
+        """
+
+        move_metrics = []
+        valid_mask, boards2, _ = BitBoard.move_all(board)
+        for direction in range(4):
+            if (valid_mask >> direction) & 1:
+                move_metrics.append(self.chance_node(boards2[direction], depth - 1, 1.0))
+            else:
+                move_metrics.append(-2.0)
+
+        return move_metrics
+
+    def evaluate(self, board):
+
+        trans_table = self.ap.trans_table
+        if trans_table is not None:
+            metric = trans_table.lookup(board, 0, exact=True)
+            if metric is not None:
+                return metric
+
+        eval_cache = self.ap.eval_cache
+        metric = None if (eval_cache is None) else eval_cache.lookup(board, self.ap.eval_params)
+        if metric is None:
+            self.num_evals += 1
+            metric = float(self.ap.board_metric_func(board))
+            if eval_cache is not None:
+                eval_cache.store(board, self.ap.eval_params, metric)
+
+        if trans_table is not None:
+            trans_table.store(board, 0, metric)
+
+        return metric
+
+    def chance_node(self, board, depth, prob):
+        """Expected metric of a board after a move, over all possible random tiles"""
+
+        if depth <= 0:
+            return self.evaluate(board)
+
+        # Too unlikely, or out of nodes.  Not searched to depth, so no chance node above is
+        # stored in trans_table
+        max_nodes = self.ap.max_nodes
+        if prob < self.ap.prob_cutoff or (max_nodes is not None and self.num_evals >= max_nodes):
+            self.pruned = True
+            return self.evaluate(board)
+
+        trans_table = self.ap.trans_table
+        if trans_table is not None:
+            metric = trans_table.lookup(board, depth)
+            if metric is not None:
+                return metric
+
+        open_positions = [4 * idx for idx in range(16) if ((board >> (4 * idx)) & 0xF) == 0]
+        num_empty = len(open_positions)
+
+        pruned = self.pruned
+        self.pruned = False
+
+        total = 0.0
+        for shift in open_positions:
+            for exp, tile_prob in TILE_PROBS:
+                total += tile_prob * self.max_node(board | (exp << shift), depth,
+                                                   prob * tile_prob / num_empty)
+
+        metric = total / num_empty
+        if trans_table is not None and not self.pruned:
+            trans_table.store(board, depth, metric)
+
+        self.pruned = self.pruned or pruned
+
+        return metric
+
+    def max_node(self, board, depth, prob):
+        """Metric of the best move of a board after a random tile. 0 if game over"""
+
+        if self.ap.deadline is not None and perf_counter() > self.ap.deadline:
+            raise SearchTimeout()
+
+        best = 0.0
+        valid_mask, boards2, _ = BitBoard.move_all(board)
+        for direction in range(4):
+            if (valid_mask >> direction) & 1:
+                best = max(best, self.chance_node(boards2[direction], depth - 1, prob))
+
+        return best
 
 
 if __name__ == '__main__':
@@ -291,7 +1323,7 @@ if __name__ == '__main__':
     #          [0, 8, 8, 16],
     #          [16, 32, 32, 2048]]
     #
-    # AutoPlayUtilsCy.calc_metrics1(array(tiles1))
+    # get_backend().calc_metrics[1](array(tiles1))
 
     # import GameMgr
 
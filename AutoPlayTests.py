@@ -1,9 +1,20 @@
 import GameMgr
 import AutoPlay
 import AutoPlayUtilsCy
+import BitBoard
+import SearchCache
+import HeuristicTables
+import MoveTables
+import NTuple
+import ResultsStore
+import Sweep
 import numpy as np
+import os
+import shutil
+import tempfile
 from time import perf_counter
 import cProfile
+from glob import glob
 
 # ------------------------------
 # Testing Functions
@@ -126,27 +137,898 @@ def test_calc_metrics3():
     print("PASSED") if num1 == 0 else print("FAILED")
 
 
+def test_Utils_play_game():
+
+    seeds = np.array([5, 6, 7], dtype=np.uint64)
+    games = [AutoPlayUtilsCy.play_game(int(seed), 2, 0.05, 3, 1.5) for seed in seeds]
+
+    assert AutoPlayUtilsCy.play_game(5, 2, 0.05, 3, 1.5) == games[0]
+
+    results = AutoPlayUtilsCy.play_games(seeds, 2, 0.05, 3, 1.5, 2)
+    assert results.tolist() == [list(game) for game in games]
+
+    assert_raises(ValueError, AutoPlayUtilsCy.play_game, 5, 2, 0.05, 4, 1.5)
+
+
+def test_BitBoard_move_tiles():
+
+    b1 = [[2, 2, 4, 8],
+          [0, 4, 4, 4],
+          [16, 0, 0, 16],
+          [2, 4, 8, 16]]
+    t1 = np.array(b1, dtype=np.int32)
+    board = BitBoard.from_tiles(t1)
+
+    assert (BitBoard.to_tiles(board) == t1).all()
+
+    game1 = GameMgr.Game(None)
+    for direction in range(4):
+        valid1, _, tiles2, score2 = game1.move_tiles(direction, False, t1, 0)
+        valid2, board2, score3 = BitBoard.move_tiles(direction, board, 0)
+
+        assert (valid1, score2) == (valid2, score3), f"direction {direction}"
+        assert (BitBoard.to_tiles(board2) == tiles2).all(), f"direction {direction}"
+
+
+def test_MoveTables():
+    """Tables match Game moves of single rows, and are rebuilt from a stale or broken cache"""
+
+    # Row 0 of an otherwise empty board, tiles up to 16384 (Game merges 32768s, tables can't)
+    rows = np.random.default_rng(2).integers(0, 15, size=(500, 4))
+    game1 = GameMgr.Game(None)
+    for exps in rows:
+        tiles = np.zeros((4, 4), dtype=np.int32)
+        tiles[0] = np.where(exps > 0, 2 ** exps, 0)
+        row = int((exps << (4 * np.arange(4))).sum())
+
+        for direction, table in ((1, MoveTables.ROW_RIGHT), (3, MoveTables.ROW_LEFT)):
+            valid, _, tiles2, score2 = game1.move_tiles(direction, False, tiles, 0)
+            assert (BitBoard.to_tiles(int(table[row]))[0] == tiles2[0]).all(), f"row {exps}"
+            assert MoveTables.ROW_SCORE[row] == score2
+            assert bool(MoveTables.ROW_CHANGED[row] & (1 if direction == 3 else 2)) == valid
+
+    # Two 32768s never merge
+    assert MoveTables.ROW_LEFT[0xFF] == 0xFF
+
+    tables = MoveTables.build_tables()
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "MoveTables.npz")
+
+        # Missing, then cached, then stale and broken caches are rebuilt and saved again
+        for broken in (None, None, "version", "file"):
+            if broken == "version":
+                np.savez(filename, version=MoveTables.TABLES_VERSION - 1, row_left=tables[0],
+                         row_right=tables[1], row_score=tables[2], row_changed=tables[3])
+            elif broken == "file":
+                with open(filename, "wb") as file1:
+                    file1.write(b"not a cache")
+
+            loaded = MoveTables.load_tables(filename)
+            assert all((table1 == table2).all() for table1, table2 in zip(loaded, tables))
+            assert MoveTables._load_cache(filename) is not None, broken
+
+        assert os.listdir(directory) == ["MoveTables.npz"]
+
+        # A valid cache is loaded, not written again
+        mtime = os.stat(filename).st_mtime_ns
+        MoveTables.load_tables(filename)
+        assert os.stat(filename).st_mtime_ns == mtime
+
+    assert all((table1 == table2).all() for table1, table2 in zip(
+        (MoveTables.ROW_LEFT, MoveTables.ROW_RIGHT, MoveTables.ROW_SCORE, MoveTables.ROW_CHANGED), tables))
+
+
+def test_move_all():
+    """All 4 moves in one call (BitBoard and every backend) match 4 BitBoard.move_tiles() calls"""
+
+    boards = random_boards(10, 300, 16)
+    boards[:2] = (0, BitBoard.from_tiles(np.array([[2, 4, 2, 4], [4, 2, 4, 2]] * 2)))
+
+    valid = np.zeros((len(boards), 4), dtype=bool)
+    boards2 = np.zeros((len(boards), 4), dtype=np.uint64)
+    gained = np.zeros((len(boards), 4), dtype=np.int64)
+    for idx, board in enumerate(boards.tolist()):
+        for direction in range(4):
+            valid[idx, direction], boards2[idx, direction], gained[idx, direction] = (
+                BitBoard.move_tiles(direction, board, 0))
+
+        valid_mask = sum(1 << direction for direction in range(4) if valid[idx, direction])
+        expected = (valid_mask, tuple(boards2[idx].tolist()), tuple(gained[idx].tolist()))
+        assert BitBoard.move_all(board) == expected, f"board {board:016x}"
+
+        for backend in available_backends():
+            if hasattr(backend.utils, "move_all_bitboard"):
+                assert backend.utils.move_all_bitboard(board) == expected, backend.name
+
+    assert not valid[:2].any()
+
+    for name, moves in [("BitBoard", BitBoard.move_all_boards(boards))] + [
+            (backend.name, backend.move_boards_all(boards)) for backend in available_backends()]:
+        assert np.array_equal(moves[0], valid), name
+        assert np.array_equal(moves[1], boards2), name
+        assert np.array_equal(moves[2], gained), name
+
+
+def test_Game_check_game_over():
+
+    b1 = [[2, 4, 2, 4],
+          [4, 2, 4, 2],
+          [2, 4, 2, 4],
+          [4, 2, 65536, 2]]
+    t1 = np.array(b1)
+    game1 = GameMgr.Game(None)
+
+    # Tiles too large for a packed BitBoard
+    assert game1.check_game_over(t1)
+    t1[2, 2] = 65536
+    assert not game1.check_game_over(t1)
+
+    # Two 32768s still merge
+    t1[2, 2], t1[3, 2] = 32768, 32768
+    valid, _, _, score = game1.move_tiles(0, False, t1, 0)
+    assert valid and score == 65536
+    assert not game1.check_game_over(t1)
+
+    # add_random_tile() filling the last empty tile checks the tile numbers too
+    t1[0, 0] = 0
+    game1 = GameMgr.Game(None, t1)
+    game1.add_random_tile(commit=True)
+    assert game1.num_empty == 0 and not game1.game_over
+
+
+def test_GameBatch():
+    """Every step of a batch of games matches Game moves of each game, plus one new tile"""
+
+    rand = np.random.default_rng(5)
+    batch = GameMgr.GameBatch(20, rand=np.random.default_rng(5))
+    batch.add_random_tiles()
+    assert (batch.num_empty == 15).all()
+
+    while not batch.game_over.all() and batch.num_moves.max() < 300:
+        games = [batch.get_game(idx) for idx in range(len(batch))]
+        directions = rand.integers(0, 4, size=len(batch))
+        valid = batch.valid_moves()
+
+        moved = batch.step(directions)
+
+        for idx, (game1, direction) in enumerate(zip(games, directions.tolist())):
+            if game1.game_over:
+                assert not moved[idx]
+                continue
+
+            for direction2 in range(4):
+                assert valid[idx, direction2] == game1.move_tiles(direction2, False)[0]
+
+            valid1, _, tiles2, score2 = game1.move_tiles(direction, False)
+            tiles3 = BitBoard.to_tiles(int(batch.boards[idx]))
+            assert moved[idx] == valid1
+            assert (batch.scores[idx], batch.num_moves[idx]) == (score2, game1.num_moves + valid1)
+
+            # One new 2 or 4 on an empty tile, after a valid move only
+            new_tiles = tiles3[tiles3 != tiles2]
+            if valid1:
+                assert len(new_tiles) == 1 and new_tiles[0] in (2, 4)
+                assert (tiles2[tiles3 != tiles2] == 0).all()
+            else:
+                assert len(new_tiles) == 0
+
+            assert batch.num_empty[idx] == (tiles3 == 0).sum()
+            assert batch.game_over[idx] == game1.check_game_over(tiles3)
+
+    assert batch.game_over.any()
+
+
+def expectimax_reference(tiles, depth, ap):
+    """Brute force Expectimax value of tiles after a move (before its random tile), on tile
+    arrays with GameMgr moves: average over every random tile, best of the 4 moves after it"""
+
+    if depth <= 0:
+        return float(ap.metric_func(tiles))
+
+    game1 = GameMgr.Game(None)
+    empty = np.argwhere(tiles == 0)
+    total = 0.0
+    for row, col in empty:
+        for tile, prob in ((2, 0.9), (4, 0.1)):
+            tiles2 = tiles.copy()
+            tiles2[row, col] = tile
+
+            best = 0.0
+            for direction in range(4):
+                valid, _, tiles3, _ = game1.move_tiles(direction, False, tiles2, 0)
+                if valid:
+                    best = max(best, expectimax_reference(tiles3, depth - 1, ap))
+            total += prob * best
+
+    return total / len(empty)
+
+
+def test_Expectimax_search():
+
+    b1 = [[0, 2, 0, 4],
+          [2, 8, 4, 16],
+          [4, 16, 32, 64],
+          [8, 32, 128, 256]]
+    t1 = np.array(b1, dtype=np.int32)
+    board = BitBoard.from_tiles(t1)
+
+    game1 = GameMgr.Game(None)
+    for depth in (1, 2):
+        ap1 = AutoPlay.AutoPlayer(game1, depth, 0.05, 3, search_mode="expectimax",
+                                  prob_cutoff=0.0, trans_table_bits=0)
+        move_metrics = AutoPlay.Expectimax(ap1).search(board, depth)
+
+        actual = []
+        for direction in range(4):
+            valid, _, tiles2, _ = game1.move_tiles(direction, False, t1, 0)
+            actual.append(expectimax_reference(tiles2, depth - 1, ap1) if valid else -2.0)
+
+        assert np.allclose(move_metrics, actual), f"depth {depth}: {move_metrics} != {actual}"
+
+
+def test_TranspositionTable():
+
+    table = SearchCache.TranspositionTable(4)
+    board1 = BitBoard.from_tiles(np.array([[2, 4, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 8]]))
+
+    # Two different boards hashing to the same slot
+    board2 = next(board for board in range(1, 1 << 16)
+                  if board != board1 and table.slot(board) == table.slot(board1))
+
+    table.store(board1, 3, 1.5)
+    assert (table.lookup(board1, 3), table.lookup(board1, 1), table.lookup(board1, 4)) == (1.5, 1.5, None)
+
+    # Same search: the deeper entry is kept, an entry as deep replaces it
+    table.store(board2, 1, 2.5)
+    assert table.lookup(board1, 3) == 1.5 and table.lookup(board2, 1) is None
+    table.store(board2, 3, 2.5)
+    assert table.lookup(board2, 3) == 2.5 and table.lookup(board1, 0) is None
+
+    # Next search: entries of the last one are replaced, even by shallower ones
+    table.new_search()
+    table.store(board1, 1, 0.5)
+    assert table.lookup(board1, 1) == 0.5 and table.lookup(board2, 0) is None
+    assert table.replacements == 2
+
+    # clear() empties every slot, with its depth and search
+    table.clear()
+    assert len(table) == 0 and table.lookup(board1, 0) is None
+    assert table.depths == [0] * table.size and table.generations == [0] * table.size
+
+    # Chance node values found in the table are the same as searched again
+    b1 = [[0, 2, 0, 4],
+          [2, 8, 4, 16],
+          [0, 16, 32, 64],
+          [8, 32, 128, 256]]
+    game1 = GameMgr.Game(None)
+    board = BitBoard.from_tiles(np.array(b1))
+    move_metrics = []
+    for trans_table_bits in (0, 10):
+        ap1 = AutoPlay.AutoPlayer(game1, 3, 0.05, 3, search_mode="expectimax", prob_cutoff=0.0,
+                                  trans_table_bits=trans_table_bits)
+        move_metrics.append(AutoPlay.Expectimax(ap1).search(board, 3))
+
+    assert ap1.trans_table.hits
+    assert np.allclose(*move_metrics)
+
+
+def test_Expectimax_trans_table():
+    """Searches to a fixed depth give the same values with or without a transposition table"""
+
+    for seed in (3, 5):
+        game1, _ = play_moves(seed, 40, 2, search_mode="expectimax")
+        board = game1.get_bitboard()
+
+        for prob_cutoff in (0.0001, 0.01):
+            move_metrics = []
+            for trans_table_bits in (0, 16):
+                ap1 = AutoPlay.AutoPlayer(game1, 3, 0.05, 3, search_mode="expectimax",
+                                          prob_cutoff=prob_cutoff, trans_table_bits=trans_table_bits)
+                move_metrics.append(AutoPlay.Expectimax(ap1).search(board, 3))
+
+            assert np.allclose(*move_metrics), f"seed {seed}, prob_cutoff {prob_cutoff}"
+
+        # Values of a search with cuts aren't reused by a search without them
+        ap1.prob_cutoff = 0.0
+        actual = AutoPlay.Expectimax(AutoPlay.AutoPlayer(
+            game1, 3, 0.05, 3, search_mode="expectimax", prob_cutoff=0.0, trans_table_bits=0)).search(board, 3)
+        assert np.allclose(AutoPlay.Expectimax(ap1).search(board, 3), actual), f"seed {seed}"
+
+    # A leaf is evaluated, even if the table holds a searched value of the same board
+    ap1.trans_table.store(board, 2, -5.0)
+    assert AutoPlay.Expectimax(ap1).evaluate(board) == ap1.board_metric_func(board)
+
+
+def test_EvalCache():
+
+    # Room for 3 entries
+    cache = SearchCache.EvalCache(3.5 * SearchCache.EVAL_ENTRY_BYTES / 2**20)
+    params = (3, 1.5)
+    for board in (1, 2, 3):
+        cache.store(board, params, float(board))
+
+    # Board 1 was used last, so board 2 is the least recently used
+    cache.lookup(1, params)
+    cache.store(4, params, 4.0)
+    assert [cache.lookup(board, params) for board in (1, 2, 3, 4)] == [1.0, None, 3.0, 4.0]
+    assert cache.evictions == 1
+
+    # Other parameters are other entries
+    assert cache.lookup(1, (3, 2.0)) is None and len(cache) == 3
+
+    # Cached metrics are the same as calculated
+    eval_cache = SearchCache.EvalCache()
+    assert_same_games(play_moves(9, 30)[0], play_moves(9, 30, eval_cache=eval_cache)[0])
+    assert eval_cache.hits
+
+
+def test_time_budget():
+
+    for search_mode, tree_depth in (("tree", 10), ("expectimax", 8)):
+        game1, ap1 = play_moves(0, 10, tree_depth, search_mode=search_mode, time_budget=0.05)
+
+        start = perf_counter()
+        move = ap1.get_move()
+        duration = perf_counter() - start
+
+        assert move in range(4)
+        assert 1 <= ap1.search_depth < tree_depth, f"{search_mode}: depth {ap1.search_depth}"
+        assert duration < 0.15, f"{search_mode}: {duration:.3f}s for a 0.05s budget"
+
+
+def assert_move_tree(tree, ap, depth):
+    """Every node of levels 0 - depth of a MoveTree is consistent: the children of a node are
+    its valid moves in direction order, each with one new 2 or 4 tile, its score and its metric"""
+
+    for node in range(tree.num_nodes(depth - 1)):
+        valid_mask, boards2, gained = BitBoard.move_all(int(tree.board[node]))
+        children = range(tree.first_child[node], tree.first_child[node] + tree.num_children[node])
+
+        assert [tree.move[child] for child in children] == [d for d in range(4) if (valid_mask >> d) & 1]
+
+        for child in children:
+            direction = tree.move[child]
+            added = int(tree.board[child]) ^ boards2[direction]
+            cells = [i for i in range(16) if (added >> (4 * i)) & 0xF]
+
+            assert tree.parent[child] == node
+            assert tree.score[child] == tree.score[node] + gained[direction]
+            assert len(cells) == 1 and (added >> (4 * cells[0])) in (1, 2)
+            assert not (boards2[direction] >> (4 * cells[0])) & 0xF
+
+    num = tree.num_nodes(depth)
+    assert np.allclose(tree.metric[:num], ap.boards_metric_func(tree.board[:num]))
+
+
+def test_MoveTree_build():
+
+    game1, ap1 = play_moves(0, 10, 4)
+
+    tree = AutoPlay.MoveTree(4)
+    tree.build(game1.tiles, game1.score, ap1, 4)
+
+    assert len(tree.level_start) == 6
+    assert_move_tree(tree, ap1, 4)
+
+
+def assert_top_metrics(tree, depth):
+    """top_metrics of a MoveTree are the largest metrics of levels 1 - depth below each first
+    move, from all the nodes (first move nodes counted twice)"""
+
+    num = tree.num_nodes(depth)
+    level1 = slice(tree.level_start[1], tree.level_start[2])
+    for direction in range(4):
+        metrics = tree.metric[1:num][tree.branch[1:num] == direction]
+        metrics = np.concatenate((metrics, tree.metric[level1][tree.move[level1] == direction]))
+        actual = np.sort(metrics)[::-1][:tree.topx_max]
+
+        assert np.array_equal(np.sort(tree.top_metrics[direction])[::-1], actual), f"branch {direction}"
+
+
+def test_MoveTree_top_metrics():
+
+    game1, ap1 = play_moves(2, 10, 4)
+
+    tree = AutoPlay.MoveTree(4)
+    for topx_max in (1, 5, None):
+        tree.build(game1.tiles, game1.score, ap1, 4, topx_max)
+        assert_top_metrics(tree, 4)
+
+
+def test_MoveTree_reroot():
+
+    game1, ap1 = play_moves(4, 10)
+
+    tree = AutoPlay.MoveTree(3)
+    tree.build(game1.tiles, game1.score, ap1, 3)
+
+    # Subtree of the last first move, level by level
+    node = tree.level_start[2] - 1
+    board, score = int(tree.board[node]), int(tree.score[node])
+    subtree = [(tree.board[lo:hi].copy(), tree.score[lo:hi].copy(), tree.metric[lo:hi].copy())
+               for lo, hi in tree.subtree_ranges(node)]
+
+    assert tree.reroot(board, score)
+    assert len(tree.level_start) - 1 == len(subtree)
+    for lo, hi, (boards, scores, metrics) in zip(tree.level_start, tree.level_start[1:], subtree):
+        assert np.array_equal(tree.board[lo:hi], boards)
+        assert np.array_equal(tree.score[lo:hi], scores)
+        assert np.array_equal(tree.metric[lo:hi], metrics)
+
+    tree.extend(ap1, 3)
+    assert len(tree.level_start) == 5
+    assert_move_tree(tree, ap1, 3)
+    assert_top_metrics(tree, 3)
+
+    # A state not on level 1 isn't found, and leaves the tree unchanged
+    size = tree.size
+    assert not tree.reroot(board ^ 1, score)
+    assert tree.size == size
+
+    # Only AutoPlayers that opt in reuse their tree
+    assert play_moves(4, 50)[1].move_tree.num_reroots == 0
+    assert play_moves(4, 50, reuse_tree=True)[1].move_tree.num_reroots > 0
+
+
+def test_depth_bands():
+    """choose_depth() is the depth of the board's band of empty tiles, +1 with many distinct
+    tiles, capped at tree_depth.  get_move() searches that depth"""
+
+    game1 = GameMgr.Game(None)
+    for tree_depth in (7, 4):
+        ap1 = AutoPlay.AutoPlayer(game1, tree_depth, 0.05, 3, np.random.default_rng(0),
+                                  depth_bands=AutoPlay.DEPTH_BANDS)
+
+        for num_empty in range(1, 16):
+            for num_distinct in {1, min(16 - num_empty, 12)}:
+                exps = np.zeros(16, dtype=np.int64)
+                exps[num_empty:] = np.arange(16 - num_empty) % num_distinct + 1
+                game1.tiles = np.where(exps > 0, 2 ** exps, 0).reshape(4, 4)
+
+                depth = next(depth for max_empty, depth in AutoPlay.DEPTH_BANDS if num_empty <= max_empty)
+                depth = min(depth + (num_distinct >= AutoPlay.DISTINCT_TILES_DANGER), tree_depth)
+                assert ap1.choose_depth() == depth, f"{num_empty} empty, {num_distinct} distinct"
+
+    game1, ap1 = play_moves(4, 10, 7, depth_bands=AutoPlay.DEPTH_BANDS)
+    depth = ap1.choose_depth()
+    ap1.get_move()
+    assert ap1.search_depth == depth
+
+
+def test_max_nodes():
+    """max_nodes limits a MoveTree to the full levels that fit, and cuts an Expectimax search"""
+
+    game1, ap1 = play_moves(1, 10, 6)
+    ap1.max_nodes = 500
+    tree = AutoPlay.MoveTree(6)
+    tree.build(game1.tiles, game1.score, ap1, 6)
+
+    depth = len(tree.level_start) - 2
+    last_level = tree.level_start[-1] - tree.level_start[-2]
+    assert 1 <= depth < 6
+    assert tree.size <= 500 < tree.size + 4 * last_level
+    assert_move_tree(tree, ap1, depth)
+
+    # Full search, then one cut at a tenth of its evaluations
+    game1, ap1 = play_moves(1, 10, 3, search_mode="expectimax", prob_cutoff=0.0, trans_table_bits=0)
+    board = game1.get_bitboard()
+    search = AutoPlay.Expectimax(ap1)
+    full = search.search(board, 3)
+    num_evals = search.num_evals
+
+    ap1.max_nodes = num_evals
+    assert AutoPlay.Expectimax(ap1).search(board, 3) == full
+
+    ap1.max_nodes = num_evals // 10
+    search = AutoPlay.Expectimax(ap1)
+    search.search(board, 3)
+    assert search.num_evals < num_evals // 2
+
+
+def test_HeuristicTables():
+
+    # Line exponents, first tile in the lowest nibble --> (empty, merges, monotonicity, smoothness)
+    lines = {(1, 1, 2, 0): (1, 1, 15, 1),       # increases 0+15, decreases 16
+             (3, 2, 1, 1): (0, 1, 0, 2),        # only decreases
+             (2, 2, 2, 2): (0, 2, 0, 0),
+             (0, 5, 0, 1): (2, 0, 625, 0)}      # increases 625+1, decreases 625, no neighbours
+    for exps, actual in lines.items():
+        line = sum(exp << (4 * i) for i, exp in enumerate(exps))
+        components = (HeuristicTables.EMPTY[line], HeuristicTables.MERGES[line],
+                      HeuristicTables.MONOTONICITY[line], HeuristicTables.SMOOTHNESS[line])
+
+        assert components == actual, f"line {exps}: {components} != {actual}"
+
+    # Board metric is the row tables of its rows plus the column table of its columns
+    lut = HeuristicTables.build_lut({"smoothness": -20.0}, 2.0)
+    b1 = [[2, 4, 8, 1024],
+          [0, 4, 16, 256],
+          [0, 2, 0, 32],
+          [0, 0, 0, 2]]
+    board = BitBoard.from_tiles(np.array(b1))
+    columns = BitBoard.transpose(board)
+    actual = sum(lut[r][(board >> (16 * r)) & 0xFFFF] + lut[4][(columns >> (16 * r)) & 0xFFFF]
+                 for r in range(4))
+
+    assert np.isclose(AutoPlay.get_backend().board_metric_func(4, 2.0, lut)(board), actual)
+    assert (lut.min(axis=1) == 1.0).all()
+
+    assert_raises(ValueError, HeuristicTables.build_lut, {"corner": 1.0})
+
+
+def test_NTupleNetwork():
+
+    with tempfile.TemporaryDirectory() as directory:
+        network = NTuple.NTupleNetwork.create(os.path.join(directory, "ntuple.npy"))
+        rand = np.random.default_rng(10)
+        for _ in range(3):
+            NTuple.td_train_game(network, rand)
+
+        afterstates, _, _, _ = NTuple.play_td_episode(network, np.random.default_rng(11))
+        boards = np.array(afterstates, dtype=np.uint64)
+        values = network.values(boards)
+
+        assert values.any()
+        assert np.allclose(values, [network.value(board) for board in afterstates])
+
+        # Weights and tuples survive save() and load()
+        filename = os.path.join(directory, "copy.npy")
+        network.save(filename)
+        loaded = NTuple.NTupleNetwork.load(filename)
+
+        assert loaded.tuples == network.tuples
+        assert np.array_equal(loaded.weights, network.weights)
+        assert np.array_equal(loaded.values(boards), values)
+
+        # calc_option 5 plays from the file, with metrics > 0
+        game1, ap1 = play_moves(10, 20, 2, calc_option=5, ntuple_file=filename)
+
+        assert game1.num_moves == 20
+        assert ap1.metric_func(game1.tiles) > 0
+
+        # Memory-mapped weight files must be closed before the directory is removed (Windows)
+        del network, loaded, ap1
+
+
+def test_td_update_episode():
+
+    values = np.array([1.0, 2.0, 3.0])
+    rewards = np.array([0.0, 4.0, 8.0])
+    assert np.allclose(NTuple.td_targets(values, rewards), [6.0, 11.0, 0.0])
+    assert np.allclose(NTuple.td_targets(values, rewards, 0.5), [9.75, 9.5, 0.0])
+
+    # Batch updates, with a repeated board, add up like one at a time
+    afterstates, _, _, _ = NTuple.play_td_episode(NTuple.NTupleNetwork(), np.random.default_rng(12))
+    boards = np.array(afterstates + afterstates[:5], dtype=np.uint64)
+    deltas = np.random.default_rng(12).random(len(boards)) - 0.5
+
+    network1 = NTuple.NTupleNetwork()
+    network1.update_boards(boards, deltas)
+    network2 = NTuple.NTupleNetwork()
+    for board, delta in zip(boards.tolist(), deltas.astype(np.float32).tolist()):
+        network2.update(board, delta)
+
+    assert np.allclose(network1.weights, network2.weights, atol=1e-5)
+
+    # Learning from a game moves its values towards their targets (before the update)
+    boards = np.array(afterstates, dtype=np.uint64)
+    rewards = np.random.default_rng(13).integers(0, 64, size=len(boards)) * 4
+    values = network1.values(boards)
+    targets = NTuple.td_targets(values, rewards.astype(float))
+    NTuple.td_update_episode(network1, boards, rewards, alpha=0.0001)
+
+    assert ((targets - network1.values(boards)) ** 2).mean() < ((targets - values) ** 2).mean()
+
+
+def test_Sweep_resume():
+
+    with tempfile.TemporaryDirectory() as directory:
+        config = dict(Sweep.CONFIG_DEFAULTS, name="test", grid={"tree_depth": [1, 2]}, reps=2,
+                      num_workers=2, buffer_rows=3, output=os.path.join(directory, "test_results"))
+
+        assert Sweep.run_sweep(config) == 4
+        assert Sweep.run_sweep(config) == 0
+
+        # Jobs of a lost shard are played again, with the same results
+        results = ResultsStore.load_results(config["output"])
+        shard = sorted(glob(os.path.join(config["output"], ResultsStore.SHARD_PATTERN)))[-1]
+        lost = len(np.load(os.path.join(shard, "score.npy")))
+        shutil.rmtree(shard)
+
+        assert Sweep.run_sweep(config) == lost
+        replayed = ResultsStore.load_results(config["output"])
+        assert (sorted(results[["job_id", "score"]].tolist()) ==
+                sorted(replayed[["job_id", "score"]].tolist()))
+
+        del results, replayed
+
+    assert_raises(ValueError, Sweep.check_config, dict(Sweep.CONFIG_DEFAULTS, grid={"calc_option": [3, 4]}))
+
+    # Another seed or player --> other job ids, so a store is not resumed with other games
+    job_ids = {job["job_id"] for job in Sweep.expand_jobs(config)}
+    for changes in ({"seed": 1}, {"compiled": False}):
+        assert not job_ids & {job["job_id"] for job in Sweep.expand_jobs(dict(config, **changes))}
+
+
+def test_ResultsStore():
+
+    with tempfile.TemporaryDirectory() as directory:
+        with ResultsStore.ResultsWriter(directory, buffer_rows=4, flush_seconds=None) as writer:
+            for game_num in range(10):
+                writer.append(job_id=f"job{game_num}", tree_depth=game_num % 3, game_num=game_num,
+                              score=1000 * game_num, duration=0.5 * game_num)
+            assert writer.num_shards == 2
+
+        # 4 + 4 rows when the buffer filled, and the last 2 when the writer closed
+        shards = ResultsStore.load_shards(directory)
+        assert [len(shard["score"]) for shard in shards] == [4, 4, 2]
+        assert set(shards[0]) == set(ResultsStore.RESULT_DTYPE.names)
+        assert list(ResultsStore.load_shards(directory, ["score"])[0]) == ["score"]
+
+        results = ResultsStore.load_results(directory)
+        columns = ResultsStore.load_columns(directory, ["score", "duration"])
+        assert results["score"].tolist() == [1000 * num for num in range(10)]
+        assert results["calc_option"].tolist() == [0] * 10
+        assert np.array_equal(columns["score"], results["score"])
+        assert np.array_equal(columns["duration"], 0.5 * np.arange(10))
+
+        assert ResultsStore.completed_jobs(directory) == {f"job{num}" for num in range(10)}
+
+        assert_raises(ValueError, ResultsStore.ResultsWriter(directory).append, moves=1)
+        assert_raises(ValueError, ResultsStore.ResultsWriter(directory).append, job_id="x" * 97)
+
+        del shards, results, columns
+
+
+def test_RandStream():
+
+    # Takes crossing refills return the Generator's numbers, in order
+    sizes = [3, 5, 2, 7, 1, 8, 4, 6, 6, 8, 2]
+    actual = np.random.default_rng(7).random(sum(sizes), dtype=np.single)
+
+    for chunk_size in (8, 16, 1024):
+        stream = AutoPlay.RandStream(np.random.default_rng(7), chunk_size)
+        rands = np.concatenate([stream.take(num).copy() for num in sizes])
+
+        assert stream.num_used == len(actual)
+        assert (rands == actual).all(), f"chunk_size {chunk_size}"
+
+    # Takes larger than a chunk too: same seed --> same numbers
+    sizes = [3, 30, 5, 2, 17, 8]
+    streams = [AutoPlay.RandStream(np.random.default_rng(7), 16) for _ in range(2)]
+    rands = [np.concatenate([stream.take(num).copy() for num in sizes]) for stream in streams]
+
+    assert (rands[0] == rands[1]).all()
+
+    # Same seed --> same game
+    assert_same_games(play_moves(1, 50, 2, rand_chunk=64)[0], play_moves(1, 50, 2, rand_chunk=4096)[0])
+
+
+def test_backends():
+    """Every available backend (see AutoPlay.get_backend()) gives the same metrics and games"""
+
+    backends = available_backends()
+    boards = random_boards(8, 200, 12)
+    lut = HeuristicTables.build_lut()
+
+    for calc_option in range(5):
+
+        # Python calc_metrics1/2 are the original variants (chain from any corner, longer
+        # chain multiplier), not the same metric.  Only compiled backends are compared
+        compared = [backend for backend in backends
+                    if calc_option not in (1, 2) or backend.name != "py"]
+
+        metrics = [backend.boards_metric_func(calc_option, 1.5, lut)(boards) for backend in compared]
+        for backend, other in zip(compared[1:], metrics[1:]):
+            assert np.allclose(metrics[0], other), f"calc_option {calc_option}: {backend.name}"
+
+    games = [play_moves(8, 50, backend=backend.name)[0] for backend in backends]
+    assert_same_games(*games)
+
+
+def test_Nb_utils():
+    """AutoPlayUtilsNb, called directly, matches BitBoard and Game moves, and the metrics of
+    AutoPlayUtilsCy it was ported from"""
+
+    try:
+        import AutoPlayUtilsNb
+    except ImportError:
+        print("AutoPlayUtilsNb: not available (needs Numba)")
+        return
+
+    boards = random_boards(11, 200, 14)
+    tiles = np.array([BitBoard.to_tiles(board) for board in boards.tolist()], dtype=np.int32)
+    rands = np.random.default_rng(11).random(2 * len(boards))
+    lut = HeuristicTables.build_lut()
+    game1 = GameMgr.Game(None)
+
+    for idx, board in enumerate(boards.tolist()):
+        tiles1 = tiles[idx]
+        assert AutoPlayUtilsNb.pack_tiles(tiles1) == board
+        assert AutoPlayUtilsNb.check_game_over_bitboard(board) == BitBoard.check_game_over(board)
+        assert AutoPlayUtilsNb.check_game_over(tiles1) == game1.check_game_over(tiles1)
+
+        for direction in range(4):
+            assert AutoPlayUtilsNb.move_bitboard(direction, board, 10) == BitBoard.move_tiles(direction, board, 10)
+
+            valid, tiles2, score2 = AutoPlayUtilsNb.move_tiles(direction, tiles1, 10)
+            valid1, _, tiles3, score3 = game1.move_tiles(direction, False, tiles1, 10)
+            assert (valid, score2) == (valid1, score3) and (tiles2 == tiles3).all()
+
+        tiles2, num_empty, rand_idx = AutoPlayUtilsNb.add_random_tile(tiles1.copy(), rands, 2 * idx)
+        board2, num_empty2, rand_idx2 = BitBoard.add_random_tile(board, rands, 2 * idx)
+        assert (num_empty, rand_idx) == (num_empty2, rand_idx2)
+        assert (tiles2 == BitBoard.to_tiles(board2)).all()
+
+        metrics = [AutoPlayUtilsNb.calc_metrics0(tiles1)] + [
+            getattr(AutoPlayUtilsNb, f"calc_metrics{option}")(tiles1, 1.5) for option in (1, 2, 3)] + [
+            AutoPlayUtilsNb.calc_metrics4(tiles1, lut), AutoPlayUtilsNb.lut_metric_bitboard(board, lut)] + [
+            AutoPlayUtilsNb.calc_metric_bitboard(board, option, 1.5) for option in range(4)]
+        actual = [AutoPlayUtilsCy.calc_metrics0(tiles1)] + [
+            getattr(AutoPlayUtilsCy, f"calc_metrics{option}")(tiles1, 1.5) for option in (1, 2, 3)] + [
+            AutoPlayUtilsCy.calc_metrics4(tiles1, lut), AutoPlayUtilsCy.lut_metric_bitboard(board, lut)] + [
+            AutoPlayUtilsCy.calc_metric_bitboard(board, option, 1.5) for option in range(4)]
+        assert np.allclose(metrics, actual), f"board {board:016x}"
+
+    # Parallel functions, on 1 and 2 threads
+    for num_threads in (1, 2):
+        assert np.allclose(AutoPlayUtilsNb.calc_metrics_boards(boards, 3, 1.5, num_threads),
+                           AutoPlayUtilsCy.calc_metrics_boards(boards, 3, 1.5))
+        assert np.allclose(AutoPlayUtilsNb.calc_metrics_tiles(tiles, 2, 1.5, num_threads),
+                           AutoPlayUtilsCy.calc_metrics_tiles(tiles, 2, 1.5))
+        assert np.allclose(AutoPlayUtilsNb.lut_metrics_boards(boards, lut, num_threads),
+                           AutoPlayUtilsCy.lut_metrics_boards(boards, lut))
+
+    metrics = rands[:50]
+    top = AutoPlayUtilsNb.merge_top_metrics(metrics[:20], metrics[20:], 10)
+    assert np.array_equal(np.sort(top), np.sort(metrics)[-10:])
+
+
+def test_move_tiles_into():
+    """move_tiles_into() and add_random_tile_into() of every backend match BitBoard moves and
+    spawns, into another array or in place"""
+
+    boards = random_boards(9, 300, 14).tolist()
+    rand = np.random.default_rng(9)
+
+    for backend in available_backends():
+        for board in boards:
+            tiles = BitBoard.to_tiles(board)
+
+            for direction in range(4):
+                valid, board2, score2 = BitBoard.move_tiles(direction, board, 0)
+
+                out = np.zeros((4, 4), dtype=np.int32)
+                assert backend.move_tiles_into(direction, tiles, out) == (valid, score2), backend.name
+                assert (out == BitBoard.to_tiles(board2)).all(), backend.name
+                assert (tiles == BitBoard.to_tiles(board)).all(), backend.name
+
+                out = tiles.copy()
+                assert backend.move_tiles_into(direction, out, out) == (valid, score2), backend.name
+                assert (out == BitBoard.to_tiles(board2)).all(), backend.name
+
+            rands = rand.random(2)
+            board2, num_empty, _ = BitBoard.add_random_tile(board, rands, 0)
+            out = tiles.copy()
+            num_empty2 = backend.add_random_tile_into(out, rands[0], rands[1])
+            assert num_empty2 == (num_empty if (tiles == 0).any() else -1), backend.name
+            assert (out == BitBoard.to_tiles(board2)).all(), backend.name
+
+        full = np.full((4, 4), 2, dtype=np.int32)
+        assert backend.add_random_tile_into(full, 0.5, 0.5) == -1
+        assert (full == 2).all()
+
+
+def test_workers_search():
+    """Worker processes (num_workers) give the same Expectimax values as the serial search,
+    and the same tree search games for the same seed"""
+
+    game1, ap1 = play_moves(3, 10, search_mode="expectimax", trans_table_bits=0)
+
+    serial = AutoPlay.Expectimax(ap1).search(game1.get_bitboard(), 3)
+    ap1.num_workers = 2
+    assert np.allclose(ap1.search_expectimax_parallel(3), serial)
+
+    try:
+        assert_same_games(play_moves(3, 20, num_workers=2)[0], play_moves(3, 20, num_workers=2)[0])
+    finally:
+        AutoPlay.shutdown_worker_pools()
+
+
+def test_workers_after_threads():
+    """Worker processes (num_workers) of the Cython backend, after a multi-threaded metric call
+    in this process.  Forked workers used to hang here (OpenMP isn't fork-safe)"""
+
+    boards = np.arange(1, 4097, dtype=np.uint64) * np.uint64(0x1111)
+    AutoPlayUtilsCy.calc_metrics_boards(boards, 3, 1.5, 4)
+
+    try:
+        game1, _ = play_moves(0, 20, num_workers=2, backend="cy", num_threads=4)
+    finally:
+        AutoPlay.shutdown_worker_pools()
+
+    assert game1.num_moves == 20
+
+
 def print_tree_bfs(tree):
 
     print("Tree:", end="")
-    q1 = [tree]
-    q2 = []
-    level = 0
-    while q1:
-        level += 1
-        for node in q1:
-            print("|", end="") if node else print("-", end="")
-
-            if node and node.next:
-                for next1 in node.next:
-                    q2.append(next1)
-        print(f"\nLevel {level}: {len([q2 for i in q2 if i is not None])}/{len(q2)} : ", end="")
-        q1 = q2
-        q2 = []
+    for level in range(len(tree.level_start) - 1):
+        lo, hi = tree.level_start[level], tree.level_start[level + 1]
+        max_nodes = 4 ** level
+        print(f"\nLevel {level}: {hi - lo}/{max_nodes} : ", end="")
+        print("|" * (hi - lo), end="")
 
     print("\n")
 
 
+def seeded_game(seed):
+    """:return: new GameMgr.Game with its first random tile, from a seeded Generator"""
+
+    game1 = GameMgr.Game(None)
+    game1.rand = np.random.default_rng(seed)
+    game1.add_random_tile(commit=True)
+
+    return game1
+
+
+def play_moves(seed, num_moves, tree_depth=3, calc_option=3, **kwargs):
+    """
+    :param seed: int. seed of both the game's and the AutoPlayer's random Generators
+    :param kwargs: other AutoPlayer parameters
+    :return: (GameMgr.Game, AutoPlay.AutoPlayer). a seeded game, after num_moves auto_move()s
+    """
+
+    game1 = seeded_game(seed)
+    ap1 = AutoPlay.AutoPlayer(game1, tree_depth, 0.05, calc_option, np.random.default_rng(seed),
+                              **kwargs)
+    for _ in range(num_moves):
+        ap1.auto_move()
+
+    return game1, ap1
+
+
+def assert_same_games(*games):
+    """Games have the same score, moves and tiles"""
+
+    for game1 in games[1:]:
+        assert (game1.score, game1.num_moves) == (games[0].score, games[0].num_moves)
+        assert (game1.tiles == games[0].tiles).all()
+
+
+def available_backends():
+    """:return: list of AutoPlay.Backend.  Every backend that can be imported here"""
+
+    backends = []
+    for name in ("py", "nb", "cy"):
+        try:
+            backends.append(AutoPlay.get_backend(name))
+        except ImportError:
+            print(f"Backend {name}: not available")
+
+    return backends
+
+
+def random_boards(seed, num, max_exp):
+    """:return: NumPy uint64 1D-array of num random packed boards, tile exponents 0 - max_exp-1"""
+
+    rand = np.random.default_rng(seed)
+
+    return rand.integers(0, max_exp, size=(num, 16)).astype(np.uint64) @ (
+        np.uint64(16) ** np.arange(16, dtype=np.uint64))
+
+
+def assert_raises(exception, func, *args, **kwargs):
+    """func(*args, **kwargs) raises exception"""
+
+    try:
+        func(*args, **kwargs)
+    except exception:
+        return
+
+    raise AssertionError(f"{func.__name__}() did not raise {exception.__name__}")
+
+
 def run_num_moves(start_tiles, num_moves, tree_depth, topx, calc_option):
 
     game1 = GameMgr.Game(None)
@@ -177,6 +1059,26 @@ def play_games(num, tree_depth, topx, calc_option, calc_mult):
     return ap1
 
 
+def play_games_batch(num, rand=None):
+    """Play num games at once with GameMgr.GameBatch, using a simple greedy strategy:
+    take the valid move leaving the most empty tiles.  Returns the finished GameBatch"""
+
+    batch = GameMgr.GameBatch(num, rand=rand)
+    batch.add_random_tiles()
+
+    while not batch.game_over.all():
+
+        # Score each direction by empty tiles after the move. Invalid moves score -1
+        move_metrics = np.full((num, 4), -1, dtype=np.int64)
+        for direction in range(4):
+            valid, boards2, _ = BitBoard.move_boards(direction, batch.boards)
+            move_metrics[valid, direction] = BitBoard.count_empty_boards(boards2[valid])
+
+        batch.step(move_metrics.argmax(axis=1))
+
+    return batch
+
+
 if __name__ == '__main__':
 
     # Test calc_metrics0()
@@ -190,3 +1092,29 @@ if __name__ == '__main__':
     print(ap)
 
     # test_calc_metrics3()
+    # test_Utils_play_game()
+    # test_MoveTables()
+    # test_move_all()
+    # test_Game_check_game_over()
+    # test_GameBatch()
+    # test_Expectimax_search()
+    # test_TranspositionTable()
+    # test_Expectimax_trans_table()
+    # test_EvalCache()
+    # test_time_budget()
+    # test_MoveTree_build()
+    # test_MoveTree_top_metrics()
+    # test_MoveTree_reroot()
+    # test_depth_bands()
+    # test_max_nodes()
+    # test_RandStream()
+    # test_HeuristicTables()
+    # test_NTupleNetwork()
+    # test_td_update_episode()
+    # test_Sweep_resume()
+    # test_ResultsStore()
+    # test_backends()
+    # test_Nb_utils()
+    # test_move_tiles_into()
+    # test_workers_search()
+    # test_workers_after_threads()
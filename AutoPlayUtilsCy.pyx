@@ -1,150 +1,290 @@
 # cython: language_level=3
 
-from numpy import intc, copy
+from libc.stdint cimport uint8_t, uint16_t, uint32_t, uint64_t, int64_t
+from libc.stdlib cimport malloc, free, qsort
+cimport cython
+from cython.parallel cimport prange, threadid
+from os import cpu_count
+from numpy import (intc, empty, zeros, partition, concatenate, ascontiguousarray,
+                   float64, uint8, uint32, uint64, int64, bool_)
+
+import MoveTables
 
 DTYPE = intc # Data type of NumPy arrays (tiles[][])
 cdef enum:
     SIZE = 4        # Length of single board dimension (4 for 4x4, 5 for 5x5, etc)
     NUM_TILES = 16     # 2*SIZE
+    NUM_ROWS = 65536   # Number of possible packed 16-bit rows in MoveTables
+
+
+# Return the (up to) topx_num largest metrics of both top_metrics and new_metrics.
+# Used to keep a running "top X" while AutoPlay.MoveTree is built, one level at a time.
+def merge_top_metrics(top_metrics, new_metrics, Py_ssize_t topx_num):
+
+    metrics = concatenate((top_metrics, new_metrics))
+
+    if metrics.size > topx_num:
+        metrics = partition(metrics, -topx_num)[-topx_num:]
+
+    return metrics
+
+
+# --- Packed (BitBoard) board support
+# C copies of the shared MoveTables, so lookups need no Python objects (or the GIL)
+
+cdef uint16_t row_left_table[NUM_ROWS]
+cdef uint16_t row_right_table[NUM_ROWS]
+cdef uint32_t row_score_table[NUM_ROWS]
+cdef uint8_t row_changed_table[NUM_ROWS]
+
+cdef void load_row_tables():
+
+    cdef const uint16_t [:] left = MoveTables.ROW_LEFT
+    cdef const uint16_t [:] right = MoveTables.ROW_RIGHT
+    cdef const uint32_t [:] row_score = MoveTables.ROW_SCORE
+    cdef const uint8_t [:] changed = MoveTables.ROW_CHANGED
+    cdef int i
+
+    for i in range(NUM_ROWS):
+        row_left_table[i] = left[i]
+        row_right_table[i] = right[i]
+        row_score_table[i] = row_score[i]
+        row_changed_table[i] = changed[i]
+
+load_row_tables()
+
+
+# Swap rows and columns of a packed board (see BitBoard.transpose)
+cdef inline uint64_t transpose_board(uint64_t x) nogil:
+
+    cdef uint64_t a1 = x & 0xF0F00F0FF0F00F0FULL
+    cdef uint64_t a2 = x & 0x0000F0F00000F0F0ULL
+    cdef uint64_t a3 = x & 0x0F0F00000F0F0000ULL
+    cdef uint64_t a = a1 | (a2 << 12) | (a3 >> 12)
+    cdef uint64_t b1 = a & 0xFF00FF0000FF00FFULL
+    cdef uint64_t b2 = a & 0x00FF00FF00000000ULL
+    cdef uint64_t b3 = a & 0x00000000FF00FF00ULL
+
+    return b1 | (b2 >> 24) | (b3 << 24)
+
+
+# Apply a row table to all 4 rows of a packed board.  Adds score gained to score[0]
+cdef inline uint64_t move_rows(uint64_t board, const uint16_t *table, uint32_t *score) nogil:
+
+    cdef uint64_t board2 = 0
+    cdef uint16_t row
+    cdef int i
+
+    for i in range(SIZE):
+        row = <uint16_t>((board >> (16 * i)) & 0xFFFF)
+        board2 |= (<uint64_t>table[row]) << (16 * i)
+        score[0] += row_score_table[row]
+
+    return board2
+
+
+# Move a packed board (0: Up, 1: Right, 2: Down, 3: Left). Adds score gained to score[0]
+cdef uint64_t move_board(int direction, uint64_t board, uint32_t *score) nogil:
+
+    if direction == 0:
+        return transpose_board(move_rows(transpose_board(board), row_left_table, score))
+    elif direction == 1:
+        return move_rows(board, row_right_table, score)
+    elif direction == 2:
+        return transpose_board(move_rows(transpose_board(board), row_right_table, score))
+    else:
+        return move_rows(board, row_left_table, score)
+
+
+# All 4 moves of a packed board in one pass.  Rows and columns are extracted once, and the
+# score of each row is shared by both directions.  boards2 and gained are indexed by direction.
+# Returns the validity bitmask: bit d set if move d is valid
+cdef int move_all_c(uint64_t board, uint64_t boards2[4], uint32_t gained[4]) nogil:
+
+    cdef uint64_t board_t = transpose_board(board)
+    cdef uint64_t up = 0, right = 0, down = 0, left = 0
+    cdef uint32_t row_score = 0, col_score = 0
+    cdef uint16_t row, col
+    cdef int i, valid_mask = 0
+
+    for i in range(SIZE):
+        row = <uint16_t>((board >> (16 * i)) & 0xFFFF)
+        col = <uint16_t>((board_t >> (16 * i)) & 0xFFFF)
+
+        left |= (<uint64_t>row_left_table[row]) << (16 * i)
+        right |= (<uint64_t>row_right_table[row]) << (16 * i)
+        up |= (<uint64_t>row_left_table[col]) << (16 * i)
+        down |= (<uint64_t>row_right_table[col]) << (16 * i)
+
+        row_score += row_score_table[row]
+        col_score += row_score_table[col]
+
+    boards2[0] = transpose_board(up)
+    boards2[1] = right
+    boards2[2] = transpose_board(down)
+    boards2[3] = left
+    gained[0] = col_score
+    gained[1] = row_score
+    gained[2] = col_score
+    gained[3] = row_score
+
+    for i in range(4):
+        if boards2[i] != board:
+            valid_mask |= 1 << i
+
+    return valid_mask
+
+
+def move_all_bitboard(uint64_t board):
+    """All 4 moves of a packed board in one call.  See BitBoard.move_all()
+    :return: (valid_mask: int, boards2: tuple of 4 int, gained: tuple of 4 int)"""
+
+    cdef uint64_t boards2[4]
+    cdef uint32_t gained[4]
+    cdef int valid_mask = move_all_c(board, boards2, gained)
+
+    return (valid_mask, (boards2[0], boards2[1], boards2[2], boards2[3]),
+            (gained[0], gained[1], gained[2], gained[3]))
+
+
+def move_bitboard(short direction, uint64_t board, int score):
+    """Packed-board counterpart of move_tiles().  See BitBoard.move_tiles()
+    :return: (valid_move: bool, board2: int, score2: int)"""
+
+    if direction < 0 or direction > 3:
+        raise ValueError("'direction' value invalid.  Must be 0-3.")
+
+    cdef uint32_t gained = 0
+    cdef uint64_t board2 = move_board(direction, board, &gained)
+
+    return board2 != board, board2, score + <int>gained
+
 
 def move_tiles(short direction, tiles, int score):
+    """Moves tiles in 'direction' per 2048 game rules.  Thin wrapper of move_tiles_into(),
+    for callers that need a new array.
+    :return: (valid_move: bool, tiles2: new NumPy intc 2D-array, score2: int)"""
 
-    assert tiles.shape[0] == tiles.shape[1]
     assert tiles.dtype == DTYPE
 
-    cdef int size = tiles.shape[0]
+    tiles1 = tiles.copy()
+    valid_move, delta = move_tiles_into(direction, tiles1, tiles1)
 
-    tiles1 = copy(tiles)
-    cdef int [:, :] tiles1_view = tiles1
-
-    # --- Begin primary move_tiles loop
-
-    cdef short idx1, place_idx, eval_idx, inc, row1, row2, col1, col2
-    cdef int tile_sum
-    cdef bint valid_move = False
-
-    # For each row (if left/right) or col (if up/down)
-    for idx1 in range(size):
-
-        if direction == 0:      # Move up
-            col1 = idx1
-            col2 = idx1
-            place_idx = 0
-            eval_idx = 1
-            inc = 1
-        elif direction == 1:    # Move Right
-            row1 = idx1
-            row2 = idx1
-            place_idx = size - 1
-            eval_idx = size - 2
-            inc = -1
-        elif direction == 2:    # Move Down
-            col1 = idx1
-            col2 = idx1
-            place_idx = size - 1
-            eval_idx = size - 2
-            inc = -1
-        elif direction == 3:    # Move Left
-            row1 = idx1
-            row2 = idx1
-            place_idx = 0
-            eval_idx = 1
-            inc = 1
-
-        # Traverse: (across cols in row if left/right) (across rows in col if up/down)
-        while (eval_idx > -1) and (eval_idx < size):
-
-            if direction == 0 or direction == 2:  # If move is up/down, traverse rows in column
-                row1 = place_idx
-                row2 = eval_idx
-            else:                   # If move is left/right, traverse cols in row
-                col1 = place_idx
-                col2 = eval_idx
-
-            if place_idx == eval_idx:
-                eval_idx += inc
-                continue
-
-            # If the "place" cell is empty
-            elif tiles1_view[row1, col1] == 0:
-
-                # And the next tile is also empty
-                if tiles1_view[row2, col2] == 0:
-                    eval_idx += inc
-                    continue
-
-                # Found a tile, move to empty
-                else:
-                    tiles1_view[row1, col1] = tiles1_view[row2, col2]
-                    tiles1_view[row2, col2] = 0
-                    valid_move = True
-                    eval_idx += inc
-                    continue
-
-            # If the "place" cell is NOT empty
-            else:
-
-                # And the "eval" tile is empty, move "eval" to next tile
-                if tiles1_view[row2, col2] == 0:
-                    eval_idx += inc
-                    continue
-
-                # "Place" and "eval" tiles1 equal.  Merge.
-                elif tiles1_view[row1, col1] == tiles1_view[row2, col2]:
-                    tile_sum = tiles1_view[row1, col1] + tiles1_view[row2, col2]
-                    tiles1_view[row1, col1] = tile_sum
-                    tiles1_view[row2, col2] = 0
-                    valid_move = True
-                    place_idx += inc
-                    eval_idx += inc
-                    score += tile_sum
-                    continue
-
-                # Tiles are different. Move "place" forward
-                else:
-                    place_idx += inc
-                    continue
-
-    return valid_move, tiles1, score
-
-
-def add_random_tile( tiles, float [:] rands, int rand_idx1):
+    return valid_move, tiles1, score + delta
 
-    assert tiles.shape[0] == tiles.shape[1]
+
+def move_tiles_into(short direction, const int [:, ::1] tiles, int [:, ::1] out):
+    """
+    Allocation free move_tiles().  Writes the tiles after the move into out.
+
+    :param direction: int 0-3. (0: Up, 1: Right, 2: Down, 3: Left)
+    :param tiles: C-contiguous NumPy intc 2D-array [4][4]. Not changed, unless it is also out
+    :param out: C-contiguous NumPy intc 2D-array [4][4]. May be tiles itself (move in place)
+    :return: (valid_move: bool, score gained: int)
+    """
+
+    if direction < 0 or direction > 3:
+        raise ValueError("'direction' value invalid.  Must be 0-3.")
+    assert tiles.shape[0] == SIZE and tiles.shape[1] == SIZE
+    assert out.shape[0] == SIZE and out.shape[1] == SIZE
+
+    cdef int delta = 0
+    cdef bint valid_move = move_tiles_c(direction, &tiles[0, 0], &out[0, 0], &delta)
+
+    return valid_move, delta
+
+
+def pack_tiles(tiles):
+    """Fast counterpart of BitBoard.from_tiles().  Does NOT check tiles are powers of 2.
+    :return: int. packed 64-bit board"""
+
+    assert tiles.shape[0] == SIZE and tiles.shape[1] == SIZE
     assert tiles.dtype == DTYPE
 
-    cdef int size = tiles.shape[0]
+    cdef const int [:, :] tiles_view = tiles
+    cdef uint64_t board = 0, exp
+    cdef int row, col, val
 
-    cdef short row, col
-    cdef short open_positions[16][2]
-    cdef int value, empty, rand_idx2
+    for row in range(SIZE):
+        for col in range(SIZE):
+            val = tiles_view[row, col]
+            exp = 0
+            while val > 1:
+                val >>= 1
+                exp += 1
+            board |= exp << (4 * (row * SIZE + col))
 
-    cdef int [:, :] tiles_view = tiles
+    return board
 
-    empty = 0
-    for row in range(size):
-        for col in range(size):
-            if tiles_view[row, col] == 0:
-                open_positions[empty][0] = row
-                open_positions[empty][1] = col
-                empty += 1
 
-    if empty == 0:
-        return tiles, empty, rand_idx1
+def add_random_tile(tiles, float [:] rands, int rand_idx1):
+    """Adds new tile (2 or 4) to a random empty spot of tiles, in place, using
+    rands[rand_idx1] and rands[rand_idx1 + 1].  Thin wrapper of add_random_tile_into()
+    :return: (tiles, num_empty: int, rand_idx: int) rand_idx is the next unused index"""
+
+    assert tiles.dtype == DTYPE
+
+    cdef int num_empty = add_random_tile_into(tiles, rands[rand_idx1], rands[rand_idx1 + 1])
+
+    # Full board. No tile added, and no random numbers used
+    if num_empty < 0:
+        return tiles, 0, rand_idx1
+
+    return tiles, num_empty, rand_idx1 + 2
+
+
+def add_random_tile_into(int [:, ::1] tiles, double rand_pos, double rand_val):
+    """
+    Allocation free add_random_tile().  Adds new tile (2 or 4) to tiles in place.
+    rand_pos picks among the empty spots in row-major order, rand_val < 0.9 gives a 2, else a 4.
+
+    :param tiles: C-contiguous NumPy intc 2D-array [4][4]
+    :param rand_pos: float [0.0, 1.0)
+    :param rand_val: float [0.0, 1.0)
+    :return: int. number of empty tiles after, or -1 if tiles was full (no tile added)
+    """
+
+    assert tiles.shape[0] == SIZE and tiles.shape[1] == SIZE
+
+    return add_random_tile_c(&tiles[0, 0], rand_pos, rand_val)
 
-    rand_idx2 = int(rands[rand_idx1] * empty)
-    rand_idx1 += 1
 
-    row = open_positions[rand_idx2][0]
-    col = open_positions[rand_idx2][1]
+def check_game_over(const int [:, ::1] tiles):
+    """
+    Checks tiles to see if any valid moves are left, without making any moves.
+    A move is valid if there is an empty tile, or two equal neighbours (row or column).
 
-    value = 2 if (rands[rand_idx1] < 0.9) else 4
-    rand_idx1 += 1
+    :param tiles: C-contiguous NumPy intc 2D-array [4][4]
+    :return: bool. True if game is over, False otherwise
+    """
 
-    tiles_view[row, col] = value
-    empty -= 1
+    assert tiles.shape[0] == SIZE and tiles.shape[1] == SIZE
 
-    return tiles, empty, rand_idx1
+    return tiles_game_over_c(&tiles[0, 0])
+
+
+def check_game_over_bitboard(uint64_t board):
+    """check_game_over() of a packed 64-bit BitBoard, with row table lookups
+    :return: bool. True if game is over, False otherwise"""
+
+    return board_game_over(board)
+
+
+cdef bint tiles_game_over_c(const int *tiles) nogil:
+
+    cdef int row, col, tile
+
+    for row in range(SIZE):
+        for col in range(SIZE):
+            tile = tiles[row * SIZE + col]
+            if tile == 0:
+                return False
+            if col < SIZE - 1 and tile == tiles[row * SIZE + col + 1]:
+                return False
+            if row < SIZE - 1 and tile == tiles[(row + 1) * SIZE + col]:
+                return False
+
+    return True
 
 
 # Strategy 0:
@@ -168,444 +308,795 @@ def calc_metrics0(tiles):
     return num_empty
 
 
+# Strategies 1-3 are computed by the nogil C kernels metric1_c/2_c/3_c() (see below), which
+# the compiled search uses too.  calc_metricsX() only pass them a C-contiguous view of tiles.
+
 # Strategy 1:
 # Simple metric...Rewards Upper-Right aligned chain.
 def calc_metrics1(tiles, double mult_base):
 
-    cdef int size = tiles.shape[0]
+    cdef const int [:, ::1] tiles_view = ascontiguousarray(tiles, dtype=DTYPE)
+    assert tiles_view.shape[0] == SIZE and tiles_view.shape[1] == SIZE
 
-    assert tiles.shape[0] == tiles.shape[1]
-    # assert tiles.dtype == DTYPE
+    return metric1_c(&tiles_view[0, 0], mult_base)
 
-    cdef const int [:, :] tiles_view = tiles
 
-    # Check to see if max tile is in upper-right
-    cdef int max_val = 0, val, row, col
-    cdef short maxs_len = 0
+# Strategy 2:
+# More advanced metric. Rewards any "chain" anchored in a corner,
+# with additional "reward" for empty tiles
+def calc_metrics2(tiles, double mult_base):
 
-    cdef int maxs[NUM_TILES][3]
-    cdef int [:, :] maxs_view = maxs
-    maxs_view[:, :] = 0
+    cdef const int [:, ::1] tiles_view = ascontiguousarray(tiles, dtype=DTYPE)
+    assert tiles_view.shape[0] == SIZE and tiles_view.shape[1] == SIZE
 
-    for row in range(size):
-        for col in range(size):
+    return metric2_c(&tiles_view[0, 0], mult_base)
 
-            val = tiles_view[row, col]
 
-            if val < max_val:
-                continue
-            # Value is greater
-            elif val > max_val:
-                max_val = val
-                maxs_len = 1
-                maxs[0][0] = val
-                maxs[0][1] = row
-                maxs[0][2] = col
-            else:   # Equal
-                maxs[maxs_len][0] = val
-                maxs[maxs_len][1] = row
-                maxs[maxs_len][2] = col
-                maxs_len += 1
+# Strategy 3:
+# More advanced metric. Rewards any "chain" anchored in a corner,
+# with additional "reward" for empty tiles
+def calc_metrics3(tiles, double mult_base):
 
-    cdef bint in_corner0 = False
-    cdef int i = 0
+    cdef const int [:, ::1] tiles_view = ascontiguousarray(tiles, dtype=DTYPE)
+    assert tiles_view.shape[0] == SIZE and tiles_view.shape[1] == SIZE
 
-    for i in range(maxs_len):
+    return metric3_c(&tiles_view[0, 0], mult_base)
+
+
+# Strategy 4:
+# Lookup table heuristic.  Sum of precomputed per-row and per-column tables, see HeuristicTables
+# lut is a C-contiguous float64 2D-array [5][65536]: a table for each row, then one for columns
 
-        if (maxs[i][1] == 0) and (maxs[i][2] == (size-1)):
-            in_corner0 = True
+cdef inline double lut_metric_c(uint64_t board, const double *lut) nogil:
 
-    # --- If max tile is NOT in upper-right, metric is zero.
+    cdef uint64_t board_t = transpose_board(board)
     cdef double metric = 0
+    cdef int i
+
+    for i in range(SIZE):
+        metric += lut[i * NUM_ROWS + ((board >> (16 * i)) & 0xFFFF)]
+        metric += lut[SIZE * NUM_ROWS + ((board_t >> (16 * i)) & 0xFFFF)]
+
+    return metric
+
+
+def calc_metrics4(tiles, const double [:, ::1] lut):
+
+    assert lut.shape[0] == SIZE + 1 and lut.shape[1] == NUM_ROWS
+
+    return lut_metric_c(pack_tiles(tiles), &lut[0, 0])
+
+
+def lut_metric_bitboard(uint64_t board, const double [:, ::1] lut):
+    """calc_metrics4() of a packed board
+    :return: float"""
+
+    assert lut.shape[0] == SIZE + 1 and lut.shape[1] == NUM_ROWS
+
+    return lut_metric_c(board, &lut[0, 0])
+
+
+
+# --- Compiled whole game simulator
+# play_game() runs a whole game (search, move, random tile, game over check) in C, on packed
+# boards, without the GIL.  The search is the same as AutoPlay.MoveTree / get_move_tree():
+# every move of every node to depth, one random tile per move, and the average of the top
+# metrics found below each first move.  Random numbers come from a C xorshift64* generator,
+# so games are NOT the same as AutoPlayer games with the same seed.
+
+cdef struct GameSearch:
+    int depth
+    double topx
+    int calc_option
+    double mult_base
+    uint64_t rand_state
+    long tree_size
+    double *metrics[4]      # Metrics found below each first move (branch)
+    long metrics_len[4]
+
+
+# splitmix64, to turn any seed into a good (non-zero) xorshift state
+cdef inline uint64_t seed_rand_state(uint64_t seed) nogil:
 
-    if in_corner0 == False:
-        return metric
+    cdef uint64_t z = seed + 0x9E3779B97F4A7C15ULL
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL
+    z = z ^ (z >> 31)
 
-    # Otherwise, calculate the metric
-    cdef double mult
-    cdef int rgt_col = size - 1, nxt_col = size - 2
+    return z if z != 0 else 0x9E3779B97F4A7C15ULL
 
-    # Right Col, top to bottom
-    mult = mult_base ** (size * 2)
 
-    for i in range(size):
-        metric += mult * tiles_view[i, rgt_col]
+# xorshift64*. Returns a random double [0.0, 1.0)
+cdef inline double next_rand(uint64_t *state) nogil:
+
+    cdef uint64_t x = state[0]
+    x ^= x >> 12
+    x ^= x << 25
+    x ^= x >> 27
+    state[0] = x
+
+    return ((x * 0x2545F4914F6CDD1DULL) >> 11) * (1.0 / 9007199254740992.0)
+
+
+cdef inline int board_count_empty(uint64_t board) nogil:
+
+    cdef int i, num_empty = 0
+    for i in range(NUM_TILES):
+        if ((board >> (4 * i)) & 0xF) == 0:
+            num_empty += 1
+
+    return num_empty
+
+
+# Same rules as add_random_tile(): empty spots in row-major order, rand < 0.9 --> 2, else 4
+cdef uint64_t board_add_random_tile(uint64_t board, uint64_t *rand_state) nogil:
+
+    cdef int open_positions[NUM_TILES]
+    cdef int i, empty = 0
+    cdef uint64_t exp
+
+    for i in range(NUM_TILES):
+        if ((board >> (4 * i)) & 0xF) == 0:
+            open_positions[empty] = i
+            empty += 1
+
+    if empty == 0:
+        return board
+
+    i = open_positions[<int>(next_rand(rand_state) * empty)]
+    exp = 1 if next_rand(rand_state) < 0.9 else 2
+
+    return board | (exp << (4 * i))
+
+
+cdef bint board_game_over(uint64_t board) nogil:
+
+    cdef uint64_t board_t = transpose_board(board)
+    cdef int i
+
+    if board_count_empty(board) > 0:
+        return False
+
+    for i in range(SIZE):
+        if row_changed_table[(board >> (16 * i)) & 0xFFFF] or \
+                row_changed_table[(board_t >> (16 * i)) & 0xFFFF]:
+            return False
+
+    return True
+
+
+cdef inline void unpack_board(uint64_t board, int *tiles) nogil:
+
+    cdef int row, col, exp
+    for row in range(SIZE):
+        for col in range(SIZE):
+            exp = (board >> (4 * (row * SIZE + col))) & 0xF
+            tiles[row * SIZE + col] = 0 if exp == 0 else (1 << exp)
+
+
+# Strategies 1-3 (calc_metrics1/2/3()), on a C 2D-array of tile numbers
+
+cdef double metric1_c(const int *tiles, double mult_base) nogil:
+
+    cdef int max_val = 0, row, col, i
+    cdef bint in_corner0 = False
+    cdef double metric = 0, mult
+
+    for row in range(SIZE):
+        for col in range(SIZE):
+            if tiles[row * SIZE + col] > max_val:
+                max_val = tiles[row * SIZE + col]
+
+    # Any of the max tiles in upper-right?
+    in_corner0 = tiles[SIZE - 1] == max_val
+    if not in_corner0:
+        return 0
+
+    # Right Col, top to bottom. Then second-to-right col, bottom to top
+    mult = mult_base ** (SIZE * 2)
+    for i in range(SIZE):
+        metric += mult * tiles[i * SIZE + SIZE - 1]
         mult = mult / mult_base
 
-    # Second-to-right col, bottom to top
-    for i in range(size-1, -1, -1):
-        metric += mult * tiles_view[i, nxt_col]
+    for i in range(SIZE - 1, -1, -1):
+        metric += mult * tiles[i * SIZE + SIZE - 2]
         mult = mult / mult_base
 
     return metric
 
 
-# Strategy 2:
-# More advanced metric. Rewards any "chain" anchored in a corner,
-# with additional "reward" for empty tiles
+cdef bint in_chain_c(int chain[NUM_TILES][3], int chain_len, int row, int col) nogil:
 
-def calc_metrics2(tiles, double mult_base):
+    cdef int i
+    for i in range(chain_len):
+        if chain[i][1] == row and chain[i][2] == col:
+            return True
 
-    # graph = {(0, 0): ((1, 0), (0, 1)),
-    #          (0, 1): ((0, 0), (1, 1), (0, 2)),
-    #          (0, 2): ((0, 1), (1, 2), (0, 3)),
-    #          (0, 3): ((0, 2), (1, 3)),
-    #          (1, 0): ((0, 0), (1, 1), (2, 0)),
-    #          (1, 1): ((0, 1), (1, 2), (2, 1), (1, 0)),
-    #          (1, 2): ((0, 2), (1, 3), (2, 2), (1, 1)),
-    #          (1, 3): ((0, 3), (2, 3), (1, 2)),
-    #          (2, 0): ((1, 0), (2, 1), (3, 0)),
-    #          (2, 1): ((1, 1), (2, 2), (3, 1), (2, 0)),
-    #          (2, 2): ((1, 2), (2, 3), (3, 2), (2, 1)),
-    #          (2, 3): ((1, 3), (3, 3), (2, 2)),
-    #          (3, 0): ((2, 0), (3, 1)),
-    #          (3, 1): ((2, 1), (3, 2), (3, 0)),
-    #          (3, 2): ((2, 2), (3, 3), (3, 1)),
-    #          (3, 3): ((2, 3), (3, 2))}
+    return False
 
-    cdef int size = tiles.shape[0]
 
-    assert tiles.shape[0] == tiles.shape[1]
-    assert tiles.dtype == DTYPE
+# Largest adjacent tile (not already in chain, not larger) of the last tile of the chain
+cdef void max_adjacent_c(const int *tiles, int chain[NUM_TILES][3], int chain_len,
+                         int max_adj[3]) nogil:
 
-    cdef const int [:, :] tiles_view = tiles
+    cdef int row = chain[chain_len - 1][1], col = chain[chain_len - 1][2]
+    cdef int curr_val = tiles[row * SIZE + col], val, i
+    cdef int adj_rows[4]
+    cdef int adj_cols[4]
 
-    # Find greatest tile(s) value and indeces, the starting point(s) of the "chain" calculation(s)
-    cdef int max_val = 0, val
-    cdef short maxs_len = 0, num_empty = 0, row, col
+    # Above, Right, Below, Left
+    adj_rows[0] = row - 1
+    adj_cols[0] = col
+    adj_rows[1] = row
+    adj_cols[1] = col + 1
+    adj_rows[2] = row + 1
+    adj_cols[2] = col
+    adj_rows[3] = row
+    adj_cols[3] = col - 1
 
-    cdef int maxs[NUM_TILES][3]
-    cdef int [:, :] maxs_view = maxs
-    maxs_view[:, :] = 0
+    max_adj[0] = 0
+    max_adj[1] = -1
+    max_adj[2] = -1
 
-    for row in range(size):
-        for col in range(size):
+    for i in range(4):
+        if adj_rows[i] < 0 or adj_rows[i] >= SIZE or adj_cols[i] < 0 or adj_cols[i] >= SIZE:
+            continue
 
-            val = tiles_view[row, col]
+        val = tiles[adj_rows[i] * SIZE + adj_cols[i]]
+        if not in_chain_c(chain, chain_len, adj_rows[i], adj_cols[i]) and \
+                val <= curr_val and val > max_adj[0]:
+            max_adj[0] = val
+            max_adj[1] = adj_rows[i]
+            max_adj[2] = adj_cols[i]
+
+
+cdef double metric2_c(const int *tiles, double mult_base) nogil:
+
+    cdef int maxs[NUM_TILES][3]
+    cdef int chain[NUM_TILES][3]
+    cdef int max_adj[3]
+    cdef int max_val = 0, val, row, col, i, j, k, maxs_len = 0, num_empty = 0, chain_len
+    cdef bint in_corner, same_row, same_col
+    cdef double metric, mult, multiplier1, multiplier2, maximum = 0
 
+    for row in range(SIZE):
+        for col in range(SIZE):
+
+            val = tiles[row * SIZE + col]
             if val == 0:
                 num_empty += 1
-            elif val < max_val:
-                continue
-            # Value is greater
             elif val > max_val:
                 max_val = val
-                maxs_len = 1
-                maxs[0][0] = val
-                maxs[0][1] = row
-                maxs[0][2] = col
-            else:   # Equal
+                maxs_len = 0
+
+            if val != 0 and val == max_val:
                 maxs[maxs_len][0] = val
                 maxs[maxs_len][1] = row
                 maxs[maxs_len][2] = col
                 maxs_len += 1
 
-    # --- Master Loop: Traverses chain(s) and calculates chain quality metric/score
-    # Tiles must be adjacent, and weakly decreasing to comprise a chain.
-
-    cdef int max_adj[3]
-    cdef short metrics_len = 0, chain_len = 0, curr_row, curr_col, i
-    # cdef bint end_of_chain
-    cdef double metric, mult, multiplier1, multiplier2
-    cdef bint in_corner1, in_corner2, in_corner, same_row, same_col
-
-    # Initialize metrics array
-    cdef double metrics[NUM_TILES]
-    cdef double [:] metrics_view = metrics
-    metrics_view[:] = 0
-
-    # Initialize chain 2D array
-    cdef int chain[NUM_TILES][3]
-    cdef int [:, :] chain_view = chain
-    chain_view[:, :] = 0
-
     for i in range(maxs_len):
 
-        # end_of_chain = False    # Have reached the end of the chain?
-        metric = 0              # "Score" metric for the overall chain
-
-        # Start with "max" tile
         chain[0][0] = maxs[i][0]
         chain[0][1] = maxs[i][1]
         chain[0][2] = maxs[i][2]
         chain_len = 1
 
-        # --- Process next 7 (or SIZE-1) "largest" tiles of "chain"
-        for _ in range(2*size-1):
+        for k in range(2 * SIZE - 1):
 
-            max_adj[0] = 0
-            max_adj[1] = -1
-            max_adj[2] = -1
-
-            max_adj = max_adjacent(tiles, chain, chain_len, max_adj, size)
-
-            # If Reached the end of the chain, stop looking for more tiles
+            max_adjacent_c(tiles, chain, chain_len, max_adj)
             if max_adj[0] > chain[chain_len - 1][0] or max_adj[0] == 0:
-                # end_of_chain = True
                 break
 
-            # Else, save this next tile in chain, and keep looking
             chain[chain_len][0] = max_adj[0]
             chain[chain_len][1] = max_adj[1]
             chain[chain_len][2] = max_adj[2]
             chain_len += 1
 
-        # --- Done Identifying this chain
-
-        # Add bonus if largest tile in corner
-        in_corner1 = (chain[0][1] == 0) or (chain[0][1] == size-1)
-        in_corner2 = (chain[0][2] == 0) or (chain[0][2] == size-1)
-        in_corner = in_corner1 and in_corner2
+        in_corner = (chain[0][1] == 0 or chain[0][1] == SIZE - 1) and \
+                    (chain[0][2] == 0 or chain[0][2] == SIZE - 1)
         multiplier1 = 2 if in_corner else 1
 
-        # If the first <=4 tiles in the chain are all in the same row or col
         same_row = True
         same_col = True
-        for i in range(1, min(4, chain_len)):
-            same_row = same_row and (chain[0][1] == chain[i][1])
-            same_col = same_col and (chain[0][2] == chain[i][2])
-
-        # Give "bonus" for these tiles being in same row or col
+        for j in range(1, min(4, chain_len)):
+            same_row = same_row and (chain[0][1] == chain[j][1])
+            same_col = same_col and (chain[0][2] == chain[j][2])
         multiplier2 = 2 if in_corner and (same_row or same_col) else 1
 
-        # Update metric for this chain
+        metric = 0
         mult = mult_base ** chain_len
-        for i in range(chain_len):
-            metric += mult*chain[i][0]
+        for j in range(chain_len):
+            metric += mult * chain[j][0]
             mult = mult / mult_base
 
         metric = metric * multiplier1 * multiplier2 * num_empty
-        metrics[metrics_len] = metric
-        metrics_len += 1
+        if metric > maximum:
+            maximum = metric
+
+    return maximum
+
+
+# Snake shaped chains of calc_metrics3(), 2 per corner: (0, 0), (0, 3), (3, 0), (3, 3)
+cdef int chains3[8][9][2]
+chains3[:] = [[[0, 0], [0, 1], [0, 2], [0, 3], [1, 3], [1, 2], [1, 1], [1, 0], [2, 0]],
+              [[0, 0], [1, 0], [2, 0], [3, 0], [3, 1], [2, 1], [1, 1], [0, 1], [0, 2]],
+              [[0, 3], [1, 3], [2, 3], [3, 3], [3, 2], [2, 2], [1, 2], [0, 2], [0, 1]],
+              [[0, 3], [0, 2], [0, 1], [0, 0], [1, 0], [1, 1], [1, 2], [1, 3], [2, 3]],
+              [[3, 0], [2, 0], [1, 0], [0, 0], [0, 1], [1, 1], [2, 1], [3, 1], [3, 2]],
+              [[3, 0], [3, 1], [3, 2], [3, 3], [2, 3], [2, 2], [2, 1], [2, 0], [1, 0]],
+              [[3, 3], [3, 2], [3, 1], [3, 0], [2, 0], [2, 1], [2, 2], [2, 3], [1, 3]],
+              [[3, 3], [2, 3], [1, 3], [0, 3], [0, 2], [1, 2], [2, 2], [3, 2], [3, 1]]]
+
+
+cdef double metric3_c(const int *tiles, double mult_base) nogil:
+
+    cdef int max_val = 0, row, col, corner, c, j
+    cdef double metric, mult, maximum = 0
 
-        continue        # Unnecessary, but helps readability for long loop
+    for row in range(SIZE):
+        for col in range(SIZE):
+            if tiles[row * SIZE + col] > max_val:
+                max_val = tiles[row * SIZE + col]
 
-    # --- Done calculating the metrics for all chains
+    # Corners in order (0, 0), (0, 3), (3, 0), (3, 3). Only corners holding a max tile count
+    for corner in range(4):
+        row = 0 if corner < 2 else SIZE - 1
+        col = 0 if corner % 2 == 0 else SIZE - 1
+        if max_val == 0 or tiles[row * SIZE + col] != max_val:
+            continue
 
-    # --- Find the maximum value of metrics
-    cdef double maximum = 0
-    for i in range(metrics_len):
-        if metrics[i] > maximum:
-            maximum = metrics[i]
+        for c in range(2 * corner, 2 * corner + 2):
+            metric = 0
+            mult = mult_base ** 9
+            for j in range(9):
+                metric += tiles[chains3[c][j][0] * SIZE + chains3[c][j][1]] * mult
+                mult = mult / mult_base
+
+            if metric > maximum:
+                maximum = metric
 
     return maximum
 
 
-# Given a tile [row, col], find and return the largest adjacent tile
-# Inputs:
-#       int[:,:] tiles_view   - memoryview of numpy array of current game board tiles
-#       int chain[16][3] - C array of tiles found thus far in current "chain"
-#       int chain_len    - length of the current chain
-#       int row, int col - row and column indeces of the current tile to find adjacents of
-#       int size         - the dimension length of the game board  (4 if 4x4 tiles)
-# Returns:
-#
-cdef int * max_adjacent(const int [:, :] tiles_view, int chain[NUM_TILES][3], int chain_len, int max_adj[3], int size):
-
-    cdef int curr_val, abv_val, rgt_val, blw_val, lft_val
-    cdef int row, col, abv_row, rgt_col, blw_row, lft_col
-    cdef bint in_chain
-
-    # Initialize
-    row = chain[chain_len - 1][1]
-    col = chain[chain_len - 1][2]
-    max_adj[0] = 0
-    max_adj[1] = -1
-    max_adj[2] = -1
-    curr_val = tiles_view[row, col]
-
-    # Explore adjacent tiles for largest
-
-    # Above
-    abv_row = row - 1
-    if abv_row > -1:
-
-        in_chain = check_in_chain(chain, chain_len, abv_row, col)
-        abv_val = tiles_view[abv_row, col]
-        if not in_chain and abv_val <= curr_val and abv_val > max_adj[0]:
-            max_adj[0] = abv_val
-            max_adj[1] = abv_row
-            max_adj[2] = col
-
-    # Right
-    rgt_col = col + 1
-    if rgt_col < size:
-
-        in_chain = check_in_chain(chain, chain_len, row, rgt_col)
-        rgt_val = tiles_view[row, rgt_col]
-        if not in_chain and rgt_val <= curr_val and rgt_val > max_adj[0]:
-            max_adj[0] = rgt_val
-            max_adj[1] = row
-            max_adj[2] = rgt_col
-
-    # Below
-    blw_row = row + 1
-    if blw_row < size:
-
-        in_chain = check_in_chain(chain, chain_len, blw_row, col)
-        blw_val = tiles_view[blw_row, col]
-        if not in_chain and blw_val <= curr_val and blw_val > max_adj[0]:
-            max_adj[0] = blw_val
-            max_adj[1] = blw_row
-            max_adj[2] = col
-
-    # Left
-    lft_col = col - 1
-    if lft_col > -1:
-
-        in_chain = check_in_chain(chain, chain_len, row, lft_col)
-        lft_val = tiles_view[row, lft_col]
-        if not in_chain and lft_val <= curr_val and lft_val > max_adj[0]:
-            max_adj[0] = lft_val
-            max_adj[1] = row
-            max_adj[2] = lft_col
-
-    return max_adj
-
-# Check whether a particular tile [row, col] is already saved in "chain"
-# Return True if this tile is already in the chain, False otherwise
-cdef bint check_in_chain(int chain[NUM_TILES][3], int chain_len, int row, int col):
-    cdef int i
-    cdef bint in_chain = False
+# calc_metricsX() selected by calc_option, of a C-contiguous row-major buffer of 16 tile numbers
+cdef double tiles_metric(const int *tiles, int calc_option, double mult_base) nogil:
 
-    for i in range(chain_len):
-        if (chain[i][1] == row) and (chain[i][2] == col):
-            in_chain = True
+    cdef int i, num_empty = 0
+
+    if calc_option == 0:
+        for i in range(NUM_TILES):
+            if tiles[i] == 0:
+                num_empty += 100
+        return num_empty
+    elif calc_option == 1:
+        return metric1_c(tiles, mult_base)
+    elif calc_option == 2:
+        return metric2_c(tiles, mult_base)
+    elif calc_option == 3:
+        return metric3_c(tiles, mult_base)
+
+    return 0
+
+
+cdef double board_metric(uint64_t board, int calc_option, double mult_base) nogil:
+
+    cdef int tiles[NUM_TILES]
+
+    unpack_board(board, tiles)
+    return tiles_metric(tiles, calc_option, mult_base)
+
+
+def calc_metric_bitboard(uint64_t board, int calc_option, double mult_base):
+    """calc_metricsX() selected by calc_option, of a packed board.  Same values as
+    AutoPlay.calc_metric() of the unpacked board.
+    :return: float"""
+
+    return board_metric(board, calc_option, mult_base)
+
+
+cdef int compare_desc(const void *a, const void *b) nogil:
+
+    cdef double x = (<const double *>a)[0], y = (<const double *>b)[0]
+    return (x < y) - (x > y)
+
+
+# Add the metrics of all nodes below board (to depth) to search.metrics[branch]
+cdef void search_subtree(GameSearch *search, uint64_t board, int depth, int branch) nogil:
+
+    cdef int direction, valid_mask
+    cdef uint32_t gained[4]
+    cdef uint64_t boards2[4]
+    cdef uint64_t board2
+
+    valid_mask = move_all_c(board, boards2, gained)
+    for direction in range(4):
+
+        if not (valid_mask >> direction) & 1:
+            continue
+
+        board2 = board_add_random_tile(boards2[direction], &search.rand_state)
+        search.metrics[branch][search.metrics_len[branch]] = \
+            board_metric(board2, search.calc_option, search.mult_base)
+        search.metrics_len[branch] += 1
+        search.tree_size += 1
+
+        if depth > 1:
+            search_subtree(search, board2, depth - 1, branch)
+
+
+# Best move of board, same rules as AutoPlayer.get_move_tree().  -1 if no valid moves
+cdef int search_best_move(GameSearch *search, uint64_t board) nogil:
+
+    cdef double root_metric = board_metric(board, search.calc_option, search.mult_base)
+    cdef double move_metrics[4]
+    cdef double metric, total, max_metric = -3.0
+    cdef uint32_t gained[4]
+    cdef uint64_t boards2[4]
+    cdef uint64_t board2
+    cdef long topx_num, i
+    cdef int direction, best_move = -1
+    cdef int valid_mask = move_all_c(board, boards2, gained)
+
+    search.tree_size = 0
+    for direction in range(4):
+
+        search.metrics_len[direction] = 0
+        move_metrics[direction] = -2.0
+
+        if not (valid_mask >> direction) & 1:
+            continue
+
+        board2 = board_add_random_tile(boards2[direction], &search.rand_state)
+        metric = board_metric(board2, search.calc_option, search.mult_base)
+        search.tree_size += 1
+
+        # If this move would displace a max from a corner, metric is -1
+        if root_metric > 0 and metric == 0:
+            move_metrics[direction] = -1.0
+        else:
+            move_metrics[direction] = 0.0
+
+        # First move node's own metric is counted twice, as in MoveTree
+        search.metrics[direction][0] = metric
+        search.metrics[direction][1] = metric
+        search.metrics_len[direction] = 2
+
+        if search.depth > 1:
+            search_subtree(search, board2, search.depth - 1, direction)
+
+    topx_num = max(1, <long>(search.tree_size * search.topx))
+
+    for direction in range(4):
+
+        if move_metrics[direction] == 0.0:
+            qsort(search.metrics[direction], search.metrics_len[direction], sizeof(double),
+                  compare_desc)
+
+            total = 0
+            for i in range(min(topx_num, search.metrics_len[direction])):
+                total += search.metrics[direction][i]
+            move_metrics[direction] = total / topx_num
+
+        if move_metrics[direction] > max_metric:
+            max_metric = move_metrics[direction]
+            best_move = direction if move_metrics[direction] > -2.0 else -1
+
+    return best_move
+
+
+# Play one whole game with search (its metrics buffers must be allocated).
+# Results are saved in result[0] (score), result[1] (num_moves), result[2] (max_tile)
+cdef void play_game_c(GameSearch *search, uint64_t seed, int64_t *result) nogil:
+
+    cdef uint64_t board = 0, board2
+    cdef uint32_t score = 0
+    cdef long num_moves = 0
+    cdef int direction, i, max_exp = 0
+
+    search.rand_state = seed_rand_state(seed)
+    board = board_add_random_tile(board, &search.rand_state)
+
+    while True:
+
+        direction = search_best_move(search, board)
+        if direction < 0:
             break
 
-    return in_chain
+        board2 = move_board(direction, board, &score)
+        board = board_add_random_tile(board2, &search.rand_state)
+        num_moves += 1
 
+        if board_game_over(board):
+            break
 
-# Strategy 3:
-# More advanced metric. Rewards any "chain" anchored in a corner,
-# with additional "reward" for empty tiles
-def calc_metrics3(tiles, double mult_base):
+    for i in range(NUM_TILES):
+        max_exp = max(max_exp, <int>((board >> (4 * i)) & 0xF))
 
-    cdef int size = tiles.shape[0]
+    result[0] = score
+    result[1] = num_moves
+    result[2] = (1 << max_exp) if max_exp else 0
 
-    assert tiles.shape[0] == tiles.shape[1]
-    assert tiles.dtype == DTYPE
 
-    cdef const int [:, :] tiles_view = tiles
+# Allocate the metrics buffers of search. Returns False if out of memory (nothing allocated)
+cdef bint alloc_search(GameSearch *search, int depth, double topx, int calc_option,
+                       double mult_base) nogil:
 
-    # Find the greatest tile(s) value and indices, the starting point(s) of the "chain" calculation(s)
-    cdef int max_val = 0, val
-    cdef short maxs_len = 0, num_empty = 0, row, col
+    cdef long capacity = 2, level_size = 1
+    cdef int i, j
 
-    cdef int maxs[NUM_TILES][3]
-    cdef int [:, :] maxs_view = maxs
-    maxs_view[:, :] = 0
+    # Most metrics below one first move: itself (twice), and a full 4-ary tree below it
+    for i in range(depth - 1):
+        level_size *= 4
+        capacity += level_size
 
-    for row in range(size):
-        for col in range(size):
+    search.depth = depth
+    search.topx = topx
+    search.calc_option = calc_option
+    search.mult_base = mult_base
 
-            val = tiles_view[row, col]
+    for i in range(4):
+        search.metrics[i] = <double *>malloc(capacity * sizeof(double))
+        if search.metrics[i] == NULL:
+            for j in range(i):
+                free(search.metrics[j])
+            return False
 
-            if val == 0:
-                num_empty += 1
-            elif val < max_val:
-                continue
-            # Value is greater
-            elif val > max_val:
-                max_val = val
-                maxs_len = 1
-                maxs[0][0] = val
-                maxs[0][1] = row
-                maxs[0][2] = col
-            else:   # Equal
-                maxs[maxs_len][0] = val
-                maxs[maxs_len][1] = row
-                maxs[maxs_len][2] = col
-                maxs_len += 1
+    return True
 
-    cdef bint row_in_corner = False, col_in_corner = False, in_corner = False
-    cdef int max_corners[4][3]
-    cdef int i, corners_len = 0
 
-    for i in range(maxs_len):
-        row_in_corner = (maxs[i][1] == 0 or maxs[i][1] == size-1)
-        col_in_corner = (maxs[i][2] == 0 or maxs[i][2] == size-1)
-        if row_in_corner and col_in_corner:
-            in_corner = True
-            max_corners[corners_len][0] = maxs[i][0]
-            max_corners[corners_len][1] = maxs[i][1]
-            max_corners[corners_len][2] = maxs[i][2]
-            corners_len += 1
-
-    # If there are no max tiles in corners, metric is 0
-    if not in_corner:
-        return 0.0
-
-
-    cdef short[9][2] chain00a = [[0, 0], [0, 1], [0, 2], [0, 3], [1, 3], [1, 2], [1, 1], [1, 0], [2, 0]]
-    cdef short[9][2] chain00b = [[0, 0], [1, 0], [2, 0], [3, 0], [3, 1], [2, 1], [1, 1], [0, 1], [0, 2]]
-    cdef short[9][2] chain03a = [[0, 3], [1, 3], [2, 3], [3, 3], [3, 2], [2, 2], [1, 2], [0, 2], [0, 1]]
-    cdef short[9][2] chain03b = [[0, 3], [0, 2], [0, 1], [0, 0], [1, 0], [1, 1], [1, 2], [1, 3], [2, 3]]
-    cdef short[9][2] chain33a = [[3, 3], [3, 2], [3, 1], [3, 0], [2, 0], [2, 1], [2, 2], [2, 3], [1, 3]]
-    cdef short[9][2] chain33b = [[3, 3], [2, 3], [1, 3], [0, 3], [0, 2], [1, 2], [2, 2], [3, 2], [3, 1]]
-    cdef short[9][2] chain30a = [[3, 0], [2, 0], [1, 0], [0, 0], [0, 1], [1, 1], [2, 1], [3, 1], [3, 2]]
-    cdef short[9][2] chain30b = [[3, 0], [3, 1], [3, 2], [3, 3], [2, 3], [2, 2], [2, 1], [2, 0], [1, 0]]
-
-    cdef double metrics[8]
-    cdef short metrics_len = 0
-    cdef double mult = 256, metric = 0
-    cdef short[9][2] chain1, chain2
-
-    for i in range(corners_len):
-
-        if max_corners[i][1] == 0 and max_corners[i][2] == 0:
-            chain1 = chain00a
-            chain2 = chain00b
-
-        elif max_corners[i][1] == 0 and max_corners[i][2] == 3:
-            chain1 = chain03a
-            chain2 = chain03b
-
-        elif max_corners[i][1] == 3 and max_corners[i][2] == 0:
-            chain1 = chain30a
-            chain2 = chain30b
-
-        elif max_corners[i][1] == 3 and max_corners[i][2] == 3:
-            chain1 = chain33a
-            chain2 = chain33b
-
-        metric = 0.0
-        mult = mult_base ** 9
-        for j in range(9):
-            row = chain1[j][0]
-            col = chain1[j][1]
-            metric += tiles_view[row][col] * mult
-            mult = mult / mult_base
+cdef void free_search(GameSearch *search) nogil:
+
+    cdef int i
+    for i in range(4):
+        free(search.metrics[i])
 
-        metrics[metrics_len] = metric
-        metrics_len += 1
 
-        metric = 0.0
-        mult = mult_base ** 9
-        for j in range(9):
-            row = chain2[j][0]
-            col = chain2[j][1]
-            metric += tiles_view[row][col] * mult
-            mult = mult / mult_base
+def play_game(uint64_t seed, int depth=6, double topx=0.05, int calc_option=3,
+              double mult_base=1.5):
+    """
+    Play a whole game, from one random tile until game over, entirely in C.
+    Moves are chosen as AutoPlayer (search_mode "tree", tree_depth=depth) chooses them.
 
-        metrics[metrics_len] = metric
-        metrics_len += 1
+    :param seed: int >= 0. seed of the random numbers of both the search and the game
+    :param depth: int 1-10. depth of the search tree
+    :param topx: float. fraction of the tree's metrics averaged (AutoPlayer topx_perc)
+    :param calc_option: int 0-3. board metric (see AutoPlay.calc_metric())
+    :param mult_base: float. parameter of the board metric
+    :return: (score: int, num_moves: int, max_tile: int)
+    """
 
-    # Find the largest of the metrics calculated for this board
-    cdef double maximum = 0
+    if depth < 1 or depth > 10:
+        raise ValueError("'depth' value invalid.  Must be 1-10.")
+    if calc_option < 0 or calc_option > 3:
+        raise ValueError("'calc_option' value invalid.  Must be 0-3.")
 
-    for i in range(metrics_len):
-        if metrics[i] > maximum:
-            maximum = metrics[i]
+    cdef GameSearch search
+    cdef int64_t result[3]
 
-    # max_c_list = list(max_corners)
-    # max_c_list = max_c_list[:corners_len]
-    return maximum
+    if not alloc_search(&search, depth, topx, calc_option, mult_base):
+        raise MemoryError()
 
+    with nogil:
+        play_game_c(&search, seed, result)
 
-def calc_metrics4(const int [:, :] tiles_view):
-    cdef int i = 0
-    return 0
+    free_search(&search)
+
+    return result[0], result[1], result[2]
+
+
+# --- nogil kernels on raw buffers, and prange helpers
+# tiles buffers are C-contiguous row-major int[16] (a 4x4 NumPy intc array's data).
+# The helpers below release the GIL and split their work over OpenMP threads (if compiled
+# with OpenMP, see setup.py), so they scale across cores in one process.
+
+# Move tiles of one line of 4 tiles, tiles[start], tiles[start + step], ... towards tiles[start].
+# Returns score gained, and sets changed[0] if any tile moved. Same rules as move_tiles()
+cdef int move_line_c(int *tiles, int start, int step, bint *changed) nogil:
+
+    cdef int i, val, place = start, last = 0, score = 0
+    cdef int idx
+
+    for i in range(SIZE):
+        idx = start + i * step
+        val = tiles[idx]
+        if val == 0:
+            continue
+        tiles[idx] = 0
+
+        # Merge with the last placed tile, once
+        if val == last:
+            tiles[place - step] = 2 * val
+            score += 2 * val
+            last = 0
+            changed[0] = True
+        else:
+            tiles[place] = val
+            last = val
+            if place != idx:
+                changed[0] = True
+            place += step
+
+    return score
+
+
+cdef bint move_tiles_c(int direction, const int *tiles, int *out, int *score) nogil:
+    """Move tiles into out (may be the same buffer). Adds score gained to score[0].
+    Returns True if the move changed the board"""
+
+    cdef int i
+    cdef bint changed = False
+
+    if out != tiles:
+        for i in range(NUM_TILES):
+            out[i] = tiles[i]
+
+    for i in range(SIZE):
+        if direction == 0:      # Up: columns, towards row 0
+            score[0] += move_line_c(out, i, SIZE, &changed)
+        elif direction == 1:    # Right: rows, towards col SIZE-1
+            score[0] += move_line_c(out, i * SIZE + SIZE - 1, -1, &changed)
+        elif direction == 2:    # Down: columns, towards row SIZE-1
+            score[0] += move_line_c(out, (SIZE - 1) * SIZE + i, -SIZE, &changed)
+        else:                   # Left: rows, towards col 0
+            score[0] += move_line_c(out, i * SIZE, 1, &changed)
+
+    return changed
+
+
+cdef int add_random_tile_c(int *tiles, double rand_pos, double rand_val) nogil:
+    """Add a random tile in place, same rules as add_random_tile().
+    Returns number of empty tiles after, or -1 if tiles was full (no tile added)"""
+
+    cdef int open_positions[NUM_TILES]
+    cdef int i, empty = 0
+
+    for i in range(NUM_TILES):
+        if tiles[i] == 0:
+            open_positions[empty] = i
+            empty += 1
+
+    if empty == 0:
+        return -1
+
+    tiles[open_positions[<int>(rand_pos * empty)]] = 2 if rand_val < 0.9 else 4
+
+    return empty - 1
+
+
+# The prange helpers below default to num_threads=1: their callers usually already run one per
+# process (AutoPlayer workers, Sweep, Training), and N processes x N threads oversubscribes the CPUs.
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def calc_metrics_boards(const uint64_t [:] boards, int calc_option, double mult_base,
+                        int num_threads=1):
+    """calc_metric_bitboard() of every board, in parallel.
+    :param num_threads: int. 0 --> one per CPU
+    :return: NumPy float64 1D-array"""
+
+    cdef Py_ssize_t i, num = boards.shape[0]
+    cdef int threads = num_threads or cpu_count()
+    metrics = empty(num, dtype=float64)
+    cdef double [:] metrics_view = metrics
+
+    for i in prange(num, nogil=True, schedule="static", num_threads=threads):
+        metrics_view[i] = board_metric(boards[i], calc_option, mult_base)
+
+    return metrics
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def calc_metrics_tiles(const int [:, :, ::1] tiles, int calc_option, double mult_base,
+                       int num_threads=1):
+    """calc_metricsX() (see AutoPlay.calc_metric()) of a 3D-array [N][4][4] of tiles, in parallel.
+    :param num_threads: int. 0 --> one per CPU
+    :return: NumPy float64 1D-array"""
+
+    assert tiles.shape[1] == SIZE and tiles.shape[2] == SIZE
+
+    cdef Py_ssize_t i, num = tiles.shape[0]
+    cdef int threads = num_threads or cpu_count()
+    metrics = empty(num, dtype=float64)
+    cdef double [:] metrics_view = metrics
+
+    for i in prange(num, nogil=True, schedule="static", num_threads=threads):
+        metrics_view[i] = tiles_metric(&tiles[i, 0, 0], calc_option, mult_base)
+
+    return metrics
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def lut_metrics_boards(const uint64_t [:] boards, const double [:, ::1] lut, int num_threads=1):
+    """lut_metric_bitboard() of every board, in parallel.
+    :param num_threads: int. 0 --> one per CPU
+    :return: NumPy float64 1D-array"""
+
+    assert lut.shape[0] == SIZE + 1 and lut.shape[1] == NUM_ROWS
+
+    cdef Py_ssize_t i, num = boards.shape[0]
+    cdef int threads = num_threads or cpu_count()
+    metrics = empty(num, dtype=float64)
+    cdef double [:] metrics_view = metrics
+
+    for i in prange(num, nogil=True, schedule="static", num_threads=threads):
+        metrics_view[i] = lut_metric_c(boards[i], &lut[0, 0])
+
+    return metrics
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def move_boards_all(const uint64_t [:] boards, int num_threads=1):
+    """All 4 moves of every board, in parallel.  See BitBoard.move_all_boards()
+    :return: (valid: bool 2D-array [N][4], boards2: uint64 2D-array [N][4],
+              gained: uint32 2D-array [N][4])"""
+
+    cdef Py_ssize_t i, num = boards.shape[0]
+    cdef int threads = num_threads or cpu_count()
+    cdef int direction, valid_mask
+
+    boards2 = empty((num, 4), dtype=uint64)
+    gained = zeros((num, 4), dtype=uint32)
+    valid = empty((num, 4), dtype=bool_)
+    cdef uint64_t [:, ::1] boards2_view = boards2
+    cdef uint32_t [:, ::1] gained_view = gained
+    cdef uint8_t [:, :] valid_view = valid.view(uint8)
+
+    for i in prange(num, nogil=True, schedule="static", num_threads=threads):
+        valid_mask = move_all_c(boards[i], &boards2_view[i, 0], &gained_view[i, 0])
+        for direction in range(4):
+            valid_view[i, direction] = (valid_mask >> direction) & 1
+
+    return valid, boards2, gained
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def play_games(const uint64_t [:] seeds, int depth=6, double topx=0.05, int calc_option=3,
+               double mult_base=1.5, int num_threads=1):
+    """
+    play_game() of each seed, in parallel.
+
+    :param seeds: NumPy uint64 1D-array of seeds, one game each
+    :param depth, topx, calc_option, mult_base: see play_game()
+    :param num_threads: int. 0 --> one per CPU
+    :return: NumPy int64 2D-array [N][3] of (score, num_moves, max_tile) of each game
+    """
+
+    if depth < 1 or depth > 10:
+        raise ValueError("'depth' value invalid.  Must be 1-10.")
+    if calc_option < 0 or calc_option > 3:
+        raise ValueError("'calc_option' value invalid.  Must be 0-3.")
+
+    cdef Py_ssize_t i, num = seeds.shape[0]
+    cdef int threads = num_threads or cpu_count()
+    cdef int t, num_alloc = 0
+
+    results = zeros((num, 3), dtype=int64)
+    cdef int64_t [:, ::1] results_view = results
+
+    # Each thread has its own search buffers
+    cdef GameSearch *searches = <GameSearch *>malloc(threads * sizeof(GameSearch))
+    if searches == NULL:
+        raise MemoryError()
+
+    while num_alloc < threads and alloc_search(&searches[num_alloc], depth, topx, calc_option,
+                                               mult_base):
+        num_alloc += 1
+
+    if num_alloc < threads:
+        for t in range(num_alloc):
+            free_search(&searches[t])
+        free(searches)
+        raise MemoryError()
 
+    for i in prange(num, nogil=True, schedule="dynamic", num_threads=threads):
+        play_game_c(&searches[threadid()], seeds[i], &results_view[i, 0])
 
+    for t in range(threads):
+        free_search(&searches[t])
+    free(searches)
 
+    return results
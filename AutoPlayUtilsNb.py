@@ -0,0 +1,707 @@
+# Various functions for AutoPlay, compiled just-in-time with Numba
+# Same function surface as AutoPlayUtilsCy, with no build step: each function is compiled on
+# first use, and cached on disk (cache=True), so later runs start without compiling.
+# See also AutoPlayUtilsPy (slower, pure Python) and AutoPlayUtilsCy (Cython, needs building)
+#
+# tiles arrays are NumPy 2D-arrays [4][4] of tile numbers (0, 2, 4, ...).  The *_into()
+# functions need C-contiguous arrays, like their AutoPlayUtilsCy counterparts.
+# Packed boards are 64-bit BitBoard ints (see BitBoard)
+
+from numba import config, njit, prange, get_num_threads, set_num_threads
+from numpy import (array, empty, zeros, concatenate, partition,
+                   float64, int64, uint64, uint32, bool_)
+
+import MoveTables
+
+SIZE = 4            # Length of single board dimension
+NUM_TILES = 16      # SIZE * SIZE
+
+# Row tables of the shared MoveTables.  Numba freezes these into the compiled functions
+ROW_LEFT = MoveTables.ROW_LEFT
+ROW_RIGHT = MoveTables.ROW_RIGHT
+ROW_SCORE = MoveTables.ROW_SCORE
+ROW_CHANGED = MoveTables.ROW_CHANGED
+
+# Packed board constants, typed uint64 so Numba never mixes signed and unsigned ints
+ROW_MASK = uint64(0xFFFF)
+NIBBLE_MASK = uint64(0xF)
+
+# Snake shaped chains of calc_metrics3(), 2 per corner: (0, 0), (0, 3), (3, 0), (3, 3)
+CHAINS3 = array([[[0, 0], [0, 1], [0, 2], [0, 3], [1, 3], [1, 2], [1, 1], [1, 0], [2, 0]],
+                 [[0, 0], [1, 0], [2, 0], [3, 0], [3, 1], [2, 1], [1, 1], [0, 1], [0, 2]],
+                 [[0, 3], [1, 3], [2, 3], [3, 3], [3, 2], [2, 2], [1, 2], [0, 2], [0, 1]],
+                 [[0, 3], [0, 2], [0, 1], [0, 0], [1, 0], [1, 1], [1, 2], [1, 3], [2, 3]],
+                 [[3, 0], [2, 0], [1, 0], [0, 0], [0, 1], [1, 1], [2, 1], [3, 1], [3, 2]],
+                 [[3, 0], [3, 1], [3, 2], [3, 3], [2, 3], [2, 2], [2, 1], [2, 0], [1, 0]],
+                 [[3, 3], [3, 2], [3, 1], [3, 0], [2, 0], [2, 1], [2, 2], [2, 3], [1, 3]],
+                 [[3, 3], [2, 3], [1, 3], [0, 3], [0, 2], [1, 2], [2, 2], [3, 2], [3, 1]]],
+                dtype=int64)
+
+
+# Return the (up to) topx_num largest metrics of both top_metrics and new_metrics.
+# Used to keep a running "top X" while AutoPlay.MoveTree is built, one level at a time.
+@njit(cache=True)
+def merge_top_metrics(top_metrics, new_metrics, topx_num):
+
+    metrics = concatenate((top_metrics, new_metrics))
+
+    if metrics.size > topx_num:
+        metrics = partition(metrics, metrics.size - topx_num)[metrics.size - topx_num:]
+
+    return metrics
+
+
+# --- Packed (BitBoard) boards
+
+# Swap rows and columns of a packed board (see BitBoard.transpose)
+@njit(cache=True)
+def transpose_board(x):
+
+    a1 = x & uint64(0xF0F00F0FF0F00F0F)
+    a2 = x & uint64(0x0000F0F00000F0F0)
+    a3 = x & uint64(0x0F0F00000F0F0000)
+    a = a1 | (a2 << uint64(12)) | (a3 >> uint64(12))
+    b1 = a & uint64(0xFF00FF0000FF00FF)
+    b2 = a & uint64(0x00FF00FF00000000)
+    b3 = a & uint64(0x00000000FF00FF00)
+
+    return b1 | (b2 >> uint64(24)) | (b3 << uint64(24))
+
+
+# Apply a row table to all 4 rows of a packed board.  Returns (board2, score gained)
+@njit(cache=True)
+def move_rows(board, table):
+
+    board2 = uint64(0)
+    score = 0
+
+    for i in range(SIZE):
+        shift = uint64(16 * i)
+        row = (board >> shift) & ROW_MASK
+        board2 |= uint64(table[row]) << shift
+        score += ROW_SCORE[row]
+
+    return board2, score
+
+
+# Move a packed board (0: Up, 1: Right, 2: Down, 3: Left).  Returns (board2, score gained)
+@njit(cache=True)
+def move_board(direction, board):
+
+    if direction == 0:
+        board2, score = move_rows(transpose_board(board), ROW_LEFT)
+        return transpose_board(board2), score
+    elif direction == 1:
+        return move_rows(board, ROW_RIGHT)
+    elif direction == 2:
+        board2, score = move_rows(transpose_board(board), ROW_RIGHT)
+        return transpose_board(board2), score
+    else:
+        return move_rows(board, ROW_LEFT)
+
+
+# All 4 moves of a packed board in one pass, into boards2[4] and gained[4] (by direction).
+# Returns the validity bitmask: bit d set if move d is valid.  Same as AutoPlayUtilsCy.move_all_c
+@njit(cache=True)
+def move_all_into(board, boards2, gained):
+
+    board_t = transpose_board(board)
+    up = uint64(0)
+    right = uint64(0)
+    down = uint64(0)
+    left = uint64(0)
+    row_score = 0
+    col_score = 0
+
+    for i in range(SIZE):
+        shift = uint64(16 * i)
+        row = (board >> shift) & ROW_MASK
+        col = (board_t >> shift) & ROW_MASK
+
+        left |= uint64(ROW_LEFT[row]) << shift
+        right |= uint64(ROW_RIGHT[row]) << shift
+        up |= uint64(ROW_LEFT[col]) << shift
+        down |= uint64(ROW_RIGHT[col]) << shift
+
+        row_score += ROW_SCORE[row]
+        col_score += ROW_SCORE[col]
+
+    boards2[0] = transpose_board(up)
+    boards2[1] = right
+    boards2[2] = transpose_board(down)
+    boards2[3] = left
+    gained[0] = col_score
+    gained[1] = row_score
+    gained[2] = col_score
+    gained[3] = row_score
+
+    valid_mask = 0
+    for i in range(4):
+        if boards2[i] != board:
+            valid_mask |= 1 << i
+
+    return valid_mask
+
+
+@njit(cache=True)
+def unpack_board_into(board, tiles):
+
+    for row in range(SIZE):
+        for col in range(SIZE):
+            exp = int64((board >> uint64(4 * (row * SIZE + col))) & NIBBLE_MASK)
+            tiles[row, col] = 0 if exp == 0 else (1 << exp)
+
+
+@njit(cache=True)
+def board_game_over(board):
+
+    board_t = transpose_board(board)
+
+    for i in range(NUM_TILES):
+        if (board >> uint64(4 * i)) & NIBBLE_MASK == 0:
+            return False
+
+    for i in range(SIZE):
+        shift = uint64(16 * i)
+        if ROW_CHANGED[(board >> shift) & ROW_MASK] or ROW_CHANGED[(board_t >> shift) & ROW_MASK]:
+            return False
+
+    return True
+
+
+def move_bitboard(direction, board, score):
+    """Packed-board counterpart of move_tiles().  See BitBoard.move_tiles()
+    :return: (valid_move: bool, board2: int, score2: int)"""
+
+    if direction < 0 or direction > 3:
+        raise ValueError("'direction' value invalid.  Must be 0-3.")
+
+    board2, gained = move_board(direction, uint64(board))
+
+    return board2 != board, int(board2), score + int(gained)
+
+
+def move_all_bitboard(board):
+    """All 4 moves of a packed board in one call.  See BitBoard.move_all()
+    :return: (valid_mask: int, boards2: tuple of 4 int, gained: tuple of 4 int)"""
+
+    boards2 = empty(4, dtype=uint64)
+    gained = empty(4, dtype=int64)
+    valid_mask = move_all_into(uint64(board), boards2, gained)
+
+    return valid_mask, tuple(boards2.tolist()), tuple(gained.tolist())
+
+
+def check_game_over_bitboard(board):
+    """check_game_over() of a packed 64-bit BitBoard, with row table lookups
+    :return: bool. True if game is over, False otherwise"""
+
+    return board_game_over(uint64(board))
+
+
+@njit(cache=True)
+def pack_board(tiles):
+
+    board = uint64(0)
+    for row in range(SIZE):
+        for col in range(SIZE):
+            val = tiles[row, col]
+            exp = 0
+            while val > 1:
+                val >>= 1
+                exp += 1
+            board |= uint64(exp) << uint64(4 * (row * SIZE + col))
+
+    return board
+
+
+def pack_tiles(tiles):
+    """Fast counterpart of BitBoard.from_tiles().  Does NOT check tiles are powers of 2.
+    :return: int. packed 64-bit board"""
+
+    return int(pack_board(tiles))
+
+
+# --- Unpacked tiles
+
+# Move tiles of one line of 4 tiles, flat[start], flat[start + step], ... towards flat[start].
+# Returns (score gained, changed). Same rules as move_tiles()
+@njit(cache=True)
+def move_line(flat, start, step):
+
+    place = start
+    last = 0
+    score = 0
+    changed = False
+
+    for i in range(SIZE):
+        idx = start + i * step
+        val = flat[idx]
+        if val == 0:
+            continue
+        flat[idx] = 0
+
+        # Merge with the last placed tile, once
+        if val == last:
+            flat[place - step] = 2 * val
+            score += 2 * val
+            last = 0
+            changed = True
+        else:
+            flat[place] = val
+            last = val
+            if place != idx:
+                changed = True
+            place += step
+
+    return score, changed
+
+
+@njit(cache=True)
+def move_tiles_into(direction, tiles, out):
+    """
+    Allocation free move_tiles().  Writes the tiles after the move into out.
+
+    :param direction: int 0-3. (0: Up, 1: Right, 2: Down, 3: Left)
+    :param tiles: C-contiguous NumPy int 2D-array [4][4]. Not changed, unless it is also out
+    :param out: C-contiguous NumPy int 2D-array [4][4]. May be tiles itself (move in place)
+    :return: (valid_move: bool, score gained: int)
+    """
+
+    if direction < 0 or direction > 3:
+        raise ValueError("'direction' value invalid.  Must be 0-3.")
+
+    for row in range(SIZE):
+        for col in range(SIZE):
+            out[row, col] = tiles[row, col]
+
+    flat = out.reshape(NUM_TILES)
+    delta = 0
+    valid_move = False
+
+    for i in range(SIZE):
+        if direction == 0:      # Up: columns, towards row 0
+            score, changed = move_line(flat, i, SIZE)
+        elif direction == 1:    # Right: rows, towards col SIZE-1
+            score, changed = move_line(flat, i * SIZE + SIZE - 1, -1)
+        elif direction == 2:    # Down: columns, towards row SIZE-1
+            score, changed = move_line(flat, (SIZE - 1) * SIZE + i, -SIZE)
+        else:                   # Left: rows, towards col 0
+            score, changed = move_line(flat, i * SIZE, 1)
+
+        delta += score
+        valid_move = valid_move or changed
+
+    return valid_move, delta
+
+
+@njit(cache=True)
+def move_tiles(direction, tiles, score):
+    """Moves tiles in 'direction' per 2048 game rules.  Thin wrapper of move_tiles_into(),
+    for callers that need a new array.
+    :return: (valid_move: bool, tiles2: new NumPy 2D-array, score2: int)"""
+
+    tiles1 = tiles.copy()
+    valid_move, delta = move_tiles_into(direction, tiles1, tiles1)
+
+    return valid_move, tiles1, score + delta
+
+
+@njit(cache=True)
+def add_random_tile_into(tiles, rand_pos, rand_val):
+    """
+    Allocation free add_random_tile().  Adds new tile (2 or 4) to tiles in place.
+    rand_pos picks among the empty spots in row-major order, rand_val < 0.9 gives a 2, else a 4.
+
+    :param tiles: NumPy int 2D-array [4][4]
+    :param rand_pos: float [0.0, 1.0)
+    :param rand_val: float [0.0, 1.0)
+    :return: int. number of empty tiles after, or -1 if tiles was full (no tile added)
+    """
+
+    open_positions = empty(NUM_TILES, dtype=int64)
+    num_empty = 0
+
+    for row in range(SIZE):
+        for col in range(SIZE):
+            if tiles[row, col] == 0:
+                open_positions[num_empty] = row * SIZE + col
+                num_empty += 1
+
+    if num_empty == 0:
+        return -1
+
+    idx = open_positions[int(rand_pos * num_empty)]
+    tiles[idx // SIZE, idx % SIZE] = 2 if rand_val < 0.9 else 4
+
+    return num_empty - 1
+
+
+@njit(cache=True)
+def add_random_tile(tiles, rands, rand_idx1):
+    """Adds new tile (2 or 4) to a random empty spot of tiles, in place, using
+    rands[rand_idx1] and rands[rand_idx1 + 1].  Thin wrapper of add_random_tile_into()
+    :return: (tiles, num_empty: int, rand_idx: int) rand_idx is the next unused index"""
+
+    num_empty = add_random_tile_into(tiles, rands[rand_idx1], rands[rand_idx1 + 1])
+
+    # Full board. No tile added, and no random numbers used
+    if num_empty < 0:
+        return tiles, 0, rand_idx1
+
+    return tiles, num_empty, rand_idx1 + 2
+
+
+@njit(cache=True)
+def check_game_over(tiles):
+    """
+    Checks tiles to see if any valid moves are left, without making any moves.
+    A move is valid if there is an empty tile, or two equal neighbours (row or column).
+
+    :param tiles: NumPy int 2D-array [4][4]
+    :return: bool. True if game is over, False otherwise
+    """
+
+    for row in range(SIZE):
+        for col in range(SIZE):
+            tile = tiles[row, col]
+            if tile == 0:
+                return False
+            if col < SIZE - 1 and tile == tiles[row, col + 1]:
+                return False
+            if row < SIZE - 1 and tile == tiles[row + 1, col]:
+                return False
+
+    return True
+
+
+# --- Metrics. Same values as the AutoPlayUtilsCy versions
+
+# Strategy 0:
+# Simplest...Rewards Empty Tiles.
+@njit(cache=True)
+def calc_metrics0(tiles):
+
+    num_empty = 0
+    for row in range(SIZE):
+        for col in range(SIZE):
+            if tiles[row, col] == 0:
+                num_empty += 100
+
+    return num_empty
+
+
+# Strategy 1:
+# Simple metric...Rewards Upper-Right aligned chain.
+@njit(cache=True)
+def calc_metrics1(tiles, mult_base):
+
+    max_val = 0
+    for row in range(SIZE):
+        for col in range(SIZE):
+            if tiles[row, col] > max_val:
+                max_val = tiles[row, col]
+
+    # Any of the max tiles in upper-right?
+    if tiles[0, SIZE - 1] != max_val:
+        return 0.0
+
+    # Right Col, top to bottom. Then second-to-right col, bottom to top
+    metric = 0.0
+    mult = mult_base ** (SIZE * 2)
+    for i in range(SIZE):
+        metric += mult * tiles[i, SIZE - 1]
+        mult = mult / mult_base
+
+    for i in range(SIZE - 1, -1, -1):
+        metric += mult * tiles[i, SIZE - 2]
+        mult = mult / mult_base
+
+    return metric
+
+
+# Largest adjacent tile (not already in chain, not larger) of the last tile of the chain.
+# chain is [NUM_TILES][3] of (val, row, col).  Returns (val, row, col), val 0 if none
+@njit(cache=True)
+def max_adjacent(tiles, chain, chain_len):
+
+    row = chain[chain_len - 1, 1]
+    col = chain[chain_len - 1, 2]
+    curr_val = tiles[row, col]
+    max_val, max_row, max_col = 0, -1, -1
+
+    # Above, Right, Below, Left
+    for (adj_row, adj_col) in ((row - 1, col), (row, col + 1), (row + 1, col), (row, col - 1)):
+        if adj_row < 0 or adj_row >= SIZE or adj_col < 0 or adj_col >= SIZE:
+            continue
+
+        in_chain = False
+        for i in range(chain_len):
+            if chain[i, 1] == adj_row and chain[i, 2] == adj_col:
+                in_chain = True
+                break
+
+        val = tiles[adj_row, adj_col]
+        if not in_chain and curr_val >= val > max_val:
+            max_val, max_row, max_col = val, adj_row, adj_col
+
+    return max_val, max_row, max_col
+
+
+# Strategy 2:
+# More advanced metric. Rewards any "chain" anchored in a corner,
+# with additional "reward" for empty tiles
+@njit(cache=True)
+def calc_metrics2(tiles, mult_base):
+
+    maxs = empty((NUM_TILES, 3), dtype=int64)
+    chain = empty((NUM_TILES, 3), dtype=int64)
+    max_val = 0
+    maxs_len = 0
+    num_empty = 0
+
+    for row in range(SIZE):
+        for col in range(SIZE):
+
+            val = tiles[row, col]
+            if val == 0:
+                num_empty += 1
+            elif val > max_val:
+                max_val = val
+                maxs_len = 0
+
+            if val != 0 and val == max_val:
+                maxs[maxs_len, 0] = val
+                maxs[maxs_len, 1] = row
+                maxs[maxs_len, 2] = col
+                maxs_len += 1
+
+    maximum = 0.0
+    for i in range(maxs_len):
+
+        chain[0, :] = maxs[i, :]
+        chain_len = 1
+
+        for _ in range(2 * SIZE - 1):
+
+            adj_val, adj_row, adj_col = max_adjacent(tiles, chain, chain_len)
+            if adj_val > chain[chain_len - 1, 0] or adj_val == 0:
+                break
+
+            chain[chain_len, 0] = adj_val
+            chain[chain_len, 1] = adj_row
+            chain[chain_len, 2] = adj_col
+            chain_len += 1
+
+        in_corner = (chain[0, 1] == 0 or chain[0, 1] == SIZE - 1) and \
+                    (chain[0, 2] == 0 or chain[0, 2] == SIZE - 1)
+        multiplier1 = 2 if in_corner else 1
+
+        same_row = True
+        same_col = True
+        for j in range(1, min(4, chain_len)):
+            same_row = same_row and (chain[0, 1] == chain[j, 1])
+            same_col = same_col and (chain[0, 2] == chain[j, 2])
+        multiplier2 = 2 if in_corner and (same_row or same_col) else 1
+
+        metric = 0.0
+        mult = mult_base ** chain_len
+        for j in range(chain_len):
+            metric += mult * chain[j, 0]
+            mult = mult / mult_base
+
+        metric = metric * multiplier1 * multiplier2 * num_empty
+        if metric > maximum:
+            maximum = metric
+
+    return maximum
+
+
+# Strategy 3:
+# More advanced metric. Rewards any "chain" anchored in a corner
+@njit(cache=True)
+def calc_metrics3(tiles, mult_base):
+
+    max_val = 0
+    for row in range(SIZE):
+        for col in range(SIZE):
+            if tiles[row, col] > max_val:
+                max_val = tiles[row, col]
+
+    # Corners in order (0, 0), (0, 3), (3, 0), (3, 3). Only corners holding a max tile count
+    maximum = 0.0
+    for corner in range(4):
+        row = 0 if corner < 2 else SIZE - 1
+        col = 0 if corner % 2 == 0 else SIZE - 1
+        if max_val == 0 or tiles[row, col] != max_val:
+            continue
+
+        for c in range(2 * corner, 2 * corner + 2):
+            metric = 0.0
+            mult = mult_base ** 9
+            for j in range(9):
+                metric += tiles[CHAINS3[c, j, 0], CHAINS3[c, j, 1]] * mult
+                mult = mult / mult_base
+
+            if metric > maximum:
+                maximum = metric
+
+    return maximum
+
+
+# Strategy 4:
+# Lookup table heuristic.  Sum of precomputed per-row and per-column tables, see HeuristicTables
+# lut is a float64 2D-array [5][65536]: a table for each row, then one for columns
+@njit(cache=True)
+def lut_metric(board, lut):
+
+    board_t = transpose_board(board)
+    metric = 0.0
+    for i in range(SIZE):
+        shift = uint64(16 * i)
+        metric += lut[i, (board >> shift) & ROW_MASK]
+        metric += lut[SIZE, (board_t >> shift) & ROW_MASK]
+
+    return metric
+
+
+@njit(cache=True)
+def calc_metrics4(tiles, lut):
+
+    return lut_metric(pack_board(tiles), lut)
+
+
+def lut_metric_bitboard(board, lut):
+    """calc_metrics4() of a packed board
+    :return: float"""
+
+    return lut_metric(uint64(board), lut)
+
+
+# calc_metricsX() selected by calc_option (0 for any unknown option)
+@njit(cache=True)
+def tiles_metric(tiles, calc_option, mult_base):
+
+    if calc_option == 0:
+        return float(calc_metrics0(tiles))
+    elif calc_option == 1:
+        return calc_metrics1(tiles, mult_base)
+    elif calc_option == 2:
+        return calc_metrics2(tiles, mult_base)
+    elif calc_option == 3:
+        return calc_metrics3(tiles, mult_base)
+
+    return 0.0
+
+
+@njit(cache=True)
+def board_metric(board, calc_option, mult_base):
+
+    tiles = empty((SIZE, SIZE), dtype=int64)
+    unpack_board_into(board, tiles)
+
+    return tiles_metric(tiles, calc_option, mult_base)
+
+
+def calc_metric_bitboard(board, calc_option, mult_base):
+    """calc_metricsX() selected by calc_option, of a packed board.  Same values as
+    AutoPlay.calc_metric() of the unpacked board.
+    :return: float"""
+
+    return board_metric(uint64(board), calc_option, mult_base)
+
+
+# --- Batch helpers. Loops are split over Numba's threads (prange)
+
+@njit(cache=True, parallel=True)
+def _calc_metrics_boards(boards, calc_option, mult_base):
+
+    metrics = empty(boards.shape[0], dtype=float64)
+    for i in prange(boards.shape[0]):
+        metrics[i] = board_metric(boards[i], calc_option, mult_base)
+
+    return metrics
+
+
+@njit(cache=True, parallel=True)
+def _calc_metrics_tiles(tiles, calc_option, mult_base):
+
+    metrics = empty(tiles.shape[0], dtype=float64)
+    for i in prange(tiles.shape[0]):
+        metrics[i] = tiles_metric(tiles[i], calc_option, mult_base)
+
+    return metrics
+
+
+@njit(cache=True, parallel=True)
+def _lut_metrics_boards(boards, lut):
+
+    metrics = empty(boards.shape[0], dtype=float64)
+    for i in prange(boards.shape[0]):
+        metrics[i] = lut_metric(boards[i], lut)
+
+    return metrics
+
+
+@njit(cache=True, parallel=True)
+def _move_boards_all(boards):
+
+    num = boards.shape[0]
+    boards2 = empty((num, 4), dtype=uint64)
+    gained = zeros((num, 4), dtype=uint32)
+    valid = empty((num, 4), dtype=bool_)
+
+    for i in prange(num):
+        valid_mask = move_all_into(boards[i], boards2[i], gained[i])
+        for direction in range(4):
+            valid[i, direction] = (valid_mask >> direction) & 1
+
+    return valid, boards2, gained
+
+
+# Run func(*args) on num_threads Numba threads (0, or more than Numba has --> all of them).
+# The helpers below default to 1, as their callers usually already run one per process
+# (AutoPlayer workers, Sweep, Training)
+def _with_threads(num_threads, func, *args):
+
+    if not num_threads:
+        return func(*args)
+
+    prev_threads = get_num_threads()
+    set_num_threads(min(num_threads, config.NUMBA_NUM_THREADS))
+    try:
+        return func(*args)
+    finally:
+        set_num_threads(prev_threads)
+
+
+def calc_metrics_boards(boards, calc_option, mult_base, num_threads=1):
+    """calc_metric_bitboard() of every board, in parallel.
+    :param num_threads: int. 0 --> one per CPU
+    :return: NumPy float64 1D-array"""
+
+    return _with_threads(num_threads, _calc_metrics_boards, boards, calc_option, mult_base)
+
+
+def calc_metrics_tiles(tiles, calc_option, mult_base, num_threads=1):
+    """calc_metricsX() (see AutoPlay.calc_metric()) of a 3D-array [N][4][4] of tiles, in parallel.
+    :param num_threads: int. 0 --> one per CPU
+    :return: NumPy float64 1D-array"""
+
+    return _with_threads(num_threads, _calc_metrics_tiles, tiles, calc_option, mult_base)
+
+
+def lut_metrics_boards(boards, lut, num_threads=1):
+    """lut_metric_bitboard() of every board, in parallel.
+    :param num_threads: int. 0 --> one per CPU
+    :return: NumPy float64 1D-array"""
+
+    return _with_threads(num_threads, _lut_metrics_boards, boards, lut)
+
+
+def move_boards_all(boards, num_threads=1):
+    """All 4 moves of every board, in parallel.  See BitBoard.move_all_boards()
+    :return: (valid: bool 2D-array [N][4], boards2: uint64 2D-array [N][4],
+              gained: uint32 2D-array [N][4])"""
+
+    return _with_threads(num_threads, _move_boards_all, boards)
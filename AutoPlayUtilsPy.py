@@ -1,30 +1,24 @@
 # Various functions for AutoPlay implemented in (slower) Python
 # See also AutoPlayUtilsCy for faster implementations of highest-cost functions
+# Same function surface as AutoPlayUtilsCy and AutoPlayUtilsNb, so AutoPlay can use any of them
 
-from numpy import amax
+from numpy import amax, partition, concatenate, empty, zeros, float64, uint64
 
-SIZE = int(4)
-
-def node_tree_max_DFS(node, max_metrics):
+import BitBoard
+import GameMgr
 
-    # Save metric of current node, if in (2**topx) largest in tree
-    if node.metric > max_metrics[0]:
-        max_metrics[0] = node.metric
-        max_metrics.sort()
+SIZE = int(4)
 
-    # Base Case: Reached bottom of game tree
-    if node.next is None:
-        return max_metrics
+# Return the (up to) topx_num largest metrics of both top_metrics and new_metrics.
+# Used to keep a running "top X" while AutoPlay.MoveTree is built, one level at a time.
+def merge_top_metrics(top_metrics, new_metrics, topx_num):
 
-    # Else, recurse deeper.
-    for move_dir in range(SIZE):
+    metrics = concatenate((top_metrics, new_metrics))
 
-        if node.next[move_dir] is None:
-            continue
-        else:
-            node_tree_max_DFS(node.next[move_dir], max_metrics)
+    if metrics.size > topx_num:
+        metrics = partition(metrics, -topx_num)[-topx_num:]
 
-    return max_metrics
+    return metrics
 
 
 # Strategy 0:
@@ -277,3 +271,122 @@ def calc_metrics3(tiles, mult_base):
             metrics.append(metric)
 
     return max(metrics)
+
+
+# Strategy 4:
+# Lookup table heuristic.  Sum of precomputed per-row and per-column tables, see HeuristicTables
+# lut is a float64 2D-array [5][65536]: a table for each row, then one for columns
+def calc_metrics4(tiles, lut):
+
+    return lut_metric_bitboard(BitBoard.from_tiles(tiles), lut)
+
+
+def lut_metric_bitboard(board, lut):
+    """calc_metrics4() of a packed board
+    :return: float"""
+
+    board_t = BitBoard.transpose(board)
+    metric = 0.0
+    for i in range(SIZE):
+        metric += lut[i][(board >> (16 * i)) & 0xFFFF]
+        metric += lut[SIZE][(board_t >> (16 * i)) & 0xFFFF]
+
+    return float(metric)
+
+
+def lut_metrics_boards(boards, lut, num_threads=1):
+    """lut_metric_bitboard() of every board, with NumPy vector lookups.  num_threads is ignored
+    :return: NumPy float64 1D-array"""
+
+    boards_t = BitBoard.transpose_boards(boards)
+    metrics = zeros(len(boards), dtype=float64)
+    for i in range(SIZE):
+        shift = uint64(16 * i)
+        metrics += lut[i][(boards >> shift) & uint64(0xFFFF)]
+        metrics += lut[SIZE][(boards_t >> shift) & uint64(0xFFFF)]
+
+    return metrics
+
+
+# calc_metricsX() selected by calc_option (0 for any unknown option)
+def tiles_metric(tiles, calc_option, mult_base):
+
+    if calc_option == 0:
+        return calc_metrics0(tiles)
+    elif calc_option == 1:
+        return calc_metrics1(tiles, mult_base)
+    elif calc_option == 2:
+        return calc_metrics2(tiles, mult_base)
+    elif calc_option == 3:
+        return calc_metrics3(tiles, mult_base)
+
+    return 0
+
+
+def calc_metric_bitboard(board, calc_option, mult_base):
+    """calc_metricsX() selected by calc_option, of a packed board (see BitBoard)"""
+
+    return tiles_metric(BitBoard.to_tiles(board), calc_option, mult_base)
+
+
+def calc_metrics_boards(boards, calc_option, mult_base, num_threads=1):
+    """calc_metric_bitboard() of every board.  num_threads is ignored (one thread)
+    :return: NumPy float64 1D-array"""
+
+    metrics = empty(len(boards), dtype=float64)
+    for i, tiles in enumerate(BitBoard.boards_to_tiles(boards)):
+        metrics[i] = tiles_metric(tiles, calc_option, mult_base)
+
+    return metrics
+
+
+def move_boards_all(boards, num_threads=1):
+    """All 4 moves of every board.  See BitBoard.move_all_boards().  num_threads is ignored"""
+
+    return BitBoard.move_all_boards(boards)
+
+
+def pack_tiles(tiles):
+    """Same as BitBoard.from_tiles()
+    :return: int. packed 64-bit board"""
+
+    return BitBoard.from_tiles(tiles)
+
+
+def move_tiles_into(direction, tiles, out):
+    """Moves tiles in 'direction', writing the result into out (may be tiles itself).
+    See GameMgr.Game.move_tiles_into()
+    :return: (valid_move: bool, score gained: int)"""
+
+    return GameMgr.Game.move_tiles_into(direction, tiles, out)
+
+
+def add_random_tile_into(tiles, rand_pos, rand_val):
+    """Adds new tile (2 or 4) to tiles in place.  rand_pos picks among the empty spots in
+    row-major order, rand_val < 0.9 gives a 2, else a 4.
+    :return: int. number of empty tiles after, or -1 if tiles was full (no tile added)"""
+
+    open_positions = [(row, col) for row in range(SIZE) for col in range(SIZE)
+                      if tiles[row][col] == 0]
+    num_empty = len(open_positions)
+
+    if num_empty == 0:
+        return -1
+
+    row, col = open_positions[int(rand_pos * num_empty)]
+    tiles[row][col] = 2 if rand_val < 0.9 else 4
+
+    return num_empty - 1
+
+
+def check_game_over(tiles):
+    """Checks tiles to see if any valid moves are left (an empty tile, or two equal neighbours)
+    :return: bool. True if game is over, False otherwise"""
+
+    if not tiles.all():
+        return False
+
+    if (tiles[:, 1:] == tiles[:, :-1]).any() or (tiles[1:, :] == tiles[:-1, :]).any():
+        return False
+
+    return True
@@ -0,0 +1,415 @@
+"""
+This file defines a packed "bitboard" representation of a (2048) game board.
+
+A board is a single unsigned 64-bit integer holding sixteen 4-bit "nibbles".
+Each nibble holds the log2 exponent of one tile (0: empty, 1: 2, 2: 4, ... 15: 32768).
+Tile (row, col) is stored in nibble (row * SIZE + col), so row 0 is the lowest 16 bits
+and col 0 is the lowest nibble of each row.
+
+The functions mirror the surface of GameMgr.Game / AutoPlayUtilsCy, but work directly on
+the packed integer, so a speculative move never copies or allocates a NumPy array.
+from_tiles() and to_tiles() convert losslessly to and from the NumPy 2D-array used by
+GameMgr.Game, the Qt UI and save files.
+
+Moves are table lookups of whole rows in the shared MoveTables.
+
+NOTE:   The largest representable tile is 32768 (exponent 15).
+        Two 32768 tiles are therefore never merged on a bitboard.
+"""
+
+from numpy import (array, arange, zeros, where, maximum, left_shift,
+                   int32, int64, intp, uint64)
+
+import MoveTables
+
+SIZE = 4
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+ROW_MASK = 0xFFFF
+MAX_EXP = 15
+
+# Python lists of the shared MoveTables.  Much faster than NumPy for single-element lookups.
+_ROW_LEFT = MoveTables.ROW_LEFT.tolist()
+_ROW_RIGHT = MoveTables.ROW_RIGHT.tolist()
+_ROW_SCORE = MoveTables.ROW_SCORE.tolist()
+_ROW_CHANGED = MoveTables.ROW_CHANGED.tolist()
+
+
+def from_tiles(tiles):
+    """
+    Pack a NumPy 2D-array (or nested list) of tile numbers into a bitboard.
+
+    :param tiles: int 2D-array [SIZE][SIZE] of tile numbers (0, 2, 4, ... 32768)
+    :return: int. packed 64-bit board
+    """
+
+    board = 0
+    for row in range(SIZE):
+        for col in range(SIZE):
+
+            val = int(tiles[row][col])
+            if val == 0:
+                continue
+
+            exp = val.bit_length() - 1
+            if val < 2 or val != (1 << exp) or exp > MAX_EXP:
+                raise ValueError(f"Tile value {val} can not be stored in a bitboard.")
+
+            board |= exp << (4 * (row * SIZE + col))
+
+    return board
+
+
+def to_tiles(board):
+    """
+    Unpack a bitboard into a new NumPy int32 2D-array of tile numbers.
+
+    :param board: int. packed 64-bit board
+    :return: NumPy int32 2D-array [SIZE][SIZE]
+    """
+
+    vals = []
+    for idx in range(SIZE * SIZE):
+        exp = (board >> (4 * idx)) & 0xF
+        vals.append(0 if exp == 0 else 1 << exp)
+
+    return array(vals, dtype=int32).reshape((SIZE, SIZE))
+
+
+def get_tile(board, row, col):
+    """Return the tile number (not exponent) at [row, col] of a bitboard."""
+
+    exp = (board >> (4 * (row * SIZE + col))) & 0xF
+    return 0 if exp == 0 else 1 << exp
+
+
+def transpose(board):
+    """Swap rows and columns of a bitboard, (row, col) --> (col, row)"""
+
+    a1 = board & 0xF0F00F0FF0F00F0F
+    a2 = board & 0x0000F0F00000F0F0
+    a3 = board & 0x0F0F00000F0F0000
+    a = a1 | (a2 << 12) | (a3 >> 12)
+
+    b1 = a & 0xFF00FF0000FF00FF
+    b2 = a & 0x00FF00FF00000000
+    b3 = a & 0x00000000FF00FF00
+
+    return b1 | (b2 >> 24) | (b3 << 24)
+
+
+def move_row_left(row):
+    """Return (row after Left move, score gained) for a packed 16-bit row, via MoveTables."""
+
+    return _ROW_LEFT[row], _ROW_SCORE[row]
+
+
+def move_row_right(row):
+    """Return (row after Right move, score gained) for a packed 16-bit row, via MoveTables."""
+
+    return _ROW_RIGHT[row], _ROW_SCORE[row]
+
+
+def _move_rows(board, table):
+
+    row0 = board & ROW_MASK
+    row1 = (board >> 16) & ROW_MASK
+    row2 = (board >> 32) & ROW_MASK
+    row3 = board >> 48
+
+    board2 = table[row0] | (table[row1] << 16) | (table[row2] << 32) | (table[row3] << 48)
+    score = _ROW_SCORE[row0] + _ROW_SCORE[row1] + _ROW_SCORE[row2] + _ROW_SCORE[row3]
+
+    return board2, score
+
+
+def move_tiles(direction, board, score):
+    """
+    Moves tiles of a bitboard in the 'direction' specified per 2048 game rules.
+    Counterpart of AutoPlayUtilsCy.move_tiles()
+
+    :param direction: int 0-3. specifies move direction (0: Up, 1: Right, 2: Down, 3: Left)
+    :param board: int. packed 64-bit board
+    :param score: int. score before the move
+    :return: (valid_move: bool, board2: int, score2: int)
+    """
+
+    if direction == 0:      # Up: columns are rows of the transposed board
+        board2, gained = _move_rows(transpose(board), _ROW_LEFT)
+        board2 = transpose(board2)
+    elif direction == 1:    # Right
+        board2, gained = _move_rows(board, _ROW_RIGHT)
+    elif direction == 2:    # Down
+        board2, gained = _move_rows(transpose(board), _ROW_RIGHT)
+        board2 = transpose(board2)
+    elif direction == 3:    # Left
+        board2, gained = _move_rows(board, _ROW_LEFT)
+    else:
+        raise ValueError("'direction' value invalid.  Must be 0-3.")
+
+    return board2 != board, board2, score + gained
+
+
+def move_all(board):
+    """
+    All 4 moves of a bitboard in one call.  Rows and columns are extracted once, and the
+    score of each row is shared by both directions (see MoveTables.ROW_SCORE).
+
+    :param board: int. packed 64-bit board
+    :return: (valid_mask: int, boards2: tuple of 4 int, gained: tuple of 4 int)
+             boards2 and gained are indexed by direction.  Bit d of valid_mask is set
+             if move d is valid.
+    """
+
+    board_t = transpose(board)
+    rows = (board & ROW_MASK, (board >> 16) & ROW_MASK, (board >> 32) & ROW_MASK, board >> 48)
+    cols = (board_t & ROW_MASK, (board_t >> 16) & ROW_MASK, (board_t >> 32) & ROW_MASK, board_t >> 48)
+
+    left = _ROW_LEFT[rows[0]] | (_ROW_LEFT[rows[1]] << 16) | \
+        (_ROW_LEFT[rows[2]] << 32) | (_ROW_LEFT[rows[3]] << 48)
+    right = _ROW_RIGHT[rows[0]] | (_ROW_RIGHT[rows[1]] << 16) | \
+        (_ROW_RIGHT[rows[2]] << 32) | (_ROW_RIGHT[rows[3]] << 48)
+    up = transpose(_ROW_LEFT[cols[0]] | (_ROW_LEFT[cols[1]] << 16) |
+                   (_ROW_LEFT[cols[2]] << 32) | (_ROW_LEFT[cols[3]] << 48))
+    down = transpose(_ROW_RIGHT[cols[0]] | (_ROW_RIGHT[cols[1]] << 16) |
+                     (_ROW_RIGHT[cols[2]] << 32) | (_ROW_RIGHT[cols[3]] << 48))
+
+    row_score = _ROW_SCORE[rows[0]] + _ROW_SCORE[rows[1]] + _ROW_SCORE[rows[2]] + _ROW_SCORE[rows[3]]
+    col_score = _ROW_SCORE[cols[0]] + _ROW_SCORE[cols[1]] + _ROW_SCORE[cols[2]] + _ROW_SCORE[cols[3]]
+
+    valid_mask = (up != board) | ((right != board) << 1) | ((down != board) << 2) | ((left != board) << 3)
+
+    return valid_mask, (up, right, down, left), (col_score, row_score, col_score, row_score)
+
+
+def count_empty(board):
+    """Return the number of empty tiles (zero nibbles) on a bitboard."""
+
+    # Collapse each nibble onto its lowest bit, then count the nibbles with no bits set
+    x = board | ((board >> 2) & 0x3333333333333333)
+    x |= x >> 1
+    x = ~x & 0x1111111111111111
+
+    return bin(x).count("1")
+
+
+def max_tile(board):
+    """Return the largest tile number on a bitboard."""
+
+    max_exp = 0
+    while board:
+        max_exp = max(max_exp, board & 0xF)
+        board >>= 4
+
+    return 0 if max_exp == 0 else 1 << max_exp
+
+
+def count_distinct(board):
+    """Return the number of distinct tile numbers (excluding empty) on a bitboard."""
+
+    exps = set()
+    while board:
+        exps.add(board & 0xF)
+        board >>= 4
+    exps.discard(0)
+
+    return len(exps)
+
+
+def add_random_tile(board, rands, rand_idx):
+    """
+    Adds new tile (2 or 4) to a random empty spot of a bitboard, if available.
+    Counterpart of AutoPlayUtilsCy.add_random_tile().  Given the same board and
+    random numbers, both place the same tile in the same position.
+
+    :param board: int. packed 64-bit board
+    :param rands: indexable of random floats [0.0, 1.0)
+    :param rand_idx: int. index of next unused number in rands
+    :return: (board2: int, num_empty: int, rand_idx: int)
+    """
+
+    open_positions = [idx for idx in range(SIZE * SIZE) if ((board >> (4 * idx)) & 0xF) == 0]
+    num_empty = len(open_positions)
+
+    if num_empty == 0:
+        return board, num_empty, rand_idx
+
+    pos = open_positions[int(rands[rand_idx] * num_empty)]
+    rand_idx += 1
+
+    exp = 1 if (rands[rand_idx] < 0.9) else 2
+    rand_idx += 1
+
+    return board | (exp << (4 * pos)), num_empty - 1, rand_idx
+
+
+def check_game_over(board):
+    """Checks a bitboard to see if any valid moves are left.
+    :return: bool. True if game is over, False, otherwise"""
+
+    if count_empty(board) > 0:
+        return False
+
+    # Left/Right valid on rows, Up/Down valid on transposed rows
+    board_t = transpose(board)
+    for direction_board in (board, board_t):
+        for row_idx in range(SIZE):
+            if _ROW_CHANGED[(direction_board >> (16 * row_idx)) & ROW_MASK]:
+                return False
+
+    return True
+
+
+# ------------------------------
+# Vectorized versions.  Operate elementwise on NumPy uint64 1D-arrays of packed boards.
+
+_NIBBLE_SHIFTS = arange(0, 4 * SIZE * SIZE, 4, dtype=uint64)
+_ROW_SHIFTS = (uint64(0), uint64(16), uint64(32), uint64(48))
+
+
+def transpose_boards(boards):
+    """Vectorized transpose().  :param boards: NumPy uint64 1D-array"""
+
+    a1 = boards & uint64(0xF0F00F0FF0F00F0F)
+    a2 = boards & uint64(0x0000F0F00000F0F0)
+    a3 = boards & uint64(0x0F0F00000F0F0000)
+    a = a1 | (a2 << uint64(12)) | (a3 >> uint64(12))
+
+    b1 = a & uint64(0xFF00FF0000FF00FF)
+    b2 = a & uint64(0x00FF00FF00000000)
+    b3 = a & uint64(0x00000000FF00FF00)
+
+    return b1 | (b2 >> uint64(24)) | (b3 << uint64(24))
+
+
+def _move_rows_boards(boards, table):
+
+    boards2 = zeros(boards.shape, dtype=uint64)
+    gained = zeros(boards.shape, dtype=int64)
+
+    for shift in _ROW_SHIFTS:
+        rows = ((boards >> shift) & uint64(ROW_MASK)).astype(intp)
+        boards2 |= table[rows].astype(uint64) << shift
+        gained += MoveTables.ROW_SCORE[rows]
+
+    return boards2, gained
+
+
+def move_boards(direction, boards):
+    """
+    Vectorized move_tiles().  Moves every board in the same 'direction'.
+
+    :param direction: int 0-3. (0: Up, 1: Right, 2: Down, 3: Left)
+    :param boards: NumPy uint64 1D-array of packed boards
+    :return: (valid: bool array, boards2: uint64 array, gained: int64 array of score gained)
+    """
+
+    if direction == 0:
+        boards2, gained = _move_rows_boards(transpose_boards(boards), MoveTables.ROW_LEFT)
+        boards2 = transpose_boards(boards2)
+    elif direction == 1:
+        boards2, gained = _move_rows_boards(boards, MoveTables.ROW_RIGHT)
+    elif direction == 2:
+        boards2, gained = _move_rows_boards(transpose_boards(boards), MoveTables.ROW_RIGHT)
+        boards2 = transpose_boards(boards2)
+    elif direction == 3:
+        boards2, gained = _move_rows_boards(boards, MoveTables.ROW_LEFT)
+    else:
+        raise ValueError("'direction' value invalid.  Must be 0-3.")
+
+    return boards2 != boards, boards2, gained
+
+
+def move_all_boards(boards):
+    """
+    Vectorized move_all().  All 4 moves of every board.
+
+    :param boards: NumPy uint64 1D-array [N] of packed boards
+    :return: (valid: bool 2D-array [N][4], boards2: uint64 2D-array [N][4],
+              gained: int64 2D-array [N][4]) indexed by [board, direction]
+    """
+
+    boards_t = transpose_boards(boards)
+    boards2 = zeros((boards.shape[0], 4), dtype=uint64)
+    row_score = zeros(boards.shape, dtype=int64)
+    col_score = zeros(boards.shape, dtype=int64)
+
+    for shift in _ROW_SHIFTS:
+        rows = ((boards >> shift) & uint64(ROW_MASK)).astype(intp)
+        cols = ((boards_t >> shift) & uint64(ROW_MASK)).astype(intp)
+
+        boards2[:, 0] |= MoveTables.ROW_LEFT[cols].astype(uint64) << shift
+        boards2[:, 1] |= MoveTables.ROW_RIGHT[rows].astype(uint64) << shift
+        boards2[:, 2] |= MoveTables.ROW_RIGHT[cols].astype(uint64) << shift
+        boards2[:, 3] |= MoveTables.ROW_LEFT[rows].astype(uint64) << shift
+
+        row_score += MoveTables.ROW_SCORE[rows]
+        col_score += MoveTables.ROW_SCORE[cols]
+
+    boards2[:, 0] = transpose_boards(boards2[:, 0])
+    boards2[:, 2] = transpose_boards(boards2[:, 2])
+
+    gained = zeros((boards.shape[0], 4), dtype=int64)
+    gained[:, 0::2] = col_score[:, None]
+    gained[:, 1::2] = row_score[:, None]
+
+    return boards2 != boards[:, None], boards2, gained
+
+
+def empty_cells(boards):
+    """Return NumPy bool 2D-array [N][16], True where nibble (row * SIZE + col) is empty."""
+
+    return ((boards[:, None] >> _NIBBLE_SHIFTS) & uint64(0xF)) == 0
+
+
+def count_empty_boards(boards):
+    """Vectorized count_empty().  :return: NumPy int array [N]"""
+
+    return empty_cells(boards).sum(axis=1)
+
+
+def add_random_tiles(boards, rand_pos, rand_val):
+    """
+    Vectorized add_random_tile().  Adds one tile to each board with an empty spot.
+    Uses the same rules as add_random_tile(): rand_pos picks among the empty spots
+    in row-major order, and rand_val < 0.9 gives a 2, else a 4.
+
+    :param boards: NumPy uint64 1D-array of packed boards
+    :param rand_pos: NumPy float 1D-array [N] of random floats [0.0, 1.0)
+    :param rand_val: NumPy float 1D-array [N] of random floats [0.0, 1.0)
+    :return: (boards2: uint64 array, num_empty: int array) num_empty is AFTER the new tile
+    """
+
+    empty = empty_cells(boards)
+    num_empty = empty.sum(axis=1)
+
+    # The chosen spot is the first nibble where the running count of empties passes the target
+    target = (rand_pos * num_empty).astype(intp)
+    pos = (empty.cumsum(axis=1) > target[:, None]).argmax(axis=1)
+
+    exps = where(rand_val < 0.9, 1, 2).astype(uint64)
+    new_tiles = where(num_empty > 0, exps << (uint64(4) * pos.astype(uint64)), uint64(0))
+
+    return boards | new_tiles, maximum(num_empty - 1, 0)
+
+
+def check_game_over_boards(boards):
+    """Vectorized check_game_over().  :return: NumPy bool array [N], True if game over"""
+
+    can_move = count_empty_boards(boards) > 0
+
+    for direction_boards in (boards, transpose_boards(boards)):
+        for shift in _ROW_SHIFTS:
+            rows = ((direction_boards >> shift) & uint64(ROW_MASK)).astype(intp)
+            can_move |= MoveTables.ROW_CHANGED[rows] != 0
+
+    return ~can_move
+
+
+def boards_to_tiles(boards):
+    """Vectorized to_tiles().  :return: NumPy int32 3D-array [N][SIZE][SIZE] of tile numbers"""
+
+    exps = ((boards[:, None] >> _NIBBLE_SHIFTS) & uint64(0xF)).astype(int32)
+    tiles = where(exps == 0, 0, left_shift(1, exps)).astype(int32)
+
+    return tiles.reshape((-1, SIZE, SIZE))
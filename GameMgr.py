@@ -3,14 +3,24 @@
 This file defines the core functionality of a (2048) game.
 The Game class holds the basic state data of a game, and the methods to "move".
 It is designed to used by separate modules implementing UI and AutoPlay functionality.
+
+The GameBatch class holds many games at once, and moves all of them with NumPy vector operations.
 """
 
-from numpy import zeros, array, random, int32, argwhere
-from copy import deepcopy
+from numpy import zeros, array, random, int32, int64, uint64, argwhere, flatnonzero
 # import pprint
 
+import BitBoard
+
 SIZE = 4
 
+# (row, col) of the tiles of each line moved by move_tiles_into(), in the order they
+# slide: first cell is where the line's tiles move towards.  Indexed by direction
+_MOVE_LINES = ([[(row, idx) for row in range(SIZE)] for idx in range(SIZE)],                 # Up
+               [[(idx, col) for col in range(SIZE - 1, -1, -1)] for idx in range(SIZE)],    # Right
+               [[(row, idx) for row in range(SIZE - 1, -1, -1)] for idx in range(SIZE)],    # Down
+               [[(idx, col) for col in range(SIZE)] for idx in range(SIZE)])                # Left
+
 
 class Game(object):
     """
@@ -27,6 +37,9 @@ class Game(object):
         Moves tiles in the direction specified per 2048 game rules.
         If (commit == False) , does NOT change internal game state (for speculative moves)
 
+    - move_tiles_into(direction, tiles, out)
+        Lean speculative move: writes the moved tiles into out, returns (valid, score gained)
+
     - add_random_tile(commit, tiles=None, rands=None, rand_idx=None)
         Adds a random tile (2 or 4) to an open position in the 2D-array.
         If (commit == False), does NOT change internal game state (for speculative moves)
@@ -35,6 +48,9 @@ class Game(object):
     check_game_over(tiles)
         Checks if any remaining valid moves are left.  Returns True if game over, else False
         Called by add_random_tile().
+
+    - get_bitboard() / set_bitboard(board)
+        Convert the current tiles to / from the packed 64-bit BitBoard representation.
     """
 
     def __init__(self, ui, tiles=None, score=0, num_moves=0):
@@ -91,7 +107,7 @@ class Game(object):
         ----- Return -----
         :returns:
         valid_move: bool
-        tile_move_vect: list( int[n][n][2] ) for ui.animate_tiles()
+        tile_move_vect: list( int[n][n][2] ) for ui.animate_tiles(). None, unless called by UI
         tiles2: NumPy int 2D-array of the tile numbers AFTER move
         score2: int of new score after move
         """
@@ -99,6 +115,21 @@ class Game(object):
         if not isinstance(direction, int):
             raise TypeError("Game.move_tiles() direction is not int.")
 
+        # Without UI, no animation data is needed.  Use the lean version
+        if not (commit and self.ui):
+            tiles2 = self.tiles.copy() if (tiles is None) else tiles.copy()
+            valid_move, delta = self.move_tiles_into(direction, tiles2, tiles2)
+            score2 = (self.score if (score is None) else score) + delta
+
+            if commit:
+                self.last_move_valid = valid_move
+                if valid_move:
+                    self.tiles = tiles2
+                    self.score = score2
+                    self.num_moves += 1
+
+            return valid_move, None, tiles2, score2
+
         # Create vectors for animate_tiles()
         tile_move_vect = [[[0, 0] for _ in range(SIZE)] for __ in range(SIZE)]
 
@@ -117,7 +148,7 @@ class Game(object):
             tiles2 = tiles.copy()
 
         # If this is a speculative move, score may be provided
-        score2 = deepcopy(self.score) if (score is None) else deepcopy(score)
+        score2 = self.score if (score is None) else score
 
         valid_move = False
 
@@ -215,6 +246,48 @@ class Game(object):
 
         return valid_move, tile_move_vect, tiles2, score2
 
+    @staticmethod
+    def move_tiles_into(direction, tiles, out):
+        """
+        Lean move_tiles() for speculative moves.  No UI support, no copies of tiles.
+
+        :param direction: int 0-3. specifies move direction (0: Up, 1: Right, 2: Down, 3: Left)
+        :param tiles: NumPy int 2D-array. Not changed, unless it is also out
+        :param out: NumPy int 2D-array. Receives the tiles after the move. May be tiles itself
+        :return: (valid_move: bool, delta: int score gained)
+        """
+
+        if direction not in (0, 1, 2, 3):
+            raise ValueError("'direction' value invalid.  Must be 0-3.")
+
+        valid_move = False
+        delta = 0
+
+        for line in _MOVE_LINES[direction]:
+
+            vals = [int(tiles[row, col]) for row, col in line]
+            packed = [val for val in vals if val != 0]
+
+            # Slide tiles together, then merge equal neighbors once, from the front
+            merged = []
+            idx = 0
+            while idx < len(packed):
+                if idx + 1 < len(packed) and packed[idx] == packed[idx + 1]:
+                    merged.append(2 * packed[idx])
+                    delta += 2 * packed[idx]
+                    idx += 2
+                else:
+                    merged.append(packed[idx])
+                    idx += 1
+            merged.extend([0] * (SIZE - len(merged)))
+
+            if merged != vals:
+                valid_move = True
+
+            for (row, col), val in zip(line, merged):
+                out[row, col] = val
+
+        return valid_move, delta
 
     def add_random_tile(self, commit, tiles=None, rands=None, rand_idx=None):
         """
@@ -286,12 +359,152 @@ class Game(object):
         :param tiles: Numpy int 2D-array.
         :return: bool. True if game is over, False, otherwise"""
 
-        up_valid, _, _, _ = self.move_tiles(0, False, tiles)
-        right_valid, _, _, _ = self.move_tiles(1, False, tiles)
-        down_valid, _, _, _ = self.move_tiles(2, False, tiles)
-        left_valid, _, _, _ = self.move_tiles(3, False, tiles)
+        # A move is valid if there is an empty tile, or two equal neighbours (row or column).
+        # Compares tile numbers, without making any of the 4 moves.  Not a packed BitBoard:
+        # those can't hold tiles >= 65536, and their row tables don't merge two 32768s
+        if not tiles.all():
+            return False
 
-        if any([up_valid, right_valid, down_valid, left_valid]):
+        if (tiles[:, 1:] == tiles[:, :-1]).any() or (tiles[1:, :] == tiles[:-1, :]).any():
             return False
 
         return True
+
+    def get_bitboard(self):
+        """Returns the current tiles packed into a 64-bit int (see BitBoard)"""
+
+        return BitBoard.from_tiles(self.tiles)
+
+    def set_bitboard(self, board):
+        """Replaces the current tiles with the tiles of a packed 64-bit BitBoard int.
+        Also updates num_empty.  Does NOT update score or game_over."""
+
+        self.tiles = BitBoard.to_tiles(board)
+        self.num_empty = BitBoard.count_empty(board)
+
+
+class GameBatch(object):
+    """
+    Object to hold the data of N games, and move all of them at once.
+
+    Boards are packed 64-bit BitBoards, one NumPy uint64 per game, so every operation
+    is a NumPy vector operation over the whole batch.  No UI, and no speculative moves.
+
+    ----- Attributes -----
+    - boards : NumPy uint64 1D-array [N] of packed boards (see BitBoard)
+    - scores, num_moves : NumPy int64 1D-arrays [N]
+    - num_empty : NumPy int64 1D-array [N]
+    - game_over : NumPy bool 1D-array [N]
+    - rand : a NumPy random Generator
+
+    ----- Methods -----
+    - step(directions)
+        Moves each game in its own direction, adds a random tile to each game that moved,
+        and flags the games that are over.
+
+    - add_random_tiles(idxs=None)
+        Adds a random tile (2 or 4) to the games at idxs (default: all games)
+
+    - valid_moves()
+        Returns bool 2D-array [N][4] of which directions are valid for each game.
+
+    - get_game(idx)
+        Returns a GameMgr.Game copy of a single game, e.g. for display or AutoPlayer
+    """
+
+    def __init__(self, num_games, boards=None, rand=None):
+        """
+        :param num_games: int. number of games (N) in the batch
+        :param boards: NumPy uint64 1D-array [N]. default None --> all empty boards
+        :param rand: Numpy random Generator. Default None --> new Generator created
+        """
+
+        if boards is None:
+            self.boards = zeros(num_games, dtype=uint64)
+        else:
+            self.boards = array(boards, dtype=uint64)
+
+        self.scores = zeros(num_games, dtype=int64)
+        self.num_moves = zeros(num_games, dtype=int64)
+        self.num_empty = BitBoard.count_empty_boards(self.boards).astype(int64)
+        self.game_over = zeros(num_games, dtype=bool)
+
+        self.rand = random.default_rng() if (rand is None) else rand
+
+    def __len__(self):
+        return self.boards.size
+
+    def __repr__(self):
+
+        return ("-"*30 + "\n" +
+                f"Game Batch: {len(self)} games | Over: {int(self.game_over.sum())} | " +
+                f"Max Score: {int(self.scores.max(initial=0))} | " +
+                f"Total Moves: {int(self.num_moves.sum())}\n")
+
+    def add_random_tiles(self, idxs=None):
+        """
+        Adds new tile to an empty spot of each game at idxs, if available.
+
+        :param idxs: NumPy int 1D-array of game indices. default None --> all games not over
+        """
+
+        if idxs is None:
+            idxs = flatnonzero(~self.game_over)
+
+        rands = self.rand.random((2, idxs.size))
+        self.boards[idxs], num_empty = BitBoard.add_random_tiles(self.boards[idxs], rands[0], rands[1])
+        self.num_empty[idxs] = num_empty
+
+        # Games can only be over if the board is full
+        full = idxs[num_empty == 0]
+        self.game_over[full] = BitBoard.check_game_over_boards(self.boards[full])
+
+    def step(self, directions):
+        """
+        Moves every unfinished game in its own direction, adds a random tile to each game
+        that moved, and updates scores, num_moves, num_empty and game_over.
+        Invalid moves leave a game unchanged (as in Game.move_tiles)
+
+        :param directions: NumPy int 1D-array [N] of directions 0-3 (0: Up, 1: Right, 2: Down, 3: Left)
+        :return: NumPy bool 1D-array [N]. True for each game that moved
+        """
+
+        directions = array(directions)
+        valid = zeros(len(self), dtype=bool)
+
+        for direction in range(4):
+
+            idxs = flatnonzero((directions == direction) & ~self.game_over)
+            if idxs.size == 0:
+                continue
+
+            moved, boards2, gained = BitBoard.move_boards(direction, self.boards[idxs])
+            idxs = idxs[moved]
+
+            self.boards[idxs] = boards2[moved]
+            self.scores[idxs] += gained[moved]
+            valid[idxs] = True
+
+        self.num_moves[valid] += 1
+        self.add_random_tiles(flatnonzero(valid))
+
+        return valid
+
+    def valid_moves(self):
+        """:return: NumPy bool 2D-array [N][4]. True where a direction is a valid move"""
+
+        valid = zeros((len(self), 4), dtype=bool)
+        for direction in range(4):
+            valid[:, direction], _, _ = BitBoard.move_boards(direction, self.boards)
+
+        return valid
+
+    def get_game(self, idx):
+        """:return: a new GameMgr.Game (without UI) holding a copy of game idx"""
+
+        game = Game(None, BitBoard.to_tiles(int(self.boards[idx])),
+                    int(self.scores[idx]), int(self.num_moves[idx]))
+        game.num_empty = int(self.num_empty[idx])
+        game.game_over = bool(self.game_over[idx])
+
+        return game
@@ -0,0 +1,131 @@
+"""
+This file holds the precomputed row tables of the lookup table heuristic (calc_option 4).
+
+The heuristic is a sum of per-line components.  Each component only depends on the 4 tiles
+of one row or column, so it is computed once for every one of the 65536 possible packed
+16-bit lines (see MoveTables for the packing), and stored in a NumPy array indexed by line:
+
+- EMPTY[line]        : number of empty tiles
+- MERGES[line]       : number of merges a move along the line would make (merge potential)
+- MONOTONICITY[line] : penalty for tiles not sorted in either direction.  The smaller of the
+                       sums of increases and of decreases along the line, of exp**MONO_POWER
+- SMOOTHNESS[line]   : penalty for unequal neighbours.  Sum of |exp difference| of adjacent
+                       non-empty tiles
+- SNAKE[r][line]     : tile numbers weighted along a "snake" anchored in the upper-right
+                       corner, if line is row r.  Weights fall by mult_base per snake step
+
+build_lut() combines the components with a dict of weights (see LUT_WEIGHTS) into LUT,
+a float64 2D-array [5][65536]: LUT[r] for row r (line components + SNAKE[r]), and
+LUT[4] for any column.  A board's metric is then 8 lookups (4 rows + 4 columns) and a sum.
+Changing weights only needs a new build_lut(), which is a handful of NumPy vector operations.
+"""
+
+from numpy import arange, zeros, minimum, abs as np_abs, float64, uint32
+
+import MoveTables
+
+SIZE = 4
+NUM_ROWS = 65536
+LUT_ROWS = SIZE + 1     # 4 row tables + 1 column table
+
+# Monotonicity compares exp**MONO_POWER, so disorder among large tiles costs more
+MONO_POWER = 4.0
+
+# Default weight of each component.  Penalties have negative weights
+LUT_WEIGHTS = {"empty": 270.0, "merges": 700.0, "monotonicity": -47.0,
+               "smoothness": -10.0, "snake": 1.0}
+
+# Every table of LUT is shifted so its smallest entry is LUT_FLOOR.  Metrics are then always
+# > 0, like the other calc_options, which AutoPlayer relies on (0 and negative are special).
+# A constant shift doesn't change which move is best.
+LUT_FLOOR = 1.0
+
+# Snake rank (15 = corner) of each (row, col)
+SNAKE_RANKS = ((12, 13, 14, 15),
+               (11, 10, 9, 8),
+               (4, 5, 6, 7),
+               (3, 2, 1, 0))
+
+
+def line_exps():
+    """:return: NumPy uint32 2D-array [65536][4]. the 4 exponents of every packed line"""
+
+    lines = arange(NUM_ROWS, dtype=uint32)
+    exps = zeros((NUM_ROWS, SIZE), dtype=uint32)
+    for i in range(SIZE):
+        exps[:, i] = (lines >> (4 * i)) & 0xF
+
+    return exps
+
+
+def build_components():
+    """Compute the line components from scratch.
+    :return: (EMPTY, MERGES, MONOTONICITY, SMOOTHNESS) NumPy float64 1D-arrays of length 65536"""
+
+    exps = line_exps()
+    nonzero = exps != 0
+
+    empty = (~nonzero).sum(axis=1).astype(float64)
+
+    # Each merge of a left move removes one tile from the line
+    tiles_after = line_exps()[MoveTables.ROW_LEFT.astype(uint32)] != 0
+    merges = (nonzero.sum(axis=1) - tiles_after.sum(axis=1)).astype(float64)
+
+    powers = exps.astype(float64) ** MONO_POWER
+    steps = powers[:, 1:] - powers[:, :-1]
+    increases = steps.clip(min=0).sum(axis=1)
+    decreases = (-steps).clip(min=0).sum(axis=1)
+    monotonicity = minimum(increases, decreases)
+
+    both = nonzero[:, 1:] & nonzero[:, :-1]
+    diffs = np_abs(exps[:, 1:].astype(float64) - exps[:, :-1].astype(float64))
+    smoothness = (diffs * both).sum(axis=1)
+
+    return empty, merges, monotonicity, smoothness
+
+
+def build_snake(mult_base):
+    """:return: NumPy float64 2D-array [4][65536]. SNAKE[r][line], for this mult_base"""
+
+    exps = line_exps()
+    tiles = (1 << exps) * (exps != 0)
+
+    snake = zeros((SIZE, NUM_ROWS), dtype=float64)
+    for row in range(SIZE):
+        for col in range(SIZE):
+            weight = float(mult_base) ** (SNAKE_RANKS[row][col] - 15)
+            snake[row] += tiles[:, col] * weight
+
+    return snake
+
+
+def build_lut(weights=None, mult_base=1.5):
+    """
+    Combine the components into the lookup tables of one set of weights.
+
+    :param weights: dict of component name --> weight.  Missing names use LUT_WEIGHTS.
+                    None --> LUT_WEIGHTS
+    :param mult_base: float > 0.  snake weights fall by this factor per step from the corner
+    :return: NumPy float64 C-contiguous 2D-array [5][65536].  [0-3]: row tables, [4]: column table
+    """
+
+    weights = dict(LUT_WEIGHTS, **(weights or {}))
+    unknown = set(weights) - set(LUT_WEIGHTS)
+    if unknown:
+        raise ValueError(f"Unknown LUT weights {sorted(unknown)}. Must be in {list(LUT_WEIGHTS)}.")
+
+    line = (weights["empty"] * EMPTY + weights["merges"] * MERGES +
+            weights["monotonicity"] * MONOTONICITY + weights["smoothness"] * SMOOTHNESS)
+
+    lut = zeros((LUT_ROWS, NUM_ROWS), dtype=float64)
+    snake = build_snake(mult_base)
+    for row in range(SIZE):
+        lut[row] = line + weights["snake"] * snake[row]
+    lut[SIZE] = line
+
+    lut -= lut.min(axis=1, keepdims=True) - LUT_FLOOR
+
+    return lut
+
+
+EMPTY, MERGES, MONOTONICITY, SMOOTHNESS = build_components()
@@ -0,0 +1,142 @@
+"""
+This file holds precomputed row transition tables shared by all move implementations.
+
+A row of the board is packed into 16 bits: four 4-bit log2 exponents, nibble 0 first
+(see BitBoard for the full board layout).  Every one of the 65536 possible rows is
+slid and merged once, and the results are stored in NumPy arrays indexed by the packed row:
+
+- ROW_LEFT[row]    : uint16. the row after a move towards nibble 0 (Left, or Up if transposed)
+- ROW_RIGHT[row]   : uint16. the row after a move towards nibble 3 (Right, or Down if transposed)
+- ROW_SCORE[row]   : uint32. the score gained (same for either direction)
+- ROW_CHANGED[row] : uint8. bit flags CHANGED_LEFT / CHANGED_RIGHT if the move changes the row
+
+Up and Down moves use the same tables on the transposed board, so a whole board move
+is four table lookups.
+
+The tables are built at import, or loaded from CACHE_FILE if it was saved by an earlier import.
+"""
+
+import os
+from zipfile import BadZipFile
+from numpy import arange, array, load, savez, uint8, uint16, uint32
+
+SIZE = 4
+NUM_ROWS = 65536
+MAX_EXP = 15
+
+CHANGED_LEFT = 1
+CHANGED_RIGHT = 2
+
+# Bump if the table contents ever change, so stale cache files are rebuilt
+TABLES_VERSION = 1
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "MoveTables.npz")
+
+
+def reverse_row(row):
+    """Reverse the order of the four nibbles in a packed 16-bit row.
+    Works on an int, or elementwise on a NumPy integer array."""
+
+    return ((row >> 12) | ((row >> 4) & 0x00F0) |
+            ((row << 4) & 0x0F00) | ((row << 12) & 0xF000))
+
+
+def move_row_left(row):
+    """
+    Slide and merge a single packed 16-bit row towards nibble 0, per 2048 game rules.
+    Only used to build the tables.  Use ROW_LEFT / ROW_SCORE for lookups.
+
+    NOTE:   Two 32768 tiles (exponent 15) are never merged. There is no room for exponent 16.
+
+    :param row: int. packed 16-bit row (4 exponents)
+    :return: (int, int). the packed row after the move, and the score gained
+    """
+
+    tiles = [(row >> (4 * i)) & 0xF for i in range(SIZE)]
+    tiles = [exp for exp in tiles if exp != 0]
+
+    out = []
+    score = 0
+    i = 0
+    while i < len(tiles):
+
+        # Equal neighbors merge once
+        if i + 1 < len(tiles) and tiles[i] == tiles[i + 1] and tiles[i] < MAX_EXP:
+            out.append(tiles[i] + 1)
+            score += 1 << (tiles[i] + 1)
+            i += 2
+        else:
+            out.append(tiles[i])
+            i += 1
+
+    row2 = 0
+    for i, exp in enumerate(out):
+        row2 |= exp << (4 * i)
+
+    return row2, score
+
+
+def build_tables():
+    """Compute all four tables from scratch.
+    :return: (ROW_LEFT, ROW_RIGHT, ROW_SCORE, ROW_CHANGED) NumPy 1D-arrays of length 65536"""
+
+    left = []
+    score = []
+    for row in range(NUM_ROWS):
+        row2, row_score = move_row_left(row)
+        left.append(row2)
+        score.append(row_score)
+
+    rows = arange(NUM_ROWS, dtype=uint32)
+    row_left = array(left, dtype=uint32)
+    row_score = array(score, dtype=uint32)
+
+    # A right move is a left move of the reversed row, reversed back
+    row_right = reverse_row(row_left[reverse_row(rows)])
+
+    row_changed = ((row_left != rows) * CHANGED_LEFT) | ((row_right != rows) * CHANGED_RIGHT)
+
+    return (row_left.astype(uint16), row_right.astype(uint16),
+            row_score, row_changed.astype(uint8))
+
+
+def _load_cache(filename):
+
+    try:
+        with load(filename) as data:
+            if int(data["version"]) != TABLES_VERSION:
+                return None
+            tables = (data["row_left"], data["row_right"], data["row_score"], data["row_changed"])
+    except (OSError, EOFError, KeyError, ValueError, BadZipFile):
+        return None
+
+    if any(table.shape != (NUM_ROWS,) for table in tables):
+        return None
+
+    return tables
+
+
+def load_tables(filename=CACHE_FILE):
+    """Load tables from cache file if valid, otherwise build them and try to save the cache.
+    :return: (ROW_LEFT, ROW_RIGHT, ROW_SCORE, ROW_CHANGED)"""
+
+    tables = _load_cache(filename)
+    if tables is not None:
+        return tables
+
+    tables = build_tables()
+
+    # Cache is only an optimization. Read-only install directories are fine.
+    # Write to a temp file first, so parallel processes never load a partial cache.
+    temp_name = f"{filename}.{os.getpid()}.tmp"
+    try:
+        with open(temp_name, "wb") as file1:
+            savez(file1, version=TABLES_VERSION, row_left=tables[0], row_right=tables[1],
+                  row_score=tables[2], row_changed=tables[3])
+        os.replace(temp_name, filename)
+    except OSError:
+        pass
+
+    return tables
+
+
+ROW_LEFT, ROW_RIGHT, ROW_SCORE, ROW_CHANGED = load_tables()
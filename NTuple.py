@@ -0,0 +1,425 @@
+"""
+This file contains an n-tuple network board evaluator (calc_option 5), and its TD learning.
+- NTupleNetwork
+- td_train_game()
+- play_episodes(), td_update_episode() : self play in worker processes, learning in batches
+
+An n-tuple is a fixed set of n board cells.  The exponents of its n tiles (4 bits each) index
+a table of 16**n float32 weights.  Each tuple is applied to all 8 symmetries of the board
+(rotations and reflections), all sharing the one table, and the value of a board is the sum of
+the 8 * (number of tuples) weights looked up.  So one evaluation is a few dozen lookups.
+
+Weights are learned by self play with temporal difference (TD) learning, as the value of an
+"afterstate" (board after a move, before its random tile): the expected score still to come.
+
+Weight files are NumPy .npy files of float32 [num_tuples][16**n], opened memory-mapped, so
+large networks load instantly and are shared by all processes reading them.  The tuples
+are saved next to the weights, in a .json file of the same name.
+"""
+
+import json
+import os
+from numpy import add, array, load, save, zeros, float32, int32, uint64
+from numpy.random import default_rng
+from numpy.lib.format import open_memmap
+
+import BitBoard
+
+SIZE = 4
+
+# Tuples are lists of cell indices, row * 4 + col (the nibble of the cell in a BitBoard)
+
+# Five 4-tuples: outer and inner rows, and three 2x2 squares.  5 * 65536 weights (1.3 MB)
+TUPLES_4 = ((0, 1, 2, 3), (4, 5, 6, 7), (0, 1, 4, 5), (1, 2, 5, 6), (5, 6, 9, 10))
+
+# Four 6-tuples (two 2x3 "L" shapes and two 2x3 rectangles).  4 * 16**6 weights (268 MB)
+TUPLES_6 = ((0, 1, 2, 3, 4, 5), (4, 5, 6, 7, 8, 9), (0, 1, 2, 4, 5, 6), (4, 5, 6, 8, 9, 10))
+
+# Learning rate of td_train_game(), per looked up weight
+TD_ALPHA = 0.0025
+
+# Board values are clamped to >= 0, then shifted by NTUPLE_FLOOR when used as a metric.
+# AutoPlayer relies on metrics > 0 (0 and negative are special), and early in training
+# values can be negative.
+NTUPLE_FLOOR = 1.0
+
+
+def symmetric_cells(cells):
+    """:return: list of the 8 tuples of cells, cells mapped by each board symmetry"""
+
+    out = []
+    for transposed in (False, True):
+        for flip_rows in (False, True):
+            for flip_cols in (False, True):
+                mapped = []
+                for cell in cells:
+                    row, col = divmod(cell, SIZE)
+                    if transposed:
+                        row, col = col, row
+                    if flip_rows:
+                        row = SIZE - 1 - row
+                    if flip_cols:
+                        col = SIZE - 1 - col
+                    mapped.append(row * SIZE + col)
+                out.append(tuple(mapped))
+
+    return out
+
+# ------------------------------
+
+
+class NTupleNetwork:
+    """
+    N-tuple network value function of afterstates.
+
+    ----- Attributes -----
+    - tuples : tuple of tuples of cell indices.  All tuples have the same length n
+    - weights : NumPy float32 2D-array [len(tuples)][16**n].  Memory-mapped if loaded from file
+    - lookups : list of (tuple index, cells) of each tuple in each symmetry
+    - filename : str. weight file, or None
+
+    ----- Methods -----
+    - value(board) : float. value of a packed board
+    - values(boards) : NumPy float64 1D-array. values of a NumPy uint64 1D-array of boards
+    - metric(board) / metrics(boards) : value, as a calc_option 5 metric (always > 0)
+    - update(board, delta) : add delta to every weight looked up by value(board)
+    - save(filename) / flush()
+    - create(filename, tuples) / load(filename, writable) : class methods, from a weight file
+    """
+
+    def __init__(self, tuples=TUPLES_4, weights=None, filename=None):
+        """
+        :param tuples: tuple of tuples of cell indices (row * 4 + col), all the same length
+        :param weights: NumPy float32 2D-array [len(tuples)][16**n].  None --> all 0
+        :param filename: str. weight file the weights were loaded from, if any
+        """
+
+        self.tuples = tuple(tuple(int(cell) for cell in cells) for cells in tuples)
+        tuple_len = len(self.tuples[0])
+        if any(len(cells) != tuple_len for cells in self.tuples):
+            raise ValueError("All tuples of an NTupleNetwork must have the same length.")
+
+        if weights is None:
+            weights = zeros((len(self.tuples), 16 ** tuple_len), dtype=float32)
+        if weights.shape != (len(self.tuples), 16 ** tuple_len):
+            raise ValueError(f"weights shape {weights.shape} doesn't match the tuples.")
+
+        self.weights = weights
+        self.filename = filename
+
+        self.lookups = [(idx, cells) for idx, base_cells in enumerate(self.tuples)
+                        for cells in symmetric_cells(base_cells)]
+
+        # For value() and update(): the weight table (a view of weights) of each lookup
+        self._tables = [(self.weights[idx], cells) for idx, cells in self.lookups]
+
+        # For values(): bit shifts of each cell, and of its position in the table index
+        self._shifts = [(idx, [(uint64(4 * cell), uint64(4 * k)) for k, cell in enumerate(cells)])
+                        for idx, cells in self.lookups]
+
+    def __repr__(self):
+
+        return (f"NTupleNetwork - Tuples: {len(self.tuples)} x {len(self.tuples[0])} cells | " +
+                f"Lookups: {len(self.lookups)} | File: {self.filename}\n")
+
+    @classmethod
+    def create(cls, filename, tuples=TUPLES_4):
+        """New network of all 0 weights, saved in (memory-mapped to) filename.
+        :return: NTupleNetwork"""
+
+        tuple_len = len(tuples[0])
+        weights = open_memmap(filename, mode="w+", dtype=float32,
+                              shape=(len(tuples), 16 ** tuple_len))
+        network = cls(tuples, weights, filename)
+        network._save_tuples(filename)
+
+        return network
+
+    @classmethod
+    def load(cls, filename, writable=False):
+        """
+        Open a weight file memory-mapped.
+
+        :param filename: str. .npy weight file saved by create() or save()
+        :param writable: bool. False --> weights are read-only (shared by all readers)
+                               True --> update() writes through to the file (see flush())
+        :return: NTupleNetwork
+        """
+
+        with open(_tuples_file(filename)) as file1:
+            tuples = json.load(file1)["tuples"]
+
+        weights = load(filename, mmap_mode="r+" if writable else "r")
+        return cls(tuples, weights, filename)
+
+    def save(self, filename):
+        """Save a copy of the weights (and tuples) to filename"""
+
+        # Write to a temp file first, so readers never load a partial file
+        temp_name = f"{filename}.{os.getpid()}.tmp.npy"
+        save(temp_name, self.weights)
+        os.replace(temp_name, filename)
+        self._save_tuples(filename)
+
+    def _save_tuples(self, filename):
+
+        with open(_tuples_file(filename), "w") as file1:
+            json.dump({"tuples": self.tuples}, file1)
+
+    def flush(self):
+        """Write changed weights of a writable memory-mapped network to its file"""
+
+        if hasattr(self.weights, "flush"):
+            self.weights.flush()
+
+    def _keys(self, board):
+        """:return: list of (table, index) of every weight looked up for a packed board"""
+
+        board = int(board)
+        exps = [(board >> shift) & 0xF for shift in range(0, 64, 4)]
+
+        keys = []
+        for table, cells in self._tables:
+            key = 0
+            shift = 0
+            for cell in cells:
+                key |= exps[cell] << shift
+                shift += 4
+            keys.append((table, key))
+
+        return keys
+
+    def value(self, board):
+        """:return: float. value of a packed board (int)"""
+
+        # item() returns a Python float, so the sum is float64 like values()
+        return sum([table.item(key) for table, key in self._keys(board)])
+
+    def _boards_keys(self, boards):
+        """:return: list of (tuple index, NumPy uint64 1D-array of the weight index of each board)
+                    of every lookup, for a NumPy uint64 1D-array of boards"""
+
+        nibble = uint64(0xF)
+
+        keys = []
+        for idx, shifts in self._shifts:
+            key = zeros(len(boards), dtype=uint64)
+            for cell_shift, key_shift in shifts:
+                key |= ((boards >> cell_shift) & nibble) << key_shift
+            keys.append((idx, key))
+
+        return keys
+
+    def values(self, boards):
+        """:return: NumPy float64 1D-array.  value() of each board of a NumPy uint64 1D-array"""
+
+        weights = self.weights
+
+        total = zeros(len(boards))
+        for idx, key in self._boards_keys(boards):
+            total += weights[idx][key]
+
+        return total
+
+    def metric(self, board):
+        """:return: float > 0.  value(board) as a calc_option 5 metric"""
+
+        return max(self.value(board), 0.0) + NTUPLE_FLOOR
+
+    def metrics(self, boards):
+        """:return: NumPy float64 1D-array > 0.  metric() of each board"""
+
+        return self.values(boards).clip(min=0.0) + NTUPLE_FLOOR
+
+    def update(self, board, delta):
+        """Add delta to every weight looked up by value(board).  (A weight looked up twice,
+        by two symmetries, gets 2 * delta)"""
+
+        for table, key in self._keys(board):
+            table[key] += delta
+
+    def update_boards(self, boards, deltas):
+        """update() of many boards at once.  Weights looked up by more than one board get
+        the sum of their deltas.
+        :param boards: NumPy uint64 1D-array
+        :param deltas: NumPy float 1D-array, one per board"""
+
+        weights = self.weights
+        deltas = deltas.astype(float32)
+
+        for idx, key in self._boards_keys(boards):
+            add.at(weights[idx], key, deltas)
+
+
+def _tuples_file(filename):
+    return os.path.splitext(filename)[0] + ".json"
+
+# ------------------------------
+# TD learning
+
+
+def play_td_episode(network, rand):
+    """
+    Play one game, always taking the move with the best reward + value of its afterstate.
+
+    :param network: NTupleNetwork
+    :param rand: NumPy random Generator
+    :return: (afterstates: list of int, rewards: list of int, score: int, max_tile: int)
+             rewards[i] is the score gained by the move leading to afterstates[i]
+    """
+
+    rands = rand.random(2 * 4)
+    board, _, _ = BitBoard.add_random_tile(0, rands, 0)
+    board, _, _ = BitBoard.add_random_tile(board, rands, 2)
+
+    afterstates = []
+    rewards = []
+    score = 0
+
+    while True:
+        valid_mask, boards2, gained = BitBoard.move_all(board)
+        if not valid_mask:
+            break
+
+        best_value = None
+        best_move = 0
+        for direction in range(4):
+            if (valid_mask >> direction) & 1:
+                move_value = gained[direction] + network.value(boards2[direction])
+                if best_value is None or move_value > best_value:
+                    best_value = move_value
+                    best_move = direction
+
+        afterstate = boards2[best_move]
+        afterstates.append(afterstate)
+        rewards.append(gained[best_move])
+        score += gained[best_move]
+
+        board, _, _ = BitBoard.add_random_tile(afterstate, rand.random(2), 0)
+
+    return afterstates, rewards, score, BitBoard.max_tile(board)
+
+
+def td_train_game(network, rand, alpha=TD_ALPHA, lam=0.0):
+    """
+    Play one game of self play, and learn from it.
+
+    lam == 0: TD(0).  The value of each afterstate moves towards the reward of the next move
+              plus the value of the next afterstate (0 after the last move).
+    lam > 0: TD(lambda), offline.  After the game, each afterstate moves towards its
+             lambda-return, computed backwards from the end of the game.
+
+    :param network: NTupleNetwork. updated in place
+    :param rand: NumPy random Generator
+    :param alpha: float. learning rate per weight
+    :param lam: float 0.0 - 1.0. lambda of TD(lambda)
+    :return: (score: int, num_moves: int, max_tile: int)
+    """
+
+    afterstates, rewards, score, max_tile = play_td_episode(network, rand)
+    num_moves = len(afterstates)
+
+    if lam == 0.0:
+        # Same updates as online TD(0), in game order
+        for i in range(num_moves):
+            if i + 1 < num_moves:
+                target = rewards[i + 1] + network.value(afterstates[i + 1])
+            else:
+                target = 0.0
+            network.update(afterstates[i], alpha * (target - network.value(afterstates[i])))
+    else:
+        lambda_return = 0.0
+        for i in range(num_moves - 1, -1, -1):
+            value = network.value(afterstates[i])
+            if i + 1 < num_moves:
+                lambda_return = rewards[i + 1] + (1.0 - lam) * next_value + lam * lambda_return
+            network.update(afterstates[i], alpha * (lambda_return - value))
+            next_value = value
+
+    return score, num_moves, max_tile
+
+
+def td_targets(values, rewards, lam=0.0):
+    """
+    TD targets of the afterstates of one game.
+
+    :param values: NumPy float64 1D-array. value of each afterstate
+    :param rewards: NumPy float64 1D-array. rewards[i] is the score of the move to afterstate i
+    :param lam: float 0.0 - 1.0. 0 --> TD(0) targets, else lambda-returns
+    :return: NumPy float64 1D-array. target of each afterstate (0 after the last move)
+    """
+
+    num_moves = len(values)
+    targets = zeros(num_moves)
+    if num_moves < 2:
+        return targets
+
+    # TD(0): reward of the next move + value of the next afterstate
+    targets[:-1] = rewards[1:] + values[1:]
+    if lam == 0.0:
+        return targets
+
+    lambda_return = 0.0
+    for i in range(num_moves - 2, -1, -1):
+        lambda_return = rewards[i + 1] + (1.0 - lam) * values[i + 1] + lam * lambda_return
+        targets[i] = lambda_return
+
+    return targets
+
+
+def td_update_episode(network, afterstates, rewards, alpha=TD_ALPHA, lam=0.0):
+    """
+    Learn from a whole game at once (batch TD): all targets are computed from the weights
+    before the update, then all updates are added with NTupleNetwork.update_boards().
+
+    :param network: NTupleNetwork. updated in place
+    :param afterstates: NumPy uint64 1D-array. afterstates of the game, in order
+    :param rewards: NumPy 1D-array. rewards[i] is the score of the move to afterstates[i]
+    :param alpha: float. learning rate per weight
+    :param lam: float 0.0 - 1.0. lambda of TD(lambda)
+    :return: float. mean squared TD error of the game
+    """
+
+    if len(afterstates) == 0:
+        return 0.0
+
+    values = network.values(afterstates)
+    errors = td_targets(values, rewards.astype(float), lam) - values
+    network.update_boards(afterstates, alpha * errors)
+
+    return float((errors ** 2).mean())
+
+# ------------------------------
+# Worker processes (see Training.train_ntuple_parallel())
+
+# Networks opened read-only by this process: filename --> NTupleNetwork
+_worker_networks = {}
+
+
+def play_episodes(filename, seed, num_games):
+    """
+    Play self play games with the weights of filename, without learning.  Runs in worker
+    processes: filename is memory-mapped once per process, and the learner's updates to the
+    file are seen by the next move, with no copying.
+
+    :param filename: str. weight file
+    :param seed: seed of the NumPy random Generator of the random tiles
+    :param num_games: int. number of games
+    :return: list of (afterstates: NumPy uint64 1D-array, rewards: NumPy int32 1D-array,
+                      score: int, max_tile: int), one per game
+    """
+
+    network = _worker_networks.get(filename)
+    if network is None:
+        network = NTupleNetwork.load(filename)
+        _worker_networks[filename] = network
+
+    rand = default_rng(seed)
+
+    episodes = []
+    for _ in range(num_games):
+        afterstates, rewards, score, max_tile = play_td_episode(network, rand)
+        episodes.append((array(afterstates, dtype=uint64), array(rewards, dtype=int32),
+                         score, max_tile))
+
+    return episodes
@@ -0,0 +1,186 @@
+"""
+This file contains a columnar store of game results, for sweeps of many games (see Sweep.py).
+- ResultsWriter, load_results(), load_columns(), load_shards(), completed_jobs()
+
+A store is a directory of shards.  Each shard is a directory of one NumPy .npy file per field
+of RESULT_DTYPE (<field>.npy), each a 1D-array with one entry per game.  ResultsWriter buffers
+results, and writes a new shard every buffer_rows games (or flush_seconds), so a sweep costs
+one shard write per batch of games instead of one file write per game.  A crash loses at most
+the unwritten buffer.
+
+Shards are written to a temp directory and renamed, so a shard is either complete or missing.
+Columns are memory-mapped when loaded, and load_columns() only opens the files of the fields
+asked for, so aggregating millions of games only reads those columns from disk, e.g.:
+
+    results = ResultsStore.load_columns("sweep_results", ["tree_depth", "score"])
+    print(results["score"][results["tree_depth"] == 6].mean())
+"""
+
+import os
+import time
+from glob import glob
+from itertools import count
+from numpy import concatenate, dtype, load, save, zeros
+
+# One entry per game
+RESULT_DTYPE = dtype([("job_id", "S96"),
+                      ("calc_option", "i1"),
+                      ("tree_depth", "i1"),
+                      ("topx", "f8"),
+                      ("mult_base", "f8"),
+                      ("game_num", "i4"),
+                      ("seed", "i8"),
+                      ("score", "i8"),
+                      ("num_moves", "i4"),
+                      ("max_tile", "i4"),
+                      ("duration", "f8")])
+
+# Shard directories.  Temp directories (".shard_*.tmp") do not match
+SHARD_PATTERN = "shard_*"
+
+# Numbers the ResultsWriters of this process, for unique shard names
+_writer_ids = count()
+
+# ------------------------------
+
+
+class ResultsWriter:
+    """
+    Buffered writer of game results to a store directory.  Use as a context manager,
+    or call close() at the end, so the last results are written.
+
+    ----- Attributes -----
+    - directory : str. store directory (created if needed)
+    - buffer : NumPy structured 1D-array of RESULT_DTYPE, of buffer_rows results
+    - num_buffered : int. results in buffer, not yet written
+    - num_shards : int. shards written by this writer
+
+    ----- Methods -----
+    - append(**fields) : add the result of one game.  Missing fields are 0.
+                         ValueError if a job_id does not fit in RESULT_DTYPE
+    - flush() : write buffered results as a new shard
+    - close() : flush()
+    """
+
+    def __init__(self, directory, buffer_rows=1024, flush_seconds=60.0):
+        """
+        :param directory: str. store directory
+        :param buffer_rows: int. results per shard (at most)
+        :param flush_seconds: float. buffered results are also written once the oldest
+                              has waited this long.  None --> only when the buffer is full
+        """
+
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        self.buffer = zeros(buffer_rows, dtype=RESULT_DTYPE)
+        self.num_buffered = 0
+        self.num_shards = 0
+        self.flush_seconds = flush_seconds
+        self.first_time = None
+
+        # Shard names are unique per writer, so many writers can share a directory
+        self.shard_prefix = (f"shard_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}_" +
+                             f"{next(_writer_ids)}")
+
+    def __repr__(self):
+
+        return (f"ResultsWriter - Directory: {self.directory} | Buffered: {self.num_buffered} | " +
+                f"Shards written: {self.num_shards}\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, **fields):
+        """Add the result of one game.  Keywords are fields of RESULT_DTYPE"""
+
+        unknown = set(fields) - set(RESULT_DTYPE.names)
+        if unknown:
+            raise ValueError(f"Unknown result fields {sorted(unknown)}. Must be in {list(RESULT_DTYPE.names)}.")
+
+        # NumPy would silently truncate a longer job_id
+        job_id = fields.get("job_id", "")
+        if len(job_id.encode()) > RESULT_DTYPE["job_id"].itemsize:
+            raise ValueError(f"job_id {job_id!r} is longer than {RESULT_DTYPE['job_id'].itemsize} bytes.")
+
+        for name in RESULT_DTYPE.names:
+            self.buffer[name][self.num_buffered] = fields.get(name, 0)
+
+        if self.num_buffered == 0:
+            self.first_time = time.perf_counter()
+        self.num_buffered += 1
+
+        if self.num_buffered == len(self.buffer) or (
+                self.flush_seconds is not None and
+                time.perf_counter() - self.first_time >= self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        """Write buffered results as a new shard, one .npy file per field"""
+
+        if self.num_buffered == 0:
+            return
+
+        shard_name = f"{self.shard_prefix}_{self.num_shards:05d}"
+        temp_dir = os.path.join(self.directory, f".{shard_name}.tmp")
+        os.makedirs(temp_dir, exist_ok=True)
+        for name in RESULT_DTYPE.names:
+            save(os.path.join(temp_dir, f"{name}.npy"), self.buffer[name][:self.num_buffered])
+        os.replace(temp_dir, os.path.join(self.directory, shard_name))
+
+        self.num_shards += 1
+        self.num_buffered = 0
+
+    def close(self):
+        self.flush()
+
+
+def load_shards(directory, names=None):
+    """
+    :param directory: str. store directory
+    :param names: list of str. fields of RESULT_DTYPE to load.  None --> all
+    :return: list of dicts of name --> NumPy 1D-array, each shard of a store, in order of
+             shard name.  Columns are memory-mapped (read-only)
+    """
+
+    if names is None:
+        names = RESULT_DTYPE.names
+
+    return [{name: load(os.path.join(shard_dir, f"{name}.npy"), mmap_mode="r") for name in names}
+            for shard_dir in sorted(glob(os.path.join(directory, SHARD_PATTERN)))]
+
+
+def load_results(directory):
+    """:return: NumPy structured 1D-array of RESULT_DTYPE.  Every result of a store, in memory.
+                load_columns() reads only some fields"""
+
+    columns = load_columns(directory, RESULT_DTYPE.names)
+    results = zeros(len(columns["job_id"]), dtype=RESULT_DTYPE)
+    for name in RESULT_DTYPE.names:
+        results[name] = columns[name]
+
+    return results
+
+
+def load_columns(directory, names):
+    """
+    :param directory: str. store directory
+    :param names: list of str. fields of RESULT_DTYPE
+    :return: dict of name --> NumPy 1D-array of that field of every result of a store.
+             Only the files of these fields are read from the shards
+    """
+
+    shards = load_shards(directory, names)
+
+    return {name: concatenate([shard[name] for shard in shards]) if shards
+            else zeros(0, dtype=RESULT_DTYPE[name])
+            for name in names}
+
+
+def completed_jobs(directory):
+    """:return: set of the job ids (str) of every result of a store"""
+
+    return {job_id.decode() for job_id in load_columns(directory, ["job_id"])["job_id"]}
@@ -0,0 +1,257 @@
+"""
+This file contains caches of search results, to avoid evaluating the same board twice.
+- TranspositionTable
+- EvalCache
+
+Boards are keyed by their packed 64-bit BitBoard int (see BitBoard).
+"""
+
+from collections import OrderedDict
+from numpy import empty, zeros, float64
+
+HASH_MULT = 0x9E3779B97F4A7C15      # 2**64 / golden ratio, for Fibonacci hashing
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+# Approximate memory used by one EvalCache entry (key tuple, int, float and OrderedDict node)
+EVAL_ENTRY_BYTES = 224
+
+
+class TranspositionTable:
+    """
+    Bounded table of board values, keyed by packed 64-bit BitBoard.
+
+    Holds a fixed number of slots (2**bits). Each board hashes to exactly one slot,
+    and each slot holds one entry: the board, its value, and the depth it was searched to.
+    An entry is only a "hit" if it was searched at least as deep as requested.
+
+    Replacement policy: a new entry overwrites a slot if the slot is empty, holds the same
+    board, holds an entry from an older search (see new_search()), or holds an entry
+    searched to the same or lower depth.  Otherwise the deeper, current entry is kept.
+
+    The table is meant to persist across consecutive get_move() calls of one AutoPlayer.
+    Values depend on the strategy parameters (calc_option, mult_base, ...), so a table must
+    NOT be shared between AutoPlayers with different parameters.
+
+    ----- Attributes -----
+    - hits, misses : int. lookup() counters
+    - stores, replacements : int. store() counters (replacements overwrote another board)
+
+    ----- Methods -----
+    - lookup(board, depth) : value, or None if not found
+    - store(board, depth, value)
+    - new_search() : call once per get_move(), ages all current entries
+    - clear()
+    """
+
+    def __init__(self, bits=16):
+        """
+        :param bits: int. table holds 2**bits entries
+        """
+
+        self.bits = bits
+        self.size = 1 << bits
+        self.shift = 64 - bits
+
+        self.clear()
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.replacements = 0
+
+    def __len__(self):
+        return self.size - self.keys.count(None)
+
+    def __repr__(self):
+
+        return (f"TranspositionTable - Size: {self.size} | Used: {len(self)} | " +
+                f"Hits: {self.hits} | Misses: {self.misses} | Hit Rate: {self.hit_rate():.3f} | " +
+                f"Stores: {self.stores} | Replacements: {self.replacements}\n")
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def slot(self, board):
+        """Slot index of a board (Fibonacci hashing, the top 'bits' bits of board * HASH_MULT)"""
+        return ((board * HASH_MULT) & MASK64) >> self.shift
+
+    def lookup(self, board, depth, exact=False):
+        """
+        :param board: int. packed BitBoard
+        :param depth: int. minimum search depth needed
+        :param exact: bool. True --> only an entry searched to exactly depth is a hit
+                      (e.g. depth 0 evaluations, which deeper search values must not replace)
+        :return: stored value if board is in table, searched to >= depth (== depth if exact).
+                 Otherwise None
+        """
+
+        idx = ((board * HASH_MULT) & MASK64) >> self.shift
+
+        stored_depth = self.depths[idx]
+        if self.keys[idx] == board and (stored_depth == depth if exact else stored_depth >= depth):
+            self.hits += 1
+            return self.values[idx]
+
+        self.misses += 1
+        return None
+
+    def store(self, board, depth, value):
+        """
+        Save the value of board, searched to depth, if the replacement policy allows.
+
+        :param board: int. packed BitBoard
+        :param depth: int. depth value was searched to (0: board was only evaluated)
+        :param value: float. value of board
+        """
+
+        idx = ((board * HASH_MULT) & MASK64) >> self.shift
+        key = self.keys[idx]
+
+        if key is not None and key != board:
+            if self.generations[idx] == self.generation and self.depths[idx] > depth:
+                return
+            self.replacements += 1
+
+        elif key == board and self.depths[idx] > depth:
+            return
+
+        self.keys[idx] = board
+        self.values[idx] = value
+        self.depths[idx] = depth
+        self.generations[idx] = self.generation
+        self.stores += 1
+
+    def new_search(self):
+        """Start a new search.  Entries of earlier searches stay valid, but can be replaced."""
+        self.generation += 1
+
+    def clear(self):
+        """Empty every slot"""
+
+        self.keys = [None] * self.size
+        self.values = [0.0] * self.size
+        self.depths = [0] * self.size
+        self.generations = [0] * self.size
+        self.generation = 0
+
+# ------------------------------
+
+
+class EvalCache:
+    """
+    Bounded cache of board evaluations (calc_metric), keyed by packed 64-bit BitBoard and
+    the strategy parameters the metric depends on (see AutoPlayer.eval_params).
+
+    Unlike TranspositionTable, entries don't depend on search depth or on which AutoPlayer
+    stored them, so one EvalCache can be shared by many AutoPlayers and games, even with
+    different parameters.
+
+    Eviction policy: least recently used (LRU).  Once max_entries are held, storing a new
+    board drops the entry looked up or stored longest ago.
+
+    ----- Attributes -----
+    - max_entries : int. memory cap, as a number of entries
+    - hits, misses : int. lookup counters
+    - evictions : int. entries dropped to stay within max_entries
+
+    ----- Methods -----
+    - lookup(board, params) : metric, or None if not found
+    - store(board, params, metric)
+    - lookup_boards(boards, params) : vectorized lookup(), (metrics, found)
+    - store_boards(boards, params, metrics) : vectorized store()
+    - clear()
+    """
+
+    def __init__(self, max_mb=64):
+        """
+        :param max_mb: float. memory cap in MB (2**20 bytes), approximately.
+                       Each entry uses ~EVAL_ENTRY_BYTES
+        """
+
+        self.max_entries = max(1, int(max_mb * 2**20) // EVAL_ENTRY_BYTES)
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+
+        return (f"EvalCache - Size: {self.max_entries} | Used: {len(self)} | " +
+                f"Hits: {self.hits} | Misses: {self.misses} | Hit Rate: {self.hit_rate():.3f} | " +
+                f"Evictions: {self.evictions}\n")
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def lookup(self, board, params):
+        """
+        :param board: int. packed BitBoard
+        :param params: hashable tuple of strategy parameters
+        :return: stored metric, or None if not found
+        """
+
+        key = (board, params)
+        metric = self.entries.get(key)
+        if metric is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return metric
+
+    def store(self, board, params, metric):
+        """
+        Save the metric of board, evicting the least recently used entry if full.
+
+        :param board: int. packed BitBoard
+        :param params: hashable tuple of strategy parameters
+        :param metric: float
+        """
+
+        key = (board, params)
+        entries = self.entries
+        entries[key] = metric
+        entries.move_to_end(key)
+
+        if len(entries) > self.max_entries:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def lookup_boards(self, boards, params):
+        """
+        :param boards: NumPy uint64 1D-array of packed boards
+        :param params: hashable tuple of strategy parameters
+        :return: (metrics: float64 1D-array, found: bool 1D-array).  metrics are 0 if not found
+        """
+
+        metrics = zeros(len(boards), dtype=float64)
+        found = empty(len(boards), dtype=bool)
+
+        for i, board in enumerate(boards.tolist()):
+            metric = self.lookup(board, params)
+            found[i] = metric is not None
+            if metric is not None:
+                metrics[i] = metric
+
+        return metrics, found
+
+    def store_boards(self, boards, params, metrics):
+        """
+        :param boards: NumPy uint64 1D-array of packed boards
+        :param params: hashable tuple of strategy parameters
+        :param metrics: NumPy float 1D-array, metric of each board
+        """
+
+        for board, metric in zip(boards.tolist(), metrics.tolist()):
+            self.store(board, params, metric)
+
+    def clear(self):
+
+        self.entries.clear()
@@ -0,0 +1,231 @@
+"""
+This file contains a parameter sweep runner: many AutoPlay games over a grid of parameters.
+- load_config(), expand_jobs(), run_sweep()
+
+A sweep is described by a JSON config file (see sweep_config.json):
+{
+    "name": "calc3_td6",                    name of the sweep, and of its results
+    "grid": {                               parameter --> list of values, or
+        "calc_option": [3],                     {"linspace": [min, max, steps]}
+        "tree_depth": [6],
+        "topx": {"linspace": [0.02, 0.04, 3]},
+        "mult_base": {"linspace": [1, 2, 6]}
+    },
+    "reps": 25,                             games per combination of parameters
+    "seed": 0,                              seed of game number 0 (game n: seed + n)
+    "compiled": true,                       true --> AutoPlayUtilsCy.play_game(), else AutoPlayer
+    "num_workers": 0,                       processes.  0 --> one per CPU
+    "buffer_rows": 1024,                    results written to the store per batch
+    "lut_weights": {},                      calc_option 4: AutoPlayer lut_weights
+    "ntuple_file": null                     calc_option 5: AutoPlayer ntuple_file
+}
+
+"compiled" games only support calc_option 0-3.  calc_option 4 and 5 need "compiled": false.
+
+Every (parameters, game number) is one job, played by one process of a pool.  Game n has the
+same seed for every combination of parameters, so combinations are compared on the same games.
+Finished jobs are written, with their job ids, in batches to a results store (see
+ResultsStore.py): the directory <name>_results, next to the config file.  A sweep that is run
+again skips the jobs already in its store, so an interrupted sweep resumes where it stopped.
+"""
+
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+from math import exp
+from numpy import linspace, random
+from numpy.random import SeedSequence
+
+import AutoPlay
+import GameMgr
+import ResultsStore
+
+# Parameters of a game, in the order of the grid.  Any not in the grid use these values
+GRID_DEFAULTS = {"calc_option": 3, "tree_depth": 6, "topx": 0.05, "mult_base": 1.5}
+
+CONFIG_DEFAULTS = {"name": "sweep", "grid": {}, "reps": 1, "seed": 0, "compiled": True,
+                   "num_workers": 0, "buffer_rows": 1024, "lut_weights": {}, "ntuple_file": None}
+
+# calc_options of each way of playing games (see play_job())
+COMPILED_CALC_OPTIONS = (0, 1, 2, 3)
+AUTOPLAYER_CALC_OPTIONS = (0, 1, 2, 3, 4, 5)
+
+
+def load_config(filename):
+    """
+    Read and check a sweep config file.  Missing entries get their CONFIG_DEFAULTS value.
+
+    :param filename: str. JSON config file
+    :return: dict. the config, with "output": directory of its results store
+    """
+
+    with open(filename) as file1:
+        config = dict(CONFIG_DEFAULTS, **json.load(file1))
+
+    config.setdefault("output", os.path.join(os.path.dirname(filename), config["name"] + "_results"))
+    check_config(config)
+
+    return config
+
+
+def check_config(config):
+    """Raise ValueError if any job of a sweep config can't be played as configured,
+    before any game is played"""
+
+    unknown = set(config["grid"]) - set(GRID_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown sweep parameters {sorted(unknown)}. Must be in {list(GRID_DEFAULTS)}.")
+
+    calc_options = grid_values(config["grid"].get("calc_option", GRID_DEFAULTS["calc_option"]))
+    supported = COMPILED_CALC_OPTIONS if config["compiled"] else AUTOPLAYER_CALC_OPTIONS
+    unsupported = sorted(set(calc_options) - set(supported))
+    if unsupported:
+        raise ValueError(f"calc_option {unsupported} can't be played with compiled={config['compiled']}. " +
+                         f"Must be in {list(supported)}.")
+
+    if 5 in calc_options and not config["ntuple_file"]:
+        raise ValueError("calc_option 5 needs an ntuple_file of network weights.")
+
+    tree_depths = grid_values(config["grid"].get("tree_depth", GRID_DEFAULTS["tree_depth"]))
+    if min(tree_depths) < 1 or (config["compiled"] and max(tree_depths) > 10):
+        raise ValueError(f"tree_depth {tree_depths} invalid.  Must be >= 1 (and <= 10 if compiled).")
+
+
+def grid_values(spec):
+    """:return: list of the values of one grid parameter: a list, a single value,
+                or {"linspace": [min, max, steps]}"""
+
+    if isinstance(spec, dict):
+        start, stop, num = spec["linspace"]
+        return [float(value) for value in linspace(start, stop, num=int(num))]
+
+    if isinstance(spec, list):
+        return spec
+
+    return [spec]
+
+
+def expand_jobs(config):
+    """
+    :param config: dict. sweep config (see load_config())
+    :return: list of jobs, one per (parameters, game number).  Each job is a dict of the
+             GRID_DEFAULTS parameters, "game_num", "seed" and "job_id" (unique within a sweep,
+             and the same every time the config is expanded).  The job id also holds the seed
+             and "compiled", so a store is not resumed with games of other seeds or players
+    """
+
+    grid = {name: grid_values(config["grid"].get(name, default))
+            for name, default in GRID_DEFAULTS.items()}
+
+    jobs = []
+    for values in product(*grid.values()):
+        params = dict(zip(grid, values))
+        for game_num in range(config["reps"]):
+            job = dict(params, game_num=game_num, seed=config["seed"] + game_num)
+            job["job_id"] = "|".join([*(f"{job[name]}" for name in (*GRID_DEFAULTS, "game_num", "seed")),
+                                      "compiled" if config["compiled"] else "autoplayer"])
+            jobs.append(job)
+
+    return jobs
+
+
+def estimate_time(jobs, num_workers):
+    """:return: float. rough estimate of the seconds to play jobs on num_workers processes
+                (from timings of calc_option 3 games, compiled)"""
+
+    return sum(0.05 * exp(1.15 * job["tree_depth"]) for job in jobs) / max(num_workers, 1)
+
+
+def play_job(job, config):
+    """
+    Play the game of one job.
+
+    :param job: dict. a job of expand_jobs()
+    :param config: dict. sweep config.  "compiled": True --> whole game in C with
+                   AutoPlayUtilsCy.play_game().  False --> AutoPlayer game (any backend),
+                   with the config's lut_weights and ntuple_file
+    :return: (job, score, num_moves, max_tile, duration)
+    """
+
+    start_time = time.perf_counter()
+
+    if config["compiled"]:
+        import AutoPlayUtilsCy
+        score, num_moves, max_tile = AutoPlayUtilsCy.play_game(
+            job["seed"], job["tree_depth"], job["topx"], job["calc_option"], job["mult_base"])
+    else:
+        # Independent random streams of the game's tiles and of the AutoPlayer's search
+        game_seed, ap_seed = SeedSequence(job["seed"]).spawn(2)
+
+        game = GameMgr.Game(None)
+        game.rand = random.default_rng(game_seed)
+        game.add_random_tile(commit=True)
+
+        ap = AutoPlay.AutoPlayer(game, job["tree_depth"], job["topx"], job["calc_option"],
+                                 rand=random.default_rng(ap_seed), mult_base=job["mult_base"],
+                                 lut_weights=config["lut_weights"],
+                                 ntuple_file=config["ntuple_file"])
+        while not game.game_over:
+            ap.auto_move()
+        score, num_moves, max_tile = game.score, game.num_moves, int(game.tiles.max())
+
+    return job, score, num_moves, max_tile, time.perf_counter() - start_time
+
+
+def run_sweep(config):
+    """
+    Play every job of a sweep not already in its results store, on a pool of processes.
+    Results are written in batches of config["buffer_rows"] (or every minute).  If the sweep is
+    stopped (Ctrl-C) or a job fails, pending jobs are cancelled and the finished ones written.
+
+    :param config: dict. sweep config (see load_config())
+    :return: int. number of jobs played
+    """
+
+    check_config(config)
+    jobs = expand_jobs(config)
+    done = ResultsStore.completed_jobs(config["output"])
+    todo = [job for job in jobs if job["job_id"] not in done]
+    print(f"Sweep {config['name']}: {len(jobs)} jobs | Done: {len(jobs) - len(todo)} | " +
+          f"To do: {len(todo)}", flush=True)
+
+    if not todo:
+        return 0
+
+    num_workers = config["num_workers"] or os.cpu_count()
+
+    start_time = time.perf_counter()
+    written = set()
+
+    def write_result(task):
+        job, score, num_moves, max_tile, duration = task.result()
+        writer.append(**job, score=score, num_moves=num_moves, max_tile=max_tile,
+                      duration=duration)
+        written.add(task)
+
+        print(f"{job['job_id']} ({score}) | {len(written)}/{len(todo)} | " +
+              f"Time: {time.perf_counter() - start_time:.0f}s", flush=True)
+
+    with ResultsStore.ResultsWriter(config["output"], config["buffer_rows"]) as writer:
+        # "spawn": see AutoPlay.get_worker_pool().  Forked workers inherit the OpenMP / Numba
+        # thread pools of this process, which can hang the workers, or this process at exit
+        pool = ProcessPoolExecutor(max_workers=num_workers,
+                                   mp_context=multiprocessing.get_context("spawn"))
+        tasks = [pool.submit(play_job, job, config) for job in todo]
+        try:
+            for task in as_completed(tasks):
+                write_result(task)
+        except BaseException:
+            # Don't wait for the pending jobs.  Keep the finished ones (written when writer closes)
+            pool.shutdown(wait=False, cancel_futures=True)
+            for task in tasks:
+                if (task not in written and task.done() and not task.cancelled() and
+                        task.exception() is None):
+                    write_result(task)
+            raise
+        pool.shutdown()
+
+    return len(todo)
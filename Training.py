@@ -1,106 +1,209 @@
-import AutoPlayTests
+import NTuple
+import Sweep
 import csv
+import multiprocessing
+import os
+import sys
 import time
-from math import exp
-from numpy import linspace
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from numpy import random
+
+
+def train_ntuple(filename, num_games, tuples=NTuple.TUPLES_4, alpha=NTuple.TD_ALPHA, lam=0.0,
+                 seed=0, checkpoint_every=1000, log_every=100):
+    """
+    Train an n-tuple network (calc_option 5) by TD self play.  Weights are memory-mapped from
+    filename, and written back every checkpoint_every games, so training can be stopped and
+    continued later.  The score of each game is saved to filename + ".csv".
+
+    :param filename: str. .npy weight file.  Created (all 0 weights) if it doesn't exist
+    :param num_games: int. number of self play games
+    :param tuples: tuples of a new network (see NTuple.TUPLES_4 / TUPLES_6)
+    :param alpha: float. learning rate
+    :param lam: float 0.0 - 1.0. 0 --> TD(0), else TD(lambda)
+    :param seed: int. seed of the random tiles.  Continue a training with a new seed
+    :param checkpoint_every: int. games between writes of the weights to filename
+    :param log_every: int. games between printed average scores
+    :return: NTuple.NTupleNetwork
+    """
+
+    if os.path.exists(filename):
+        network = NTuple.NTupleNetwork.load(filename, writable=True)
+    else:
+        network = NTuple.NTupleNetwork.create(filename, tuples)
+    print(network)
+
+    rand = random.default_rng(seed)
+    log_file = filename + ".csv"
+    if not os.path.exists(log_file):
+        with open(log_file, mode="x", newline="") as file1:
+            csv_writer = csv.writer(file1, dialect="excel", delimiter=",")
+            csv_writer.writerow(["Seed", "Game_Number", "Score", "Num_Moves", "Max_Tile", "Duration"])
+
+    scores = []
+    rows = []
+    start_time = time.perf_counter()
+    for game_num in range(num_games):
+        game_start = time.perf_counter()
+        score, num_moves, max_tile = NTuple.td_train_game(network, rand, alpha, lam)
+        scores.append(score)
+        rows.append([seed, game_num, score, num_moves, max_tile, time.perf_counter() - game_start])
+
+        log = (game_num + 1) % log_every == 0
+        checkpoint = (game_num + 1) % checkpoint_every == 0
+
+        # Log file is written in batches (each log and checkpoint), not once per game
+        if log or checkpoint:
+            with open(log_file, mode="a", newline="") as file1:
+                csv_writer = csv.writer(file1, dialect="excel", delimiter=",")
+                csv_writer.writerows(rows)
+            rows.clear()
+
+        if log:
+            print(f"Games: {game_num + 1} | Avg score (last {log_every}): " +
+                  f"{sum(scores[-log_every:]) / log_every:.0f} | " +
+                  f"Time: {time.perf_counter() - start_time:.0f}s", flush=True)
+
+        if checkpoint:
+            network.flush()
+
+    if rows:
+        with open(log_file, mode="a", newline="") as file1:
+            csv_writer = csv.writer(file1, dialect="excel", delimiter=",")
+            csv_writer.writerows(rows)
+
+    network.flush()
+
+    return network
+
+
+def train_ntuple_parallel(filename, num_games, num_workers=os.cpu_count(), tuples=NTuple.TUPLES_4,
+                          alpha=NTuple.TD_ALPHA, lam=0.0, seed=0, games_per_task=4,
+                          checkpoint_every=10000, eval_every=5000, eval_games=100):
+    """
+    train_ntuple() with self play in num_workers processes.  Workers play games with the
+    current weights (memory-mapped read-only from filename) and send back each game's
+    afterstates and rewards.  This process is the only learner: it applies each game as one
+    batch update (NTuple.td_update_episode()), writing straight into the memory-mapped file,
+    so workers play with the new weights from their next move on.
+
+    Up to 2 tasks per worker are in flight, so workers never wait for the learner.  Games are
+    reproducible (seed, task number), but training isn't, as workers read weights mid-update.
+
+    :param filename: str. .npy weight file.  Created (all 0 weights) if it doesn't exist
+    :param num_games: int. number of self play games
+    :param num_workers: int. number of worker processes
+    :param tuples: tuples of a new network (see NTuple.TUPLES_4 / TUPLES_6)
+    :param alpha: float. learning rate
+    :param lam: float 0.0 - 1.0. 0 --> TD(0), else TD(lambda)
+    :param seed: int. seed of the random tiles
+    :param games_per_task: int. games played per worker task
+    :param checkpoint_every: int. games between checkpoints: a copy of the weights saved
+                             as <filename>_<games>.npy
+    :param eval_every: int. games between evaluations: eval_games games without learning,
+                       on the same seeds each time.  0 --> no evaluation
+    :param eval_games: int. games per evaluation
+    :return: NTuple.NTupleNetwork
+    """
+
+    if not os.path.exists(filename):
+        NTuple.NTupleNetwork.create(filename, tuples).flush()
+    network = NTuple.NTupleNetwork.load(filename, writable=True)
+    print(network)
+
+    log_file = filename + ".csv"
+    if not os.path.exists(log_file):
+        with open(log_file, mode="x", newline="") as file1:
+            csv_writer = csv.writer(file1, dialect="excel", delimiter=",")
+            csv_writer.writerow(["Seed", "Game_Number", "Score", "Num_Moves", "Max_Tile", "TD_Error"])
+
+    num_tasks = -(-num_games // games_per_task)
+    base_name = os.path.splitext(filename)[0]
+
+    scores = []
+    rows = []
+    next_checkpoint = checkpoint_every
+    next_eval = eval_every
+    start_time = time.perf_counter()
+
+    # "spawn": see AutoPlay.get_worker_pool()
+    with ProcessPoolExecutor(max_workers=num_workers,
+                             mp_context=multiprocessing.get_context("spawn")) as pool:
+        pending = deque()
+        task_num = 0
+
+        while task_num < num_tasks or pending:
+            # Keep every worker busy, with one task queued behind it
+            while task_num < num_tasks and len(pending) < 2 * num_workers:
+                task_games = min(games_per_task, num_games - task_num * games_per_task)
+                pending.append(pool.submit(NTuple.play_episodes, filename, (seed, 1, task_num), task_games))
+                task_num += 1
+
+            for afterstates, rewards, score, max_tile in pending.popleft().result():
+                td_error = NTuple.td_update_episode(network, afterstates, rewards, alpha, lam)
+                rows.append([seed, len(scores), score, len(afterstates), max_tile, td_error])
+                scores.append(score)
+
+            games = len(scores)
+            checkpoint = games >= next_checkpoint or games == num_games
+            if checkpoint:
+                network.flush()
+                network.save(f"{base_name}_{games}.npy")
+                next_checkpoint += checkpoint_every
+
+            evaluate = eval_every and games >= next_eval
+
+            # Log file is written in batches (each checkpoint and evaluation), not once per game
+            if checkpoint or evaluate:
+                with open(log_file, mode="a", newline="") as file1:
+                    csv_writer = csv.writer(file1, dialect="excel", delimiter=",")
+                    csv_writer.writerows(rows)
+                rows.clear()
+
+                eval_scores = []
+                if evaluate:
+                    # Same seeds every evaluation, so evaluations are comparable
+                    eval_tasks = [pool.submit(NTuple.play_episodes, filename, (seed, 0, i), 1)
+                                  for i in range(eval_games)]
+                    eval_scores = [task.result()[0][2] for task in eval_tasks]
+                    next_eval += eval_every
+
+                print(f"Games: {games} | Avg score (last {len(scores[-1000:])}): " +
+                      f"{sum(scores[-1000:]) / len(scores[-1000:]):.0f} | " +
+                      (f"Eval avg: {sum(eval_scores) / eval_games:.0f} | " if eval_scores else "") +
+                      f"Time: {time.perf_counter() - start_time:.0f}s", flush=True)
+
+    if rows:
+        with open(log_file, mode="a", newline="") as file1:
+            csv_writer = csv.writer(file1, dialect="excel", delimiter=",")
+            csv_writer.writerows(rows)
+
+    network.flush()
+
+    return network
 
 
 if __name__ == '__main__':
 
-    records = []
-
-    # Parameters
-    calc_min = 3
-    calc_max = 3
-    tree_depth_min = 6
-    tree_depth_max = 6
-    topx_min = .02
-    topx_max = .04
-    topx_steps = 3
-    calc_mult_min = 1
-    calc_mult_max = 2
-    calc_mult_steps = 6
-    reps = 25
-
-    # Estimate Time Required
-    tot_games = (calc_max - calc_min + 1) * (tree_depth_max - tree_depth_min + 1) * (topx_max - topx_min + 1) * reps
-
-    total_time = 0
-    calc_reps = calc_max - calc_min + 1
-    tree_depth_reps = tree_depth_max - tree_depth_min + 1
-    tot_games = calc_reps * tree_depth_reps * topx_steps * calc_mult_steps * reps
-    reps2 = calc_reps * topx_steps * (calc_mult_steps + 1) * reps
-    # for calc_option in range(calc_min, calc_max+1):
-    #     for tree_depth in range(tree_depth_min, tree_depth_max+1):
-    #         for topx in range(topx_min, topx_max+1):
-    #             calc_reps = calc_max - calc_min + 1
-    #             topx_reps = topx_max - topx_min + 1
-    #             calc_mult_reps = (calc_mult_max -
-    #             total_time += reps*(*0.05*exp(1.15*tree_depth)
-
-    for tree_depth in range(tree_depth_min, tree_depth_max + 1):
-        total_time += reps2*0.05*exp(1.15*tree_depth)
-
-    print(f"Total iterations: {tot_games} | Time Estimate: {total_time/60} minutes | {total_time/3600} hours")
-    ans = input(f"Continue [y/n]? ")
-    if ans in ["n", "N"]:
+    # True --> train the n-tuple network of calc_option 5 (train_ntuple_parallel()) instead of the sweep
+    ntuple_training = False
+    if ntuple_training:
+        train_ntuple_parallel("ntuple_weights.npy", num_games=100000)
         quit()
 
-    # Initialize CSV File
-    date1 = time.ctime().replace(" ", "_").replace(":", "_")
-    filename = f"calc{calc_min}to{calc_max}_td{tree_depth_min}to{tree_depth_max}" + \
-               f"_topx{topx_min}to{topx_max}_calcmult{calc_mult_min}to{calc_mult_max}" + \
-               f"_{date1}.csv"
+    # Parameter sweep: grid, reps, seeds and processes are set in the config file
+    # (see Sweep.py).  Run it again to resume an interrupted sweep.
+    config = Sweep.load_config(sys.argv[1] if len(sys.argv) > 1 else "sweep_config.json")
+    jobs = Sweep.expand_jobs(config)
 
-    with open(filename, mode='x', newline='') as file1:
-        csv_writer = csv.writer(file1, dialect="excel", delimiter=",")
-        csv_writer.writerow(["Calc_Option", "Tree_Depth", "TopX", "Calc_Mult",
-                             "Game_Number", "Score", "Duration"])  # Must write header row manually
+    total_time = Sweep.estimate_time(jobs, config["num_workers"] or os.cpu_count())
+    print(f"Total iterations: {len(jobs)} | Time Estimate: {total_time/60} minutes | {total_time/3600} hours")
+    ans = input(f"Continue [y/n]? ")
+    if ans in ["n", "N"]:
+        quit()
 
-    # Start Main Loop to Permute parameters
     overall_start_time = time.perf_counter()
-
-    for calc_option in range(calc_min, calc_max+1):
-        print(f"\n***Calc: {calc_option}  ", end="", flush=True)
-
-        for tree_depth in range(tree_depth_min, tree_depth_max+1):
-            print(f"***TreeDp: {tree_depth}  ", end="", flush=True)
-
-            for topx in linspace(topx_min, topx_max, num=topx_steps):
-                print(f"\n***TopX: {topx*100}%  ", end="", flush=True)
-
-                for calc_mult in linspace(calc_mult_min, calc_mult_max, num=calc_mult_steps):
-                    print(f"\n***Mult_Base: {calc_mult}  ", end="", flush=True)
-
-                    for game_num in range(reps):
-                        print(f"\n***Repetition Number: {game_num}  ", flush=True)
-                        total_fwd_tiles = 0
-                        for i in range(tree_depth+1):
-                            total_fwd_tiles += 4**i
-
-                        if (2**topx) > (total_fwd_tiles / 3):
-                            continue
-
-                        start_time = time.perf_counter()
-                        ap = AutoPlayTests.play_games(1, tree_depth, topx, calc_option, calc_mult)
-                        end_time = time.perf_counter()
-                        print(ap)
-
-                        print(f"{game_num} ({ap.game.score}), ", end="", flush=True)
-
-                        # Save Records to CSV File
-                        data = [calc_option, tree_depth, topx, calc_mult, game_num,
-                                ap.game.score, end_time-start_time]
-
-                        with open(filename, mode="a", newline="") as file1:
-                            csv_writer = csv.writer(file1, dialect="excel", delimiter=",")
-                            csv_writer.writerow(data)
-
-                        # records.append(data)
-
+    Sweep.run_sweep(config)
     overall_end_time = time.perf_counter()
-    # records.append([overall_start_time, overall_end_time, overall_end_time-overall_start_time])
-    with open(filename, mode="a", newline="") as file1:
-        csv_writer = csv.writer(file1, dialect="excel", delimiter=",")
-        csv_writer.writerow([overall_start_time, overall_end_time, overall_end_time-overall_start_time])
-
+    print(f"Duration: {overall_end_time - overall_start_time} seconds | Results: {config['output']}")
@@ -344,7 +344,8 @@ class UiMain(object):
 
         self.comboBox = QComboBox(self.ap_area_widget)
         self.comboBox.addItems(["Most Blank Tiles", "Maximize Upper Right Chain",
-                                "Any Corner Chain + Blanks", "Aligned Corner Chains Only"])
+                                "Any Corner Chain + Blanks", "Aligned Corner Chains Only",
+                                "Row Table Heuristic"])
         self.comboBox.currentIndexChanged.connect(self.ap_type_changed)
         self.comboBox.setEnabled(True)
         self.comboBox.setObjectName("comboBox")
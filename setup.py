@@ -1,6 +1,23 @@
-from setuptools import setup
+import sys
+from setuptools import setup, Extension
 from Cython.Build import cythonize
 
+# OpenMP lets the prange helpers of AutoPlayUtilsCy use all cores.
+# Apple clang has no OpenMP by default, so those helpers run on one thread there.
+if sys.platform == "win32":
+    openmp_compile_args = ["/openmp"]
+    openmp_link_args = []
+elif sys.platform == "darwin":
+    openmp_compile_args = []
+    openmp_link_args = []
+else:
+    openmp_compile_args = ["-fopenmp"]
+    openmp_link_args = ["-fopenmp"]
+
+extensions = [Extension("AutoPlayUtilsCy", ["AutoPlayUtilsCy.pyx"],
+                        extra_compile_args=openmp_compile_args,
+                        extra_link_args=openmp_link_args)]
+
 setup(
     name='2048project',
     version='0.0.0',
@@ -10,8 +27,6 @@ setup(
     author='Adam Kinsey',
     author_email='adamkinsey273@gmail.com',
     description='Python 2048 Clone with AutoPlay',
-    ext_modules=cythonize("AutoPlayUtilsCy.pyx",
-                          include_path=["C:\\Users\\Stephanie\\Documents\\Machine Learning\\2048\\2048project"],
-                          gdb_debug=False),
+    ext_modules=cythonize(extensions, gdb_debug=False),
     zip_safe= False
 )